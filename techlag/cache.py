@@ -0,0 +1,503 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2016 Bitergia
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+##
+## Authors:
+##   Jesus M. Gonzalez-Barahona <jgb@bitergia.com>
+##
+
+"""Persistent caches, stored in SQLite files.
+
+SQLite is used so that caches are a single file, can be read and
+written by several processes at the same time (for example, the
+workers used by Metrics), and survive crashes of the programs using them.
+
+"""
+
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+
+class SQLiteStore:
+    """Base class for stores kept in a SQLite file.
+
+    The connection to the database is opened when first needed, and
+    is not pickled, so that objects in this class can be passed to
+    other processes (each of them will open its own connection).
+    The database is used in WAL mode, so that readers don't block
+    writers, and writers wait (up to timeout seconds) for other writers.
+
+    Subclasses should define schema, a string with the SQL statements
+    to create their tables (if they don't exist).
+
+    :param path:    path of the SQLite file
+    :param timeout: seconds to wait for the database to be unlocked
+
+    """
+
+    schema = ""
+    # Allow using the connection from several threads (if True,
+    # subclasses should serialize its use)
+    threads = False
+
+    def __init__(self, path, timeout=60):
+
+        self.path = path
+        self.timeout = timeout
+        self.conn = None
+
+    def __getstate__(self):
+        """Get state for pickling (connections can't be pickled)
+
+        """
+
+        state = self.__dict__.copy()
+        state['conn'] = None
+        return state
+
+    def _connect(self):
+        """Get the connection to the database, opening it if needed.
+
+        """
+
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                        check_same_thread=not self.threads)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript(self.schema)
+        return self.conn
+
+    def close(self):
+        """Close the connection to the database, if open.
+
+        """
+
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+class MetricsCache(SQLiteStore):
+    """Cache of metrics comparing directories with commits.
+
+    Metrics are stored for a directory (identified by its fingerprint,
+    see BaseDir.fingerprint), a commit (identified by its hash), and
+    the kinds of metrics computed. Therefore, they are valid for any
+    later run comparing the same directory with the same repository.
+
+    The cache is bounded to max_entries. When it grows larger, the
+    entries least recently used are evicted. To avoid a write for every
+    hit, the times of use of entries are kept in memory, and written to
+    the database in batches, when calling flush (or evict, or close).
+
+    :param path:        path of the SQLite file
+    :param max_entries: maximum number of entries in the cache
+
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS metrics (
+            fingerprint TEXT, commit_hash TEXT, kinds TEXT,
+            metrics TEXT, used REAL,
+            PRIMARY KEY (fingerprint, commit_hash, kinds));
+        CREATE INDEX IF NOT EXISTS metrics_used ON metrics (used);
+        """
+
+    # Number of insertions between checks of the size of the cache
+    check_every = 100
+
+    def __init__(self, path, max_entries=1000000):
+
+        super().__init__(path)
+        self.max_entries = max_entries
+        self.inserted = 0
+        self.used = {}
+
+    def __getstate__(self):
+        """Get state for pickling (pending times of use are not pickled)
+
+        """
+
+        state = super().__getstate__()
+        state['used'] = {}
+        return state
+
+    @staticmethod
+    def _kinds(kinds):
+        """Key for a list of kinds of metrics.
+
+        """
+
+        return ','.join(sorted(kinds))
+
+    def get(self, fingerprint, commit, kinds):
+        """Get metrics from the cache.
+
+        :param fingerprint: fingerprint of the directory
+        :param commit:      hash of the commit
+        :param kinds:       kinds of metrics
+        :returns:           dictionary with metrics, or None if not cached
+
+        """
+
+        conn = self._connect()
+        key = (fingerprint, commit, self._kinds(kinds))
+        row = conn.execute("SELECT metrics FROM metrics WHERE fingerprint=? "
+                            "AND commit_hash=? AND kinds=?", key).fetchone()
+        if row is None:
+            return None
+        self.used[key] = time.time()
+        if len(self.used) >= self.check_every:
+            self.flush()
+        return json.loads(row[0])
+
+    def put(self, fingerprint, commit, kinds, metrics):
+        """Store metrics in the cache.
+
+        :param fingerprint: fingerprint of the directory
+        :param commit:      hash of the commit
+        :param kinds:       kinds of metrics
+        :param metrics:     dictionary with metrics
+
+        """
+
+        conn = self._connect()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO metrics VALUES (?,?,?,?,?)",
+                        (fingerprint, commit, self._kinds(kinds),
+                        json.dumps(metrics), time.time()))
+        self.inserted += 1
+        if self.inserted % self.check_every == 1:
+            self.evict()
+
+    def flush(self):
+        """Write pending times of use of entries to the database.
+
+        """
+
+        if self.used:
+            conn = self._connect()
+            with conn:
+                conn.executemany("UPDATE metrics SET used=? WHERE "
+                                "fingerprint=? AND commit_hash=? AND kinds=?",
+                                [(used,) + key
+                                for (key, used) in self.used.items()])
+            self.used = {}
+
+    def evict(self):
+        """Evict least recently used entries, if the cache is too large.
+
+        Entries are evicted until the cache is 90% of its maximum size,
+        so that eviction is not needed again after every insertion.
+        Pending times of use are written first, so that entries
+        recently used are not evicted.
+
+        """
+
+        self.flush()
+        conn = self._connect()
+        (entries,) = conn.execute("SELECT COUNT(*) FROM metrics").fetchone()
+        if entries > self.max_entries:
+            to_evict = entries - (self.max_entries * 9) // 10
+            logging.info("MetricsCache: evicting %d entries" % to_evict)
+            with conn:
+                conn.execute("DELETE FROM metrics WHERE rowid IN "
+                            "(SELECT rowid FROM metrics ORDER BY used LIMIT ?)",
+                            (to_evict,))
+
+    def close(self):
+        """Write pending times of use, and close the connection.
+
+        """
+
+        self.flush()
+        super().close()
+
+
+class LinesCache(SQLiteStore):
+    """Cache of number of lines of files, keyed by their git blob hash.
+
+    Since the key is the hash of the content of the file, the number
+    of lines for a blob is valid for any directory or commit where the
+    blob appears, in any package or repository, and in any run.
+
+    Lines are kept in memory as well, so that each blob is read from
+    the database at most once. New entries are written to the database
+    when calling flush (or close).
+
+    The interface is that of a (partial) dictionary, so that objects
+    in this class can be used instead of a dictionary by BaseDir.
+
+    :param path: path of the SQLite file
+
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS lines (
+            blob BLOB PRIMARY KEY, lines INTEGER) WITHOUT ROWID;
+        """
+
+    def __init__(self, path):
+
+        super().__init__(path)
+        self.lines = {}
+        self.pending = {}
+
+    def __getstate__(self):
+        """Get state for pickling (pending entries are not pickled)
+
+        """
+
+        state = super().__getstate__()
+        state['pending'] = {}
+        return state
+
+    def get(self, blob, default=None):
+        """Get number of lines for a blob.
+
+        :param blob:    blob hash (hexadecimal string)
+        :param default: value to return if the blob is not in the cache
+        :returns:       number of lines
+
+        """
+
+        if blob in self.lines:
+            return self.lines[blob]
+        row = self._connect().execute("SELECT lines FROM lines WHERE blob=?",
+                                    (bytes.fromhex(blob),)).fetchone()
+        if row is None:
+            return default
+        self.lines[blob] = row[0]
+        return row[0]
+
+    def __setitem__(self, blob, lines):
+
+        self.lines[blob] = lines
+        self.pending[blob] = lines
+
+    def flush(self):
+        """Write new entries to the database.
+
+        """
+
+        if self.pending:
+            conn = self._connect()
+            with conn:
+                conn.executemany("INSERT OR IGNORE INTO lines VALUES (?,?)",
+                                [(bytes.fromhex(blob), lines)
+                                for (blob, lines) in self.pending.items()])
+            self.pending = {}
+
+    def close(self):
+        """Write new entries, and close the connection to the database.
+
+        """
+
+        self.flush()
+        super().close()
+
+
+class ResponseCache(SQLiteStore):
+    """Cache of results of HTTP requests for JSON documents, keyed by url.
+
+    The cache stores the 'result' in the JSON documents returned by
+    the Debian Snapshot API (see download.Downloader.get_json), or None
+    if the url was not found. Results for urls which never change
+    (those matching any of immutable) are kept forever. Other results
+    (for example, the list of versions of a package) expire after ttl
+    seconds. Results for urls not found expire too, since they may
+    be found later.
+
+    The cache may be used by several threads at the same time
+    (for example, those of a Downloader).
+
+    :param path: path of the SQLite file
+    :param ttl:  seconds to keep results for urls which may change
+
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS responses (
+            url TEXT PRIMARY KEY, result TEXT, expires REAL);
+        """
+    threads = True
+
+    # Patterns for urls with results that never change: information
+    # about a file (by hash), and files of a version of a package
+    immutable = [re.compile(r'/mr/file/[0-9a-f]+/info$'),
+                re.compile(r'/mr/package/[^/]+/[^/]+/srcfiles$')]
+
+    def __init__(self, path, ttl=86400):
+
+        super().__init__(path)
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        """Get state for pickling (locks can't be pickled)
+
+        """
+
+        state = super().__getstate__()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def expires(self, url, result):
+        """When the result for an url expires.
+
+        :param url:    url
+        :param result: result for the url (None if not found)
+        :returns:      time (seconds since the epoch), or None if never
+
+        """
+
+        if result is not None \
+                and any(pattern.search(url) for pattern in self.immutable):
+            return None
+        return time.time() + self.ttl
+
+    def get(self, url, expired=False):
+        """Get the result for an url from the cache.
+
+        :param url:     url
+        :param expired: return the result even if expired
+        :returns:       tuple (found, result), with found False if the
+                        result is not in the cache (or expired)
+
+        """
+
+        with self.lock:
+            row = self._connect().execute("SELECT result, expires "
+                                "FROM responses WHERE url=?", (url,)).fetchone()
+        if row is None:
+            return (False, None)
+        (result, expires) = row
+        if not expired and expires is not None and expires < time.time():
+            return (False, None)
+        return (True, json.loads(result))
+
+    def put(self, url, result):
+        """Store the result for an url in the cache.
+
+        :param url:    url
+        :param result: result for the url (None if not found)
+
+        """
+
+        with self.lock:
+            conn = self._connect()
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO responses VALUES (?,?,?)",
+                            (url, json.dumps(result),
+                            self.expires(url, result)))
+
+    def close(self):
+
+        with self.lock:
+            super().close()
+
+
+class SourcesCatalogue(SQLiteStore):
+    """Catalogue of source packages in Debian releases (from Sources.gz).
+
+    For each release, the catalogue stores the data for each package
+    in its Sources.gz file (see gitlag.parse_sources), indexed by name,
+    so that it is read (and downloaded) once for all packages in the
+    release. A release is loaded again when older than ttl seconds,
+    since Sources.gz files for releases change over time.
+
+    :param path: path of the SQLite file
+    :param ttl:  seconds to consider the data for a release as valid
+
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS releases (
+            release TEXT PRIMARY KEY, loaded REAL);
+        CREATE TABLE IF NOT EXISTS packages (
+            release TEXT, name TEXT, data TEXT,
+            PRIMARY KEY (release, name));
+        """
+
+    def __init__(self, path, ttl=86400):
+
+        super().__init__(path)
+        self.ttl = ttl
+
+    def expired(self, release):
+        """Check if the data for a release should be loaded (again).
+
+        :param release: Debian release (eg: testing/main)
+        :returns:       True if the release is not loaded, or is too old
+
+        """
+
+        row = self._connect().execute("SELECT loaded FROM releases "
+                                    "WHERE release=?", (release,)).fetchone()
+        return row is None or row[0] + self.ttl < time.time()
+
+    def load(self, release, packages):
+        """Load the data for the packages in a release.
+
+        Data previously loaded for the release is replaced. If there
+        are several entries for a package, the first one is kept.
+
+        :param release:  Debian release (eg: testing/main)
+        :param packages: iterator of tuples (name, data), with data
+                         as produced by gitlag.parse_sources
+        :returns:        number of packages loaded
+
+        """
+
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM packages WHERE release=?", (release,))
+            conn.executemany("INSERT OR IGNORE INTO packages VALUES (?,?,?)",
+                            ((release, name, json.dumps(data))
+                            for (name, data) in packages))
+            conn.execute("INSERT OR REPLACE INTO releases VALUES (?,?)",
+                        (release, time.time()))
+            (loaded,) = conn.execute("SELECT COUNT(*) FROM packages "
+                                    "WHERE release=?", (release,)).fetchone()
+        logging.info("SourcesCatalogue: %d packages for %s" % (loaded, release))
+        return loaded
+
+    def get(self, release, name):
+        """Get the data for a package in a release.
+
+        :param release: Debian release (eg: testing/main)
+        :param name:    name of the package
+        :returns:       data for the package, or None if not found
+
+        """
+
+        row = self._connect().execute("SELECT data FROM packages "
+                                    "WHERE release=? AND name=?",
+                                    (release, name)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2016 Bitergia
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+##
+## Authors:
+##   Jesus M. Gonzalez-Barahona <jgb@bitergia.com>
+##
+
+"""Engines for counting differences between two lists of lines.
+
+All engines produce the same kind of result: a tuple (different, added,
+removed, equal), with different being 1 if the lists are different
+(0 otherwise), and then the number of lines added, removed and equal
+from the left list to the right list.
+
+Engines:
+
+* 'counting': counts the lines difflib.Differ would produce, with the
+same algorithm, but only for counting: no output is produced, lines are
+hashed to integers, and similar (not identical) lines in replaced blocks
+are only searched for when those blocks have identical lines, since
+only then they may change the result. Results are the same as with
+'difflib' (for Differ as implemented in Python 3.11). This is the default.
+* 'difflib': uses difflib.Differ, and counts the lines in its output.
+This is the original implementation, but it is slow for large files,
+since Differ is quadratic, and it looks for intraline differences,
+which are not needed for counting lines.
+* 'histogram': a counting-only histogram diff (the algorithm used by
+git diff --histogram), on lines hashed to integers, with a Myers diff
+as fallback for regions with no infrequent common lines. It is the
+fastest engine, but the lines it finds equal are not always those
+difflib finds (it may find more, or less), so results are different
+for some files.
+* 'validate': uses 'counting' and 'difflib', and logs a warning if their
+results are different. The result of 'difflib' is returned.
+
+"""
+
+import collections
+import difflib
+import logging
+
+ENGINES = ['counting', 'difflib', 'histogram', 'validate']
+
+# Default engine
+DEFAULT_ENGINE = 'counting'
+
+# Lines appearing more than this in a region are not used as anchors
+# by the histogram diff (same limit as git)
+MAX_CHAIN_LENGTH = 64
+
+# Maximum edit distance explored by the Myers diff fallback. If it is
+# exceeded, no more equal lines are found in the region.
+MAX_MYERS_DISTANCE = 2000
+
+# Similarity for lines in replaced blocks to be considered close
+# by difflib.Differ (and initial best similarity when searching for them)
+CUTOFF = 0.75
+BEST_RATIO = 0.74
+
+
+def difflib_stat(left, right):
+    """Count differences between two lists of lines, using difflib.Differ
+
+    :param left:  left list of lines
+    :param right: right list of lines
+    :returns:     tuple (different, added, removed, equal)
+
+    """
+
+    added = 0
+    removed = 0
+    equal = 0
+    differ = difflib.Differ()
+    diff = differ.compare(left, right)
+    for line in diff:
+        if line.startswith('+'):
+            added += 1
+        elif line.startswith('-'):
+            removed += 1
+        elif line.startswith(' '):
+            equal += 1
+    if (added + removed) > 0:
+        different = 1
+    else:
+        different = 0
+    return (different, added, removed, equal)
+
+def _ratio_bound(counts_left, counts_right, length):
+    """Upper bound of the similarity of two lines (as SequenceMatcher.quick_ratio)
+
+    :param counts_left:  counts of characters in the left line (Counter)
+    :param counts_right: counts of characters in the right line (Counter)
+    :param length:       sum of the lengths of both lines
+    :returns:            upper bound of the similarity
+
+    """
+
+    return 2.0 * sum((counts_left & counts_right).values()) / length
+
+def _replaced_equal(left, right, a, b, alo, ahi, blo, bhi, ratios):
+    """Count the lines difflib.Differ finds equal in a replaced block.
+
+    Differ looks for the closest pair of similar (not identical) lines in
+    the block, as a synch point, and then for the closest pairs in the
+    lines before and after it. Only if there are no similar lines, it
+    synchs on the first pair of identical lines, which is found equal.
+    Regions are processed as Differ does (with the same tie breaking:
+    the first pair with the highest similarity, with j in the outer
+    loop), but similarities are only computed for regions with identical
+    lines, since in other regions no line will be found equal, and they
+    are computed only once for each pair of lines (and stored in ratios,
+    with their upper bound), while Differ computes them again for each
+    region.
+
+    :param left:   left list of lines
+    :param right:  right list of lines
+    :param a:      left list of lines, hashed to integers
+    :param b:      right list of lines, hashed to integers
+    :param ratios: dictionary with lists [upper bound, similarity or None],
+                   by pair of hashes
+    :returns:      number of equal lines
+
+    """
+
+    equal = 0
+    cruncher = difflib.SequenceMatcher(None)
+    counts = {}
+    regions = [(alo, ahi, blo, bhi)]
+    while regions:
+        (alo, ahi, blo, bhi) = regions.pop()
+        if alo == ahi or blo == bhi or set(a[alo:ahi]).isdisjoint(b[blo:bhi]):
+            continue
+        best_ratio = BEST_RATIO
+        identical = None
+        for j in range(blo, bhi):
+            line_right = right[j]
+            length_right = len(line_right)
+            for i in range(alo, ahi):
+                if a[i] == b[j]:
+                    if identical is None:
+                        identical = (i, j)
+                    continue
+                length = len(left[i]) + length_right
+                # Same bounds as in Differ: real_quick_ratio, quick_ratio
+                if 2.0 * min(len(left[i]), length_right) / length <= best_ratio:
+                    continue
+                pair = ratios.get((a[i], b[j]))
+                if pair is None:
+                    for (id, line) in [(a[i], left[i]), (b[j], line_right)]:
+                        if id not in counts:
+                            counts[id] = collections.Counter(line)
+                    pair = [_ratio_bound(counts[a[i]], counts[b[j]], length),
+                            None]
+                    ratios[(a[i], b[j])] = pair
+                if pair[0] <= best_ratio:
+                    continue
+                if pair[1] is None:
+                    cruncher.set_seqs(left[i], line_right)
+                    pair[1] = cruncher.ratio()
+                if pair[1] > best_ratio:
+                    (best_ratio, best) = (pair[1], (i, j))
+        if best_ratio < CUTOFF:
+            if identical is None:
+                continue
+            best = identical
+            equal += 1
+        (best_i, best_j) = best
+        regions.append((best_i + 1, ahi, best_j + 1, bhi))
+        regions.append((alo, best_i, blo, best_j))
+    return equal
+
+def counting_stat(left, right):
+    """Count differences between two lists of lines, as difflib.Differ
+
+    Lines are hashed to integers, and matched with difflib.SequenceMatcher,
+    as Differ does. Equal lines in replaced blocks are found as Differ
+    does, too (see _replaced_equal). Lines removed and added are the
+    rest of lines in left and right.
+
+    :param left:  left list of lines
+    :param right: right list of lines
+    :returns:     tuple (different, added, removed, equal)
+
+    """
+
+    ids = {}
+    a = [ids.setdefault(line, len(ids)) for line in left]
+    b = [ids.setdefault(line, len(ids)) for line in right]
+    equal = 0
+    ratios = {}
+    matcher = difflib.SequenceMatcher(None, a, b)
+    for (tag, alo, ahi, blo, bhi) in matcher.get_opcodes():
+        if tag == 'equal':
+            equal += ahi - alo
+        elif tag == 'replace':
+            equal += _replaced_equal(left, right, a, b, alo, ahi, blo, bhi,
+                                    ratios)
+    added = len(b) - equal
+    removed = len(a) - equal
+    if (added + removed) > 0:
+        different = 1
+    else:
+        different = 0
+    return (different, added, removed, equal)
+
+def _myers_distance(a, alo, ahi, b, blo, bhi, max_d):
+    """Edit distance between two regions, using the Myers algorithm.
+
+    :returns: edit distance (number of lines added plus removed),
+              or None if larger than max_d
+
+    """
+
+    n = ahi - alo
+    m = bhi - blo
+    max_d = min(max_d, n + m)
+    offset = max_d + 1
+    v = [0] * (2 * max_d + 3)
+    for d in range(max_d + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset+k-1] < v[offset+k+1]):
+                x = v[offset+k+1]
+            else:
+                x = v[offset+k-1] + 1
+            y = x - k
+            while x < n and y < m and a[alo+x] == b[blo+y]:
+                x += 1
+                y += 1
+            v[offset+k] = x
+            if x >= n and y >= m:
+                return d
+    return None
+
+def _find_region(a, alo, ahi, b, blo, bhi):
+    """Find the longest region of common lines with the least frequent line.
+
+    This is the core of the histogram diff: lines in the left region
+    are indexed, and for each line in the right region appearing in the
+    left one no more than MAX_CHAIN_LENGTH times, the region of
+    common lines around it is found. The region with lines appearing
+    less times in the left region is chosen, or the longest one if
+    there are several of them.
+
+    :returns: tuple (begin_left, end_left, begin_right, end_right),
+              or None if no region was found, and a boolean which is
+              True if there are common lines in both regions
+
+    """
+
+    occurrences = {}
+    for i in range(alo, ahi):
+        occurrences.setdefault(a[i], []).append(i)
+    best = None
+    best_count = MAX_CHAIN_LENGTH + 1
+    has_common = False
+    j = blo
+    while j < bhi:
+        next_j = j + 1
+        positions = occurrences.get(b[j])
+        if positions is not None:
+            has_common = True
+            if len(positions) <= best_count:
+                for i in positions:
+                    (as_, bs, ae, be) = (i, j, i + 1, j + 1)
+                    count = len(positions)
+                    while as_ > alo and bs > blo and a[as_-1] == b[bs-1]:
+                        as_ -= 1
+                        bs -= 1
+                        if count > 1:
+                            count = min(count, len(occurrences[a[as_]]))
+                    while ae < ahi and be < bhi and a[ae] == b[be]:
+                        if count > 1:
+                            count = min(count, len(occurrences[a[ae]]))
+                        ae += 1
+                        be += 1
+                    if next_j < be:
+                        next_j = be
+                    if best is None or (best[1] - best[0] < ae - as_) \
+                            or count < best_count:
+                        best = (as_, ae, bs, be)
+                        best_count = count
+        j = next_j
+    return (best, has_common)
+
+def histogram_stat(left, right):
+    """Count differences between two lists of lines, using a histogram diff
+
+    Lines are hashed to integers, and then common prefixes and suffixes
+    are removed, and regions are split recursively by the region of
+    common lines found by _find_region, until no common lines are left.
+    Regions with common lines, but no region found, are compared with
+    a Myers diff. Only the number of equal lines is computed: lines
+    removed and added are the rest of lines in left and right.
+
+    :param left:  left list of lines
+    :param right: right list of lines
+    :returns:     tuple (different, added, removed, equal)
+
+    """
+
+    ids = {}
+    a = [ids.setdefault(line, len(ids)) for line in left]
+    b = [ids.setdefault(line, len(ids)) for line in right]
+    equal = 0
+    regions = [(0, len(a), 0, len(b))]
+    while regions:
+        (alo, ahi, blo, bhi) = regions.pop()
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            alo += 1
+            blo += 1
+            equal += 1
+        while alo < ahi and blo < bhi and a[ahi-1] == b[bhi-1]:
+            ahi -= 1
+            bhi -= 1
+            equal += 1
+        if alo == ahi or blo == bhi:
+            continue
+        (region, has_common) = _find_region(a, alo, ahi, b, blo, bhi)
+        if region is not None:
+            (as_, ae, bs, be) = region
+            equal += ae - as_
+            regions.append((alo, as_, blo, bs))
+            regions.append((ae, ahi, be, bhi))
+        elif has_common:
+            distance = _myers_distance(a, alo, ahi, b, blo, bhi,
+                                        MAX_MYERS_DISTANCE)
+            if distance is not None:
+                equal += ((ahi - alo) + (bhi - blo) - distance) // 2
+    added = len(b) - equal
+    removed = len(a) - equal
+    if (added + removed) > 0:
+        different = 1
+    else:
+        different = 0
+    return (different, added, removed, equal)
+
+def validate_stat(left, right):
+    """Count differences with 'difflib' and 'counting', checking they match.
+
+    If results are different, a warning is logged.
+
+    :param left:  left list of lines
+    :param right: right list of lines
+    :returns:     tuple (different, added, removed, equal), from 'difflib'
+
+    """
+
+    expected = difflib_stat(left, right)
+    result = counting_stat(left, right)
+    if result != expected:
+        logging.warning("diffstat mismatch: difflib %s, counting %s"
+                        % (str(expected), str(result)))
+    return expected
+
+def diff_stat(left, right, engine=DEFAULT_ENGINE):
+    """Count differences between two lists of lines.
+
+    :param left:   left list of lines
+    :param right:  right list of lines
+    :param engine: engine to use (see ENGINES)
+    :returns:      tuple (different, added, removed, equal)
+
+    """
+
+    if engine == 'counting':
+        return counting_stat(left, right)
+    elif engine == 'histogram':
+        return histogram_stat(left, right)
+    elif engine == 'difflib':
+        return difflib_stat(left, right)
+    elif engine == 'validate':
+        return validate_stat(left, right)
+    raise ValueError("Unknown diffstat engine", engine)
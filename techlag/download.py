@@ -0,0 +1,513 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2016 Bitergia
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+##
+## Authors:
+##   Jesus M. Gonzalez-Barahona <jgb@bitergia.com>
+##
+
+
+"""Concurrent downloads over persistent HTTP connections.
+
+A Downloader keeps a pool of keep-alive connections for each host,
+so that requests to the same host (for example, the many requests for
+metadata to snapshot.debian.org needed for a package) don't pay the
+cost of opening a new connection each time. The number of connections
+(and therefore, of concurrent requests) to each host is limited.
+Requests can be run concurrently, by a bounded pool of threads
+(see Downloader.map). Files are streamed to disk, in chunks.
+
+Results of requests for JSON documents may be kept in a persistent
+cache (see cache.ResponseCache). In offline mode, they are only
+read from the cache, and no request is sent to the network.
+
+Downloaded files may be kept in an ObjectStore, by their SHA1 hash,
+so that each file is downloaded (and stored) only once, even if it is
+a component of several packages or versions of packages.
+
+"""
+
+import concurrent.futures
+import hashlib
+import http.client
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import urllib.error
+import urllib.parse
+
+from . import profiling
+
+# Status codes for redirections, followed by Downloader
+REDIRECTS = [301, 302, 303, 307, 308]
+# Size of chunks for reading files to hash them
+CHUNK_SIZE = 65536
+
+
+def file_hash(path):
+    """SHA1 hash of the content of a file.
+
+    :param path: path of the file
+    :returns:    hash (hexadecimal string)
+
+    """
+
+    sha = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class _HostPool:
+    """Pool of connections to a host.
+
+    :param scheme:   scheme ('http' or 'https')
+    :param host:     host (and port, if any)
+    :param limit:    maximum number of connections to the host
+    :param timeout:  timeout for connections, in seconds
+
+    """
+
+    def __init__(self, scheme, host, limit, timeout):
+
+        self.scheme = scheme
+        self.host = host
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(limit)
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def acquire(self):
+        """Get a connection to the host, waiting until the limit allows it.
+
+        :returns: tuple (connection, reused), with reused True if
+                  the connection was used before
+
+        """
+
+        self.slots.acquire()
+        with self.lock:
+            if self.idle:
+                return (self.idle.pop(), True)
+        if self.scheme == 'https':
+            conn = http.client.HTTPSConnection(self.host, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(self.host, timeout=self.timeout)
+        return (conn, False)
+
+    def release(self, conn, keep=True):
+        """Return a connection to the pool.
+
+        :param conn: connection
+        :param keep: keep the connection for reusing it (otherwise, close it)
+
+        """
+
+        if keep:
+            with self.lock:
+                self.idle.append(conn)
+        else:
+            conn.close()
+        self.slots.release()
+
+    def close(self):
+        """Close all idle connections.
+
+        """
+
+        with self.lock:
+            for conn in self.idle:
+                conn.close()
+            self.idle = []
+
+
+class Downloader:
+    """Downloader of HTTP resources, with pooled persistent connections.
+
+    Errors (status codes other than 200) are raised as
+    urllib.error.HTTPError, as urllib.request.urlopen does, so that
+    callers can handle them in the same way. In offline mode, any
+    request to the network raises urllib.error.URLError.
+
+    :param workers:    number of threads for concurrent requests (see map)
+    :param per_host:   maximum number of connections to each host
+    :param timeout:    timeout for connections, in seconds
+    :param chunk_size: size of chunks for streaming files to disk
+    :param cache:      cache.ResponseCache for results of get_json
+    :param offline:    offline mode (only results in cache are available)
+
+    """
+
+    # Maximum number of redirections followed for a request
+    max_redirects = 5
+
+    def __init__(self, workers=8, per_host=4, timeout=60, chunk_size=65536,
+                cache=None, offline=False):
+
+        self.workers = workers
+        self.per_host = per_host
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.cache = cache
+        self.offline = offline
+        self.lock = threading.Lock()
+        self.pools = {}
+        self.executor = None
+
+    def __getstate__(self):
+        """Get state for pickling (connections and threads are not pickled)
+
+        """
+
+        state = self.__dict__.copy()
+        state['lock'] = None
+        state['pools'] = {}
+        state['executor'] = None
+        return state
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def _pool(self, scheme, host):
+        """Get the pool of connections for a host.
+
+        """
+
+        with self.lock:
+            if (scheme, host) not in self.pools:
+                self.pools[(scheme, host)] = _HostPool(scheme, host,
+                                                    self.per_host, self.timeout)
+            return self.pools[(scheme, host)]
+
+    @staticmethod
+    def _send(pool, path):
+        """Send a request to a host, with a connection from its pool.
+
+        If a reused connection was closed by the server (which may
+        happen at any time with persistent connections), the request
+        is sent again with other connection.
+
+        :param pool: pool of connections for the host
+        :param path: path (and query) to request
+        :returns:    tuple (connection, response)
+
+        """
+
+        while True:
+            (conn, reused) = pool.acquire()
+            try:
+                conn.request('GET', path)
+                return (conn, conn.getresponse())
+            except (http.client.RemoteDisconnected, ConnectionError):
+                pool.release(conn, keep=False)
+                if not reused:
+                    raise
+            except Exception:
+                pool.release(conn, keep=False)
+                raise
+
+    def _request(self, url, consume):
+        """Request an url, and consume the response.
+
+        The connection is returned to the pool for the host after
+        consuming the response (or closed, if it can't be reused).
+        Redirections are followed.
+
+        :param url:     url to request
+        :param consume: function to call with the response (status 200)
+        :returns:       result of consume
+
+        """
+
+        if self.offline:
+            raise urllib.error.URLError("Offline mode, not requesting " + url)
+        for redirect in range(self.max_redirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            pool = self._pool(parts.scheme, parts.netloc)
+            with profiling.phase('download.request'):
+                (conn, response) = self._send(pool, path)
+                keep = False
+                try:
+                    if response.status == 200:
+                        result = consume(response)
+                    else:
+                        response.read()
+                    keep = not response.will_close
+                finally:
+                    pool.release(conn, keep=keep)
+            if response.status == 200:
+                return result
+            elif response.status in REDIRECTS \
+                    and response.getheader('Location'):
+                url = urllib.parse.urljoin(url, response.getheader('Location'))
+                logging.debug("Redirected to: " + url)
+            else:
+                raise urllib.error.HTTPError(url, response.status,
+                                            response.reason,
+                                            response.msg, None)
+        raise urllib.error.HTTPError(url, response.status,
+                                    'Too many redirections', response.msg, None)
+
+    def get(self, url):
+        """Get the content of an url.
+
+        :param url: url to get
+        :returns:   content (bytes)
+
+        """
+
+        logging.debug("Downloader.get: " + url)
+        content = self._request(url, lambda response: response.read())
+        profiling.count('download.bytes', len(content))
+        return content
+
+    def get_json(self, url):
+        """Get the 'result' in a JSON document (as in snapshot.debian.org API).
+
+        If there is a cache, the result is read from it, if available.
+        Otherwise, it is stored in it after requesting it. In offline
+        mode, expired results in the cache are used too.
+
+        :param url: url of the JSON document
+        :returns:   value for 'result', or None if the url was not found (404)
+
+        """
+
+        if self.cache is not None:
+            (found, result) = self.cache.get(url, expired=self.offline)
+            if found:
+                logging.debug("Downloader.get_json, from cache: " + url)
+                profiling.count('http_cache.hits')
+                return result
+            profiling.count('http_cache.misses')
+        try:
+            response = self.get(url)
+            result = json.loads(response.decode('utf-8'))['result']
+        except urllib.error.HTTPError as error:
+            if error.code == 404:
+                result = None
+            else:
+                raise
+        if self.cache is not None:
+            self.cache.put(url, result)
+        return result
+
+    def download(self, url, path, sha1=None):
+        """Download an url to a file, streaming it to disk.
+
+        The content is written to a temporary file (unique, so that
+        several downloads to the same path don't collide), which is
+        renamed when complete, so that no partial file is left as path.
+        If sha1 is specified, the content is verified before renaming.
+
+        :param url:  url to download
+        :param path: path of the file to write
+        :param sha1: expected SHA1 hash of the content (default None)
+        :returns:    path
+
+        """
+
+        def consume(response):
+            sha = hashlib.sha1()
+            with open(tmp_path, 'wb') as file:
+                while True:
+                    chunk = response.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    sha.update(chunk)
+                    file.write(chunk)
+                    profiling.count('download.bytes', len(chunk))
+            return sha.hexdigest()
+
+        logging.debug("Downloader.download: " + url)
+        (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                prefix=os.path.basename(path) + '.',
+                                suffix='.part')
+        os.close(fd)
+        try:
+            hash = self._request(url, consume)
+            if sha1 is not None and hash != sha1:
+                raise ValueError("Hash mismatch for download", url, hash, sha1)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        os.replace(tmp_path, path)
+        return path
+
+    def map(self, fn, *iterables):
+        """Run a function for several arguments, concurrently.
+
+        Calls are run by the pool of threads of the downloader (with
+        self.workers threads), so that several requests may be in
+        flight at the same time (limited by self.per_host for each host).
+
+        :param fn:        function to run (usually, a method of this object)
+        :param iterables: iterables with arguments for fn (as in map)
+        :returns:         list of results, in the order of arguments
+
+        """
+
+        with self.lock:
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(
+                                                max_workers=self.workers)
+        return list(self.executor.map(fn, *iterables))
+
+    def close(self):
+        """Close all idle connections, stop the pool of threads,
+        and close the cache (if any).
+
+        """
+
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+            for pool in self.pools.values():
+                pool.close()
+            self.pools = {}
+        if self.cache is not None:
+            self.cache.close()
+
+
+class ObjectStore:
+    """Store of files, by the SHA1 hash of their content.
+
+    Each file (object) is stored once, in a path derived from its hash
+    (see path), no matter how many packages or versions of packages
+    it is a component of. Objects are verified when downloaded, and
+    written atomically (see Downloader.download). Objects already in
+    the store are verified again when fetched (see verify), so that
+    an object corrupted later is downloaded again, instead of reused.
+
+    Files are made available with their names (for example, in the
+    directory where a package is extracted) as links to objects (see link).
+
+    :param root: root directory of the store
+
+    """
+
+    def __init__(self, root):
+
+        self.root = root
+
+    def path(self, hash):
+        """Path of the object for a hash.
+
+        :param hash: SHA1 hash (hexadecimal string)
+        :returns:    path
+
+        """
+
+        return os.path.join(self.root, hash[:2], hash[2:])
+
+    def has(self, hash):
+        """Check if the object for a hash is in the store.
+
+        :param hash: SHA1 hash (hexadecimal string)
+        :returns:    True if in the store
+
+        """
+
+        return os.path.isfile(self.path(hash))
+
+    def verify(self, hash):
+        """Verify the object for a hash, removing it if not correct.
+
+        :param hash: SHA1 hash (hexadecimal string)
+        :returns:    True if the object is in the store, and correct
+
+        """
+
+        if not self.has(hash):
+            return False
+        if file_hash(self.path(hash)) != hash:
+            logging.warning("ObjectStore: removing corrupted object " + hash)
+            os.remove(self.path(hash))
+            return False
+        return True
+
+    def fetch(self, downloader, url, hash):
+        """Download an object, if not in the store (and correct).
+
+        :param downloader: Downloader to use
+        :param url:        url to download the object
+        :param hash:       SHA1 hash (hexadecimal string)
+        :returns:          path of the object
+
+        """
+
+        path = self.path(hash)
+        if not self.verify(hash):
+            profiling.count('objects.misses')
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            downloader.download(url, path, sha1=hash)
+            logging.info('Downloaded to store: ' + url)
+        else:
+            profiling.count('objects.hits')
+            logging.info('Already in store, not downloading: ' + url)
+        return path
+
+    def link(self, hash, path):
+        """Make an object available as a file, with a name.
+
+        The file is a hard link to the object (or a copy of it, if hard
+        links are not possible). If the file already exists, it is replaced.
+
+        :param hash: SHA1 hash (hexadecimal string)
+        :param path: path of the file
+        :returns:    path
+
+        """
+
+        # Temporary name specific to the process and thread, in case several
+        # of them link the same file (for example, an orig tarball of two
+        # versions, or of two packages processed at the same time)
+        tmp_path = '{}.{}.{}.link'.format(path, os.getpid(),
+                                        threading.get_ident())
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        try:
+            os.link(self.path(hash), tmp_path)
+        except OSError:
+            shutil.copyfile(self.path(hash), tmp_path)
+        os.replace(tmp_path, path)
+        return path
+
+
+# Downloader used when none is specified (see get_downloader)
+_downloader = None
+
+def get_downloader():
+    """Get the default downloader, creating it if needed.
+
+    """
+
+    global _downloader
+    if _downloader is None:
+        _downloader = Downloader()
+    return _downloader
@@ -0,0 +1,638 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2016 Bitergia
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+##
+## Authors:
+##   Jesus M. Gonzalez-Barahona <jgb@bitergia.com>
+##
+
+
+"""Reading Debian source packages, without extracting them.
+
+Comparing a Debian source package with the commits of its upstream
+repository only needs its manifest (paths, blob hashes and number of
+lines of its files, see gitlag.Manifest), and the contents of files
+found to be different. read_dpkg produces both in a single pass over
+the archives of the package (orig tarballs, and debian tarball or
+diff), with no tree written to disk: the manifest is saved to its
+file (see gitlag.manifest_path), and contents of files to a pack of
+blobs (see gitlag.BlobPack), which is used by gitlag.BaseDir.
+
+The tree is the same dpkg-source --extract would produce, including
+patches applied (for the '3.0 (quilt)' format, with the .pc directory
+quilt and dpkg-source maintain). Patches are applied as dpkg-source
+does (with no fuzz), and if anything is found that can't be reproduced
+exactly (for example, a patch not applying cleanly, renames in git
+patches, or symbolic links to directories), UnsupportedPackage is raised,
+and read_dpkg falls back to extracting the package with dpkg-source.
+
+"""
+
+import gzip
+import logging
+import os
+import posixpath
+import re
+import shutil
+import tarfile
+
+from . import profiling
+from .gitlag import IGNORED_NAMES, MAX_SYMLINKS, BlobPackWriter, Manifest, \
+    count_lines, extract_dpkg, manifest_path, pack_path
+
+# Compressions of tarballs supported
+COMPRESSIONS = r'(gz|bz2|xz)'
+
+
+class UnsupportedPackage(ValueError):
+    """Package that can't be read without extracting it with dpkg-source.
+
+    """
+
+
+def parse_dsc(dsc):
+    """Parse a .dsc file, getting its format and the files of the package.
+
+    :param dsc: path of the .dsc file
+    :returns:   dictionary with 'format' and 'files' (list of names)
+
+    """
+
+    data = {'format': '1.0', 'files': []}
+    files_found = False
+    with open(dsc, encoding='utf-8', errors='surrogateescape') as file:
+        for line in file:
+            if line.startswith('-----BEGIN PGP SIGNATURE'):
+                break
+            if files_found:
+                if line.startswith(' '):
+                    data['files'].append(line.split()[2])
+                    continue
+                files_found = False
+            if line.startswith('Format:'):
+                data['format'] = line.split(':', 1)[1].strip()
+            elif line.startswith('Files:'):
+                files_found = True
+    return data
+
+
+class FilePatch:
+    """Patch for a file, from a unified diff.
+
+    :param old:   old name (None for /dev/null)
+    :param new:   new name (None for /dev/null)
+    :param hunks: list of tuples (old start, old lines, new lines,
+                  lines of context before and after changes)
+
+    """
+
+    def __init__(self, old, new, hunks):
+
+        self.old = old
+        self.new = new
+        self.hunks = hunks
+
+
+def _split_lines(data):
+    """Split content in lines, keeping b'\\n' at the end of each line.
+
+    """
+
+    lines = data.split(b'\n')
+    last = lines.pop()
+    lines = [line + b'\n' for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+def _patch_name(name):
+    """Name of a file in the header of a unified diff (--- or +++ lines).
+
+    :returns: name, or None for /dev/null
+
+    """
+
+    name = name.rstrip(b'\r\n').split(b'\t')[0]
+    match = re.match(rb'^(.*?) +\d{4}-\d\d-\d\d \d\d:\d\d:\d\d(\.\d+)?'
+                    rb'( [+-]\d{4})?$', name)
+    if match:
+        name = match.group(1)
+    name = name.rstrip(b' ')
+    if name.startswith(b'"'):
+        raise UnsupportedPackage("Quoted name in patch", name)
+    if name == b'/dev/null':
+        return None
+    return os.fsdecode(name)
+
+def _no_newline(line, old_lines, new_lines):
+    """Remove the newline from the last old and new lines of a hunk,
+    for a line followed by a marker of no newline at end of file.
+
+    """
+
+    if line.startswith((b' ', b'-')):
+        old_lines[-1] = old_lines[-1].rstrip(b'\n')
+    if line.startswith((b' ', b'+')):
+        new_lines[-1] = new_lines[-1].rstrip(b'\n')
+
+# Lines in extended headers of git diffs
+GIT_HEADERS = (b'old mode ', b'new mode ', b'deleted file mode ',
+                b'new file mode ', b'index ', b'similarity index ',
+                b'dissimilarity index ')
+
+def parse_patch(data):
+    """Parse a patch (unified diff) in the format GNU patch accepts.
+
+    Lines not part of the diffs (for example, headers of patches
+    in DEP-3 format) are ignored.
+
+    :param data: content of the patch (bytes)
+    :returns:    list of FilePatch
+
+    """
+
+    lines = _split_lines(data)
+    patches = []
+    no = 0
+    while no < len(lines):
+        line = lines[no]
+        if line.startswith((b'rename from ', b'copy from ', b'GIT binary patch',
+                            b'Binary files ')) \
+                or (line.startswith(b'*** ') and no + 1 < len(lines)
+                    and lines[no+1].startswith(b'--- ')):
+            raise UnsupportedPackage("Patch format not supported", line)
+        if line.startswith(b'diff --git '):
+            header = no + 1
+            while header < len(lines) and lines[header].startswith(GIT_HEADERS):
+                header += 1
+            if not (header < len(lines) and lines[header].startswith(b'--- ')) \
+                    and any(lines[header_no].startswith((b'new file mode ',
+                                                        b'deleted file mode '))
+                            for header_no in range(no + 1, header)):
+                raise UnsupportedPackage("Git patch for empty file", line)
+        if not (line.startswith(b'--- ') and no + 1 < len(lines)
+                and lines[no+1].startswith(b'+++ ')):
+            no += 1
+            continue
+        old = _patch_name(line[4:])
+        new = _patch_name(lines[no+1][4:])
+        no += 2
+        hunks = []
+        while no < len(lines):
+            match = re.match(rb'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@',
+                            lines[no])
+            if not match:
+                break
+            old_count = int(match.group(2) or b'1')
+            new_count = int(match.group(4) or b'1')
+            (old_lines, new_lines) = ([], [])
+            # Lines of context before the first change, and after the last one
+            (prefix, suffix) = (None, 0)
+            no += 1
+            while (len(old_lines) < old_count or len(new_lines) < new_count) \
+                    and no < len(lines):
+                line = lines[no]
+                if line in (b'\n', b'\r\n'):
+                    line = b' ' + line
+                if line.startswith(b'\\'):
+                    _no_newline(lines[no-1], old_lines, new_lines)
+                elif line.startswith(b' '):
+                    old_lines.append(line[1:])
+                    new_lines.append(line[1:])
+                    suffix += 1
+                elif line.startswith((b'-', b'+')):
+                    if line.startswith(b'-'):
+                        old_lines.append(line[1:])
+                    else:
+                        new_lines.append(line[1:])
+                    if prefix is None:
+                        prefix = suffix
+                    suffix = 0
+                else:
+                    raise UnsupportedPackage("Malformed hunk in patch", line)
+                no += 1
+            if len(old_lines) != old_count or len(new_lines) != new_count:
+                raise UnsupportedPackage("Truncated hunk in patch")
+            # Marker for no newline at end of file, after the hunk
+            while no < len(lines) and lines[no].startswith(b'\\'):
+                _no_newline(lines[no-1], old_lines, new_lines)
+                no += 1
+            if prefix is None:
+                (prefix, suffix) = (suffix, suffix)
+            hunks.append((int(match.group(1)), old_lines, new_lines,
+                            prefix, suffix))
+        patches.append(FilePatch(old, new, hunks))
+    return patches
+
+def apply_hunks(data, hunks):
+    """Apply the hunks of a patch to some content, as GNU patch -F 0 does.
+
+    Each hunk is applied where its old lines match exactly, looking
+    first at the position in the hunk (adjusted by the offset found
+    for previous hunks), and then at positions further away from it.
+    As GNU patch does, a hunk with less context before its changes than
+    after them can only be applied at the start of the content, and
+    one with less context after them, at the end.
+
+    :param data:  content (bytes)
+    :param hunks: hunks (see FilePatch)
+    :returns:     patched content (bytes)
+
+    """
+
+    lines = _split_lines(data)
+    offset = 0
+    # First line that can be changed by the next hunk
+    frozen = 0
+    for (start, old_lines, new_lines, prefix, suffix) in hunks:
+        base = start if len(old_lines) == 0 else start - 1
+        expected = base + offset
+        last = len(lines) - len(old_lines)
+        if prefix < suffix:
+            positions = [0]
+        elif suffix < prefix:
+            positions = [last]
+        else:
+            positions = (position for distance
+                            in range(max(expected - frozen, last - expected, 0) + 1)
+                            for position in (expected - distance,
+                                            expected + distance))
+        found = None
+        for position in positions:
+            if frozen <= position <= last \
+                    and lines[position:position+len(old_lines)] == old_lines:
+                found = position
+                break
+        if found is None:
+            raise UnsupportedPackage("Hunk does not apply", start)
+        lines[found:found+len(old_lines)] = new_lines
+        offset = found - base + len(new_lines) - len(old_lines)
+        frozen = found + len(new_lines)
+    return b''.join(lines)
+
+
+class SourceTree:
+    """Tree of files of a source package, as dpkg-source would extract it.
+
+    Entries are kept by path (relative to the root of the tree), as
+    tuples: ('file', size, blob hash, lines), ('dir',), or ('symlink', target).
+    Contents of files are added to a pack of blobs (see gitlag.BlobPackWriter).
+
+    :param pack: BlobPackWriter for contents of files
+
+    """
+
+    def __init__(self, pack):
+
+        self.pack = pack
+        self.entries = {}
+
+    def add_file(self, path, data):
+        """Add a file (or replace it), with its parent directories.
+
+        """
+
+        self._add_parents(path)
+        self.entries[path] = ('file', len(data), self.pack.add(data),
+                                count_lines(data))
+
+    def _add_parents(self, path):
+
+        parent = posixpath.dirname(path)
+        while parent and parent not in self.entries:
+            self.entries[parent] = ('dir',)
+            parent = posixpath.dirname(parent)
+        if parent and self.entries[parent][0] != 'dir':
+            raise UnsupportedPackage("Parent is not a directory", path)
+
+    def remove(self, path):
+        """Remove an entry (and its subentries, if a directory).
+
+        """
+
+        for name in [name for name in self.entries
+                        if name == path or name.startswith(path + '/')]:
+            del self.entries[name]
+
+    def read(self, path):
+        """Read the content of a file in the tree.
+
+        """
+
+        return self.pack.read(self.entries[path][2])
+
+    def add_tar(self, path, prefix='', strip=True):
+        """Add the entries in a tarball to the tree.
+
+        If strip is True, entries are extracted as dpkg-source does for
+        orig tarballs: if the tarball has a single top directory, its
+        contents are placed in prefix, otherwise the whole tarball is.
+        Entries previously in prefix are removed. If strip is False,
+        entries are added in prefix, over existing entries.
+
+        :param path:   path of the tarball
+        :param prefix: directory where the tarball is extracted ('' for root)
+        :param strip:  extract as orig tarballs (see above)
+
+        """
+
+        entries = {}
+        with tarfile.open(path, 'r|*') as tar:
+            for member in tar:
+                name = posixpath.normpath(member.name)
+                if name == '.':
+                    continue
+                if name.startswith(('/', '../')) or name == '..':
+                    raise UnsupportedPackage("Unsafe path in tarball", name)
+                if member.isdir():
+                    entries[name] = ('dir',)
+                elif member.isfile():
+                    data = tar.extractfile(member).read()
+                    entries[name] = ('file', len(data), self.pack.add(data),
+                                    count_lines(data))
+                elif member.issym():
+                    entries[name] = ('symlink', member.linkname)
+                elif member.islnk():
+                    target = posixpath.normpath(member.linkname)
+                    if target not in entries or entries[target][0] != 'file':
+                        raise UnsupportedPackage("Hard link not supported", name)
+                    entries[name] = entries[target]
+                else:
+                    raise UnsupportedPackage("Entry type not supported", name)
+        if strip:
+            tops = set(name.split('/')[0] for name in entries)
+            if len(tops) == 1 and entries.get(list(tops)[0], ('dir',))[0] == 'dir':
+                top = list(tops)[0]
+                entries = {name[len(top)+1:]: entry
+                            for (name, entry) in entries.items() if name != top}
+            if prefix:
+                self.remove(prefix)
+        for (name, entry) in sorted(entries.items()):
+            name = posixpath.join(prefix, name) if prefix else name
+            self._add_parents(name)
+            if name in self.entries and self.entries[name][0] == 'dir' \
+                    and entry[0] == 'dir':
+                continue
+            self.remove(name)
+            self.entries[name] = entry
+        if prefix:
+            self._add_parents(prefix + '/')
+
+    def apply_patch(self, patch, strip=1, backup=None):
+        """Apply a patch, as dpkg-source does (with GNU patch).
+
+        :param patch:  content of the patch (bytes)
+        :param strip:  number of leading components to strip from names
+        :param backup: directory for backups of files before patching
+                       (as patch -B), and remove files which are empty
+                       after patching (as patch -E). Default None,
+                       no backups, and no removal of empty files.
+
+        """
+
+        backed_up = set()
+        for file_patch in parse_patch(patch):
+            names = []
+            for name in [file_patch.old, file_patch.new]:
+                if name is not None:
+                    parts = name.split('/')
+                    if len(parts) <= strip:
+                        raise UnsupportedPackage("Can't strip name in patch",
+                                                name)
+                    names.append(posixpath.normpath('/'.join(parts[strip:])))
+                else:
+                    names.append(None)
+            (old, new) = names
+            if old is not None and old in self.entries:
+                path = old
+            elif new is not None and new in self.entries:
+                path = new
+            elif new is not None and all(len(hunk[1]) == 0
+                                        for hunk in file_patch.hunks):
+                path = new
+            else:
+                raise UnsupportedPackage("File to patch not found", old, new)
+            if path.startswith('../') or path == '..':
+                raise UnsupportedPackage("Unsafe path in patch", path)
+            entry = self.entries.get(path)
+            if entry is not None and file_patch.old is None:
+                raise UnsupportedPackage("File to create already exists", path)
+            if entry is not None and entry[0] != 'file':
+                raise UnsupportedPackage("Patching something not a file", path)
+            data = self.read(path) if entry is not None else b''
+            if backup is not None and path not in backed_up:
+                backed_up.add(path)
+                self.add_file(posixpath.join(backup, path), data)
+            data = apply_hunks(data, file_patch.hunks)
+            if file_patch.new is None or (backup is not None and not data):
+                if data:
+                    raise UnsupportedPackage("File to remove not empty", path)
+                self._remove_file(path)
+            else:
+                self.add_file(path, data)
+
+    def _remove_file(self, path):
+        """Remove a file, and its parent directories if they become empty.
+
+        """
+
+        self.remove(path)
+        parent = posixpath.dirname(path)
+        while parent and not any(name.startswith(parent + '/')
+                                    for name in self.entries):
+            del self.entries[parent]
+            parent = posixpath.dirname(parent)
+
+    def _resolve(self, path):
+        """Resolve the entry for a path, following symbolic links.
+
+        :returns: entry (None if the path is not in the tree)
+
+        """
+
+        for _ in range(MAX_SYMLINKS):
+            entry = self.entries.get(path)
+            if entry is None or entry[0] != 'symlink':
+                return entry
+            target = entry[1]
+            if target.startswith('/'):
+                raise UnsupportedPackage("Absolute symbolic link", path)
+            path = posixpath.normpath(posixpath.join(posixpath.dirname(path),
+                                                    target))
+            if path.startswith('../') or path == '..':
+                raise UnsupportedPackage("Symbolic link out of tree", path)
+        return None
+
+    def manifest(self):
+        """Produce the manifest for the tree, as gitlag.Manifest.from_dir would.
+
+        :returns: gitlag.Manifest
+
+        """
+
+        files = {}
+        dirs = []
+        others = []
+        for (path, entry) in self.entries.items():
+            if any(part in IGNORED_NAMES for part in path.split('/')):
+                continue
+            if entry[0] == 'symlink':
+                entry = self._resolve(path)
+                if entry is not None and entry[0] == 'dir':
+                    raise UnsupportedPackage("Symbolic link to directory", path)
+            if entry is None:
+                others.append(path)
+            elif entry[0] == 'dir':
+                dirs.append(path)
+            else:
+                files[path] = entry[1:]
+        return Manifest(files, dirs, others)
+
+
+def _find(files, pattern):
+    """Find the files matching a pattern.
+
+    """
+
+    return [name for name in files if re.search(pattern, name)]
+
+def _read_series(tree):
+    """Read the quilt series of a package.
+
+    :returns: list of names of patches
+
+    """
+
+    if any(name.startswith('debian/patches/') and name.endswith('.series')
+            for name in tree.entries):
+        raise UnsupportedPackage("Vendor series for patches")
+    if tree.entries.get('debian/patches/series', ('',))[0] != 'file':
+        return []
+    patches = []
+    for line in tree.read('debian/patches/series').decode(
+                                errors='surrogateescape').splitlines():
+        line = re.sub(r'(^|\s+)#.*$', '', line).strip()
+        if not line:
+            continue
+        fields = line.split()
+        if len(fields) > 1:
+            raise UnsupportedPackage("Options in series", line)
+        patches.append(fields[0])
+    return patches
+
+def read_tree(dsc, pack):
+    """Read the tree of a Debian source package from its archives.
+
+    :param dsc:  path of the .dsc file
+    :param pack: BlobPackWriter for contents of files
+    :returns:    SourceTree
+
+    """
+
+    data = parse_dsc(dsc)
+    dir = os.path.dirname(dsc)
+    files = [name for name in data['files'] if not name.endswith('.asc')]
+    tree = SourceTree(pack)
+    tarballs = _find(files, r'\.tar\.' + COMPRESSIONS + '$')
+    if data['format'] in ['1.0', '3.0 (native)']:
+        diffs = _find(files, r'\.diff\.gz$')
+        if len(tarballs) != 1 or len(files) != len(tarballs) + len(diffs) \
+                or len(diffs) > 1 or (diffs and data['format'] != '1.0'):
+            raise UnsupportedPackage("Files not supported", files)
+        tree.add_tar(os.path.join(dir, tarballs[0]))
+        if diffs:
+            with gzip.open(os.path.join(dir, diffs[0])) as diff:
+                tree.apply_patch(diff.read())
+    elif data['format'] == '3.0 (quilt)':
+        origs = _find(files, r'\.orig\.tar\.' + COMPRESSIONS + '$')
+        components = _find(files, r'\.orig-[A-Za-z0-9][A-Za-z0-9-]*\.tar\.'
+                            + COMPRESSIONS + '$')
+        debians = _find(files, r'\.debian\.tar\.' + COMPRESSIONS + '$')
+        if len(origs) != 1 or len(debians) != 1 \
+                or len(files) != len(origs) + len(components) + len(debians):
+            raise UnsupportedPackage("Files not supported", files)
+        tree.add_tar(os.path.join(dir, origs[0]))
+        for component in sorted(components):
+            name = re.search(r'\.orig-([A-Za-z0-9][A-Za-z0-9-]*)\.tar\.',
+                            component).group(1)
+            tree.add_tar(os.path.join(dir, component), prefix=name)
+        tree.remove('debian')
+        tree.add_tar(os.path.join(dir, debians[0]), strip=False)
+        patches = _read_series(tree)
+        for patch in patches:
+            path = 'debian/patches/' + patch
+            if tree.entries.get(path, ('',))[0] != 'file':
+                raise UnsupportedPackage("Patch not found", path)
+            tree.apply_patch(tree.read(path), backup='.pc/' + patch)
+            tree.entries.setdefault('.pc/' + patch, ('dir',))
+        # State of quilt, as left by dpkg-source (even with no patches)
+        tree.add_file('.pc/.quilt_patches', b'debian/patches\n')
+        tree.add_file('.pc/.quilt_series', b'series\n')
+        tree.add_file('.pc/.version', b'2\n')
+        tree.add_file('.pc/applied-patches',
+                        ''.join(patch + '\n' for patch in patches).encode())
+    else:
+        raise UnsupportedPackage("Format not supported", data['format'])
+    return tree
+
+def read_dpkg(dsc, remove=False):
+    """Read a Debian source package, producing its manifest and pack of blobs.
+
+    The package is read from its archives (see read_tree), and its
+    manifest and pack are saved for the directory where dpkg-source
+    would extract it (see gitlag.manifest_path and gitlag.pack_path),
+    which is not created. If they were already saved (or the package
+    was already extracted, with its manifest), the package is not
+    read again, unless remove is True.
+
+    If the package can't be read from its archives, it is extracted
+    with dpkg-source (see gitlag.extract_dpkg).
+
+    :param dsc:    path of the .dsc file
+    :param remove: read the package again, even if already read
+    :returns:      name of the directory for the package
+
+    """
+
+    dir = os.path.splitext(dsc)[0]
+    manifest = manifest_path(dir)
+    pack = pack_path(dir)
+    if not remove and os.path.exists(manifest) \
+            and (os.path.isdir(dir) or os.path.exists(pack)):
+        logging.info('Package already read for dir: ' + dir)
+        return dir
+    if os.path.exists(dir):
+        logging.info('Removing old directory before reading: ' + dir)
+        shutil.rmtree(dir)
+    for path in [manifest, pack]:
+        if os.path.exists(path):
+            os.remove(path)
+    logging.info("Reading Debian pkg for dir: " + dir)
+    writer = BlobPackWriter(pack)
+    try:
+        with profiling.phase('dpkg.read'):
+            tree = read_tree(dsc, writer)
+            result = tree.manifest()
+    except (UnsupportedPackage, tarfile.TarError, OSError, EOFError) as error:
+        writer.abort()
+        logging.info("Can't read package ({}), extracting it: {}".format(
+                        str(error.args), dsc))
+        return extract_dpkg(dsc, remove=True)
+    writer.close()
+    result.save(manifest)
+    return dir
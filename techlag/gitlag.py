@@ -22,22 +22,39 @@
 ##
 
 import filecmp
-import difflib
 import os
 import os.path
 import shutil
 import gzip
-import urllib.request
 import json
-import perceval.backends
 import subprocess
 import logging
 import io
 import datetime
 import shutil
-import shelve
 import shlex
 import tempfile
+import hashlib
+import zlib
+import multiprocessing
+import multiprocessing.util
+import concurrent.futures
+import array
+import bisect
+import sys
+import collections
+import collections.abc
+import pickle
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from . import diffstat
+from . import download
+from . import profiling
+from . import search
 
 """This module provides classes for estimating the more likely checkout
 in a git repository, when comparing to a certain directory. The directory
@@ -49,29 +66,34 @@ close any checkout from the upstream repo is to the directory.
 
 """
 
-
-def get_dpkg_data (file_name, pkg_name):
-    """Get the urls of the components of a source package in aSources.gz file.
-
-    Parse the Sources.gz file given as parameter, finding the urls for
-    the componnents (.dsc, .tar.gz) for the given package name. Returns
-    a directory with an element 'directory' (directory in the remote
-    repository, as it appears in Sources.gz), an element 'dsc' (with the
-    name of the .dsc file, as it appears in the Sources.gz file), and an
-    element 'components' (list with the names of file components, including
-    .dsc, as they appear in Sources.gz)
-
-    :param filename: path of the Sources.gz file to parse
-    :param pkg_name: name of the package to find in the Sources.gz file
-    :returns: remote directory and list of urls of the components
+# Names ignored when comparing directories (same as filecmp.dircmp)
+IGNORED_NAMES = set(filecmp.DEFAULT_IGNORES)
+# Ways of comparing commits with a directory (see Metrics)
+MODES = ['checkout', 'blobs']
+# Maximum number of symbolic links followed when resolving a path
+MAX_SYMLINKS = 40
+# Debian mirror (see get_dpkg)
+DEBIAN_MIRROR = 'http://ftp.es.debian.org/debian/'
+# Debian Snapshot service (see get_dpkg_snapshot)
+SNAPSHOT_URL = 'http://snapshot.debian.org/'
+
+def parse_sources (file_name):
+    """Parse a Sources.gz file, producing the data for each package in it.
+
+    The data for a package is a dictionary with an element 'directory'
+    (directory in the remote repository, as it appears in Sources.gz),
+    an element 'dsc' (with the name of the .dsc file, as it appears in
+    the Sources.gz file), and an element 'components' (list with the
+    names of file components, including .dsc, as they appear in Sources.gz)
+
+    :param file_name: path of the Sources.gz file to parse
+    :returns: iterator of tuples (package name, data)
 
     """
 
-    data = {'components': []}
     with gzip.open(file_name, 'rt') as sources:
-        name_found = False
+        name = None
         files_found = False
-        to_download = []
         for line in sources:
             if files_found:
                 if line.startswith(' '):
@@ -82,45 +104,84 @@ def get_dpkg_data (file_name, pkg_name):
                 else:
                     files_found = False
             if line.startswith('Package:'):
-                if name_found:
-                    name_found = False
-                    break
-                read_name = line.split()[1]
-                if read_name == pkg_name:
-                    name_found = True
-            elif name_found and line.startswith('Files:'):
+                if name is not None:
+                    yield (name, data)
+                name = line.split()[1]
+                data = {'components': []}
+            elif name is not None and line.startswith('Files:'):
                 files_found = True
-            elif name_found and line.startswith('Directory:'):
+            elif name is not None and line.startswith('Directory:'):
                 data['directory'] = line.split()[1]
-    return(data)
+        if name is not None:
+            yield (name, data)
+
+def get_dpkg_data (file_name, pkg_name):
+    """Get the urls of the components of a source package in aSources.gz file.
 
-def get_dpkg(name, release, dir):
+    Parse the Sources.gz file given as parameter, finding the urls for
+    the componnents (.dsc, .tar.gz) for the given package name. Returns
+    the data for the package, as produced by parse_sources (or with
+    an empty list of components, if the package is not found).
+
+    :param filename: path of the Sources.gz file to parse
+    :param pkg_name: name of the package to find in the Sources.gz file
+    :returns: remote directory and list of urls of the components
+
+    """
+
+    for (name, data) in parse_sources(file_name):
+        if name == pkg_name:
+            return data
+    return {'components': []}
+
+def get_dpkg(name, release, dir, downloader=None, catalogue=None):
     """Get a debian source package, given its name and the release.
 
     Gets the components of the source code package from the corresponding Debian
     repository, and stores them in dir. To do that, it first gets the
     Sources.gz file  for the corresponding distribution (eg: testing/main),
-    looks in it for the components of the package, and downloads them.
-
-    :param    name: name of the Debian package
-    :param release: Debian release
-    :param     dir: name (path) of the directory to download the components
+    looks in it for the components of the package, and downloads them
+    (concurrently, see download.Downloader).
+
+    If catalogue is specified, the Sources.gz file is downloaded and
+    parsed only if the release is not in it (or is too old), and
+    the components of the package are looked for in it.
+
+    :param       name: name of the Debian package
+    :param    release: Debian release
+    :param        dir: name (path) of the directory to download the components
+    :param downloader: download.Downloader to use (default None, the default one)
+    :param  catalogue: cache.SourcesCatalogue to use (default None)
     :returns: path of the downloaded dsc file for the package
 
     """
 
-    debian_repo = 'http://ftp.es.debian.org/debian/'
-    sources_url = debian_repo + 'dists/' + release + '/source/Sources.gz'
-    sources_file = os.path.join(dir, 'Sources.gz')
-    logging.info ("Downloading {} to {}".format(sources_url, sources_file))
-    urllib.request.urlretrieve(sources_url, sources_file)
-
-    pkg_data = get_dpkg_data(sources_file, name)
+    if downloader is None:
+        downloader = download.get_downloader()
+    sources_url = DEBIAN_MIRROR + 'dists/' + release + '/source/Sources.gz'
+    if catalogue is None:
+        sources_file = os.path.join(dir, 'Sources.gz')
+        logging.info ("Downloading {} to {}".format(sources_url, sources_file))
+        downloader.download(sources_url, sources_file)
+        pkg_data = get_dpkg_data(sources_file, name)
+    else:
+        if catalogue.expired(release):
+            sources_file = os.path.join(dir,
+                                    release.replace('/', '_') + '.Sources.gz')
+            logging.info ("Downloading {} to {}".format(sources_url,
+                                                        sources_file))
+            downloader.download(sources_url, sources_file)
+            catalogue.load(release, parse_sources(sources_file))
+        pkg_data = catalogue.get(release, name)
+        if pkg_data is None:
+            raise ValueError("Package not found in release", name, release)
+    file_urls = []
+    file_paths = []
     for file in pkg_data['components']:
-        file_url = debian_repo + pkg_data['directory'] + "/" + file
-        file_path = os.path.join(dir, file)
-        logging.info ("Downloading {} from {}".format(file, file_url))
-        urllib.request.urlretrieve(file_url, file_path)
+        file_urls.append(DEBIAN_MIRROR + pkg_data['directory'] + "/" + file)
+        file_paths.append(os.path.join(dir, file))
+        logging.info ("Downloading {} from {}".format(file, file_urls[-1]))
+    downloader.map(downloader.download, file_urls, file_paths)
     return os.path.join(dir, pkg_data['dsc'])
 
 def extract_dpkg(dpkg, remove=False):
@@ -130,6 +191,11 @@ def extract_dpkg(dpkg, remove=False):
     original file and the diff file should be in the same directory). This
     function assumes that dpkg-source is already installed and ready to run.
 
+    If the package was already extracted, and the manifest for the
+    directory was saved (see manifest_path), the package is not
+    extracted again, unless remove is True (in that case, the manifest,
+    and the pack of blobs for the directory, if any, are removed too).
+
     :param   dpkg: dsc file for a Debian package
     :param remove; remove the directory if already present
     :returns: name of directory where the package was extracted
@@ -137,84 +203,1204 @@ def extract_dpkg(dpkg, remove=False):
     """
 
     dir = os.path.splitext(dpkg)[0]
-    if remove and os.path.exists(dir):
-        logging.info('Removing old directory before extracting: ' + dir)
-        shutil.rmtree(dir)
+    manifest = manifest_path(dir)
+    if remove:
+        if os.path.exists(dir):
+            logging.info('Removing old directory before extracting: ' + dir)
+            shutil.rmtree(dir)
+        for path in [manifest, pack_path(dir)]:
+            if os.path.exists(path):
+                os.remove(path)
+    elif os.path.isdir(dir) and os.path.exists(manifest):
+        logging.info('Package already extracted in dir: ' + dir)
+        return dir
     logging.info("Extracting Debian pkg in dir: " + dir)
-    result = subprocess.call(["dpkg-source", "--extract", dpkg, dir],
-                    stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+    with profiling.phase('dpkg.extract'):
+        result = subprocess.call(["dpkg-source", "--extract", dpkg, dir],
+                        stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
     if result != 0:
         logging.info('Error while extracting package for {}'.format(dpkg))
         raise ChildProcessError('Error extracting package', dpkg)
     return dir
 
-def get_json(url):
+def get_json(url, downloader=None):
+    """Get the 'result' in a JSON document (as in snapshot.debian.org API).
+
+    :param        url: url of the JSON document
+    :param downloader: download.Downloader to use (default None, the default one)
+    :returns: value for 'result', or None if the url was not found (404)
+
+    """
 
     logging.debug("get_json: " + url)
-    try:
-        response = urllib.request.urlopen(url).read()
-    except urllib.error.HTTPError as error:
-        if error.code == 404:
-            return None
-        else:
-            raise
-    data = json.loads(response.decode('utf-8'))
-    return data['result']
+    if downloader is None:
+        downloader = download.get_downloader()
+    return downloader.get_json(url)
 
-def get_dpkg_snapshot(name, version, dir):
+def get_dpkg_snapshot(name, version, dir, downloader=None, objects=None):
     """Get a debian source package from Debian Snapshot, given its name and version.
 
     Gets the components of the source code package from the corresponding Debian
     repository, and stores them in dir. To do that, it first gets the
-    Sources.gz file  for the corresponding distribution (eg: testing/main),
-    looks in it for the components of the package, and downloads them.
+    list of files for the package version, then the information for
+    each of them (concurrently), and then downloads them (concurrently,
+    see download.Downloader), verifying their SHA1 hash.
 
-    :param    name: name of the Debian package
-    :param version: Debian version
-    :param     dir: name (path) of the directory to download the components
-    :returns: path of the downloaded dsc file for the package
+    If objects is specified, files are downloaded to it (unless already
+    there), and linked in dir with their names. Otherwise, files are
+    downloaded to dir, unless already there with the right hash.
+
+    :param       name: name of the Debian package
+    :param    version: Debian version
+    :param        dir: name (path) of the directory to download the components
+    :param downloader: download.Downloader to use (default None, the default one)
+    :param    objects: download.ObjectStore to store files (default None)
+    :returns: path of the downloaded dsc file for the package, and its date
 
     """
 
+    if downloader is None:
+        downloader = download.get_downloader()
     # Get the url describing the files for the source package
-    files_url = 'http://snapshot.debian.org/mr/package/' + name + '/' \
+    files_url = SNAPSHOT_URL + 'mr/package/' + name + '/' \
         + version + '/srcfiles'
-    files = get_json(files_url)
+    files = downloader.get_json(files_url)
     if files is None:
         logging.info("Ignoring version (because no src files): " + version)
         raise ValueError("No src files found in description for package", version)
-    for file in files:
-        # Get the url describing a file
-        file_url = 'http://snapshot.debian.org/mr/file/' \
-            + file['hash'] + '/info'
+    # Get the urls describing the files
+    file_urls = [SNAPSHOT_URL + 'mr/file/' + file['hash'] + '/info'
+                for file in files]
+    for file_url in file_urls:
         logging.info("File: " + file_url)
-        info = get_json(file_url)[0]
-        download_url = 'http://snapshot.debian.org/archive/' \
+    infos = downloader.map(downloader.get_json, file_urls)
+    download_urls = []
+    file_names = []
+    hashes = []
+    for (file, info) in zip(files, infos):
+        info = info[0]
+        download_url = SNAPSHOT_URL + 'archive/' \
             + info['archive_name'] + '/' + info['first_seen'] \
             + info['path'] + '/' + info['name']
         file_name = os.path.join(dir, info['name'])
-        if os.path.isfile(file_name):
+        if objects is None and os.path.isfile(file_name) \
+                and download.file_hash(file_name) == file['hash']:
             logging.info('Already present, not downloading: ' + download_url)
         else:
             logging.info('To download: ' + download_url)
-            (name, headers) = urllib.request.urlretrieve(url=download_url,
-                filename=file_name)
-            logging.info('Downloaded: ' + name)
+            download_urls.append(download_url)
+            file_names.append(file_name)
+            hashes.append(file['hash'])
         if os.path.splitext(file_name)[1] == '.dsc':
             dsc = file_name
             date = info['first_seen']
+    if objects is None:
+        downloader.map(downloader.download, download_urls, file_names, hashes)
+    else:
+        downloader.map(objects.fetch, [downloader] * len(hashes),
+                        download_urls, hashes)
+        for (file_name, hash) in zip(file_names, hashes):
+            objects.link(hash, file_name)
+    for file_name in file_names:
+        logging.info('Downloaded: ' + file_name)
     return (dsc, date)
 
+def commit_date(date):
+    """Parse the date of a commit, as produced by Repo.
+
+    :param date: date, as a string (eg: 'Sat Aug 27 17:00:32 2016 +0200')
+    :returns:    date, as a datetime.datetime object (with time zone)
+
+    """
+
+    return datetime.datetime.strptime(date, '%a %b %d %H:%M:%S %Y %z')
+
+def snapshot_date(date):
+    """Parse a date in Debian Snapshot, as produced by get_dpkg_snapshot.
+
+    :param date: date, as a string (eg: '20160827T170032Z')
+    :returns:    date, as a datetime.datetime object (in UTC)
+
+    """
+
+    return datetime.datetime.strptime(date, '%Y%m%dT%H%M%SZ') \
+        .replace(tzinfo=datetime.timezone.utc)
+
+
+def blob_hash(data):
+    """Compute the git blob hash for some content.
+
+    This is the same hash git uses to identify the content of a file
+    (see git hash-object), which allows to match files in a directory
+    with files in a git tree without reading them from the repository.
+
+    :param data: content of the file (bytes)
+    :returns:    hash, as an hexadecimal string
+
+    """
+
+    sha = hashlib.sha1(b'blob %d\0' % len(data))
+    sha.update(data)
+    return sha.hexdigest()
+
+def read_lines(data):
+    """Split content of a file in lines, the same way open() + readlines() do.
+
+    Content is decoded as ascii with surrogate escapes, and universal
+    newlines are used, so that the lines are the same as if the file was
+    read from disk by BaseDir.compare_files.
+
+    :param data: content of the file (bytes)
+    :returns:    list of lines
+
+    """
+
+    return io.TextIOWrapper(io.BytesIO(data), encoding="ascii",
+                            errors="surrogateescape").readlines()
+
+def count_lines(data):
+    """Count lines in the content of a file, as reading it as text does.
+
+    Lines are ended by a newline, a carriage return, or both (as in
+    universal newlines mode), and a last line with no end is counted too.
+
+    :param data: content of the file (bytes)
+    :returns:    number of lines
+
+    """
+
+    lines = data.count(b'\n') + data.count(b'\r') - data.count(b'\r\n')
+    if data and not data.endswith((b'\n', b'\r')):
+        lines += 1
+    return lines
+
+
+class LRUMemo(collections.OrderedDict):
+    """Dictionary with at most maxsize entries, used as a cache in memory.
+
+    When a new entry would exceed maxsize, the least recently used
+    entry (read or written) is removed.
+
+    :param maxsize: maximum number of entries
+
+    """
+
+    def __init__(self, maxsize):
+
+        super().__init__()
+        self.maxsize = maxsize
+
+    def __getitem__(self, key):
+
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+
+    def __reduce__(self):
+        """Reduce for pickling (maxsize is needed to create the object)
+
+        """
+
+        return (self.__class__, (self.maxsize,), None, None, iter(self.items()))
+
+
+class Tree(dict):
+    """Directory tree, as a dictionary of entries.
+
+    Keys are names of entries in the directory. Values are either
+    a Tree (for subdirectories), a string with the git blob hash of the
+    content (for files), or None (for entries which are neither
+    files nor directories, such as broken symbolic links).
+
+    hash is the git hash of the tree, if the tree comes from a git
+    repository. For trees produced from a Manifest, or by resolving
+    symbolic links (see resolve_links), it is a hash of their entries
+    (see entries_hash).
+
+    For trees read from a git repository, links has the names of
+    entries which are symbolic links (their value is the blob hash of
+    the link), and has_links is True if there are symbolic links in the
+    tree, or in any of its subtrees.
+
+    """
+
+    def __init__(self, hash=None):
+        super().__init__()
+        self.hash = hash
+        self.links = set()
+        self.has_links = False
+
+    def entries_hash(self, kind):
+        """Hash of the entries of the tree.
+
+        The hash is computed from the names of the entries, and their
+        blob hashes or hashes of subtrees, so that trees with the same
+        contents have the same hash.
+
+        :param kind: kind of tree (to produce different hashes for
+                     different kinds of trees)
+        :returns:    hash (hexadecimal string)
+
+        """
+
+        sha = hashlib.sha1(kind.encode() + b'\0')
+        for name in sorted(self):
+            entry = self[name]
+            if isinstance(entry, Tree):
+                entry = entry.hash
+            sha.update(os.fsencode(name) + b'\0' + str(entry).encode() + b'\0')
+        return sha.hexdigest()
+
+def resolve_links(root, read_blob):
+    """Resolve symbolic links in a tree read from a git repository.
+
+    Produces the tree a checkout would produce when read following
+    symbolic links, as Manifest.from_dir does: links to files are files
+    with the content of the target, links to directories are directories
+    with the contents of the target, and links which can't be resolved
+    (broken links, links to directories which contain them, or links
+    to paths out of the tree, including absolute links) are neither
+    files nor directories (None). Unlike in a checkout, absolute links
+    are never resolved, since they point out of the repository.
+
+    Subtrees with no symbolic links are not copied.
+
+    :param root:      Tree read from a git repository (see Repo.read_tree)
+    :param read_blob: function to read blobs (targets of links), given
+                      their hash
+    :returns:         Tree object
+
+    """
+
+    def tree_at(path):
+        """Tree for a path with no symbolic links (as a tuple of names)"""
+        tree = root
+        for name in path:
+            tree = tree[name]
+        return tree
+
+    def follow(path, target, links):
+        """Follow a link in directory path (with no symbolic links).
+
+        :returns: tuple (path with no symbolic links, entry),
+                  or (None, None) if the link can't be resolved
+
+        """
+
+        if links > MAX_SYMLINKS or target == '' or target.startswith('/'):
+            return (None, None)
+        path = list(path)
+        entry = tree_at(path)
+        for name in target.split('/'):
+            if name in ('', '.'):
+                if not isinstance(entry, Tree):
+                    return (None, None)
+            elif not isinstance(entry, Tree):
+                return (None, None)
+            elif name == '..':
+                if not path:
+                    return (None, None)
+                path.pop()
+                entry = tree_at(path)
+            elif name not in entry:
+                return (None, None)
+            elif name in entry.links:
+                (path, entry) = follow(tuple(path),
+                                        os.fsdecode(read_blob(entry[name])),
+                                        links + 1)
+                if path is None:
+                    return (None, None)
+                path = list(path)
+            else:
+                path.append(name)
+                entry = entry[name]
+        return (tuple(path), entry)
+
+    def resolve(tree, path, ancestors):
+        """Resolve links in a tree, for directory path (with no symbolic links)
+
+        :param ancestors: paths of directories including this one
+        """
+        if not tree.has_links:
+            return tree
+        ancestors = ancestors + (path,)
+        resolved = Tree()
+        for (name, entry) in tree.items():
+            if name in tree.links:
+                (entry_path, entry) = follow(path,
+                                            os.fsdecode(read_blob(entry)), 1)
+            else:
+                entry_path = path + (name,)
+            if isinstance(entry, Tree):
+                if entry_path in ancestors:
+                    entry = None
+                else:
+                    entry = resolve(entry, entry_path, ancestors)
+            resolved[name] = entry
+        resolved.hash = resolved.entries_hash('resolved')
+        return resolved
+
+    return resolve(root, (), ())
+
+def manifest_path(dir):
+    """Path of the file with the manifest for a directory (see Manifest).
+
+    The manifest is stored next to the directory, so that it is
+    found by later runs working with the same directory.
+
+    :param dir: directory
+    :returns:   path of the file for its manifest
+
+    """
+
+    return os.path.normpath(dir) + '.manifest'
+
+class Manifest:
+    """Manifest of the files in a directory.
+
+    The manifest has, for each file in the directory (and its
+    subdirectories), its path relative to the directory, its size,
+    its git blob hash, and its number of lines (as counted by count_lines).
+    It has as well the paths of all subdirectories (including empty ones),
+    and of entries which are neither files nor directories. Entries
+    are classified following symbolic links, as filecmp.dircmp does,
+    and entries ignored by filecmp.dircmp are not included.
+
+    Manifests are not modified once built. They can be saved to a file,
+    and loaded later, so that the directory doesn't need to be read again.
+    The number of lines is not counted (and is None) if lines is False
+    when reading the directory.
+
+    :param files:  dictionary {path: (size, blob hash, lines)}
+    :param dirs:   paths of directories
+    :param others: paths of entries which are neither files nor directories
+
+    """
+
+    # Version of the format of files with manifests
+    version = 1
+
+    def __init__(self, files, dirs, others):
+
+        self.files = files
+        self.dirs = frozenset(dirs)
+        self.others = frozenset(others)
+
+    @classmethod
+    def from_dir(cls, dir, lines=True):
+        """Build the manifest for a directory, by reading it.
+
+        :param dir:   directory to read
+        :param lines: count lines of files (default True)
+        :returns:     Manifest object
+
+        """
+
+        files = {}
+        dirs = []
+        others = []
+
+        def read(path, ancestors):
+            ancestors = ancestors + (os.path.realpath(os.path.join(dir, path)),)
+            for entry in os.scandir(os.path.join(dir, path)):
+                if entry.name in IGNORED_NAMES:
+                    continue
+                name = path + '/' + entry.name if path else entry.name
+                try:
+                    (is_dir, is_file) = (entry.is_dir(), entry.is_file())
+                except OSError:
+                    # Symbolic links which can't be followed (for example,
+                    # loops of links, or to a file as a directory)
+                    (is_dir, is_file) = (False, False)
+                if is_dir:
+                    if os.path.realpath(entry.path) in ancestors:
+                        others.append(name)
+                    else:
+                        dirs.append(name)
+                        read(name, ancestors)
+                elif is_file:
+                    with open(entry.path, 'rb') as f:
+                        data = f.read()
+                    files[name] = (len(data), blob_hash(data),
+                                    count_lines(data) if lines else None)
+                else:
+                    others.append(name)
+
+        with profiling.phase('basedir.walk'):
+            read('', ())
+        profiling.count('basedir.files', len(files))
+        profiling.count('basedir.bytes_read',
+                        sum(size for (size, blob, lines) in files.values()))
+        return cls(files, dirs, others)
+
+    @classmethod
+    def load(cls, path):
+        """Load a manifest from a file (see save).
+
+        :param path: path of the file
+        :returns:    Manifest object, or None if the file has another version
+
+        """
+
+        with open(path) as f:
+            data = json.load(f)
+        if data.get('version') != cls.version:
+            return None
+        files = {name: tuple(file) for (name, file) in data['files'].items()}
+        return cls(files, data['dirs'], data['others'])
+
+    def save(self, path):
+        """Save the manifest to a file, as JSON.
+
+        The file is written atomically (first to a temporary file,
+        which is then renamed), so that an incomplete manifest is never
+        found by other processes, or by later runs.
+
+        :param path: path of the file
+
+        """
+
+        data = {'version': self.version, 'files': self.files,
+                'dirs': sorted(self.dirs), 'others': sorted(self.others)}
+        tmp = path + '.' + str(os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+    def tree(self):
+        """Produce the Tree for the directory.
+
+        Since there is no git hash for the tree of a directory read from
+        disk, the hash of each Tree is a hash of its entries (names,
+        and blob hashes or hashes of subtrees), so that Trees with the
+        same contents have the same hash.
+
+        :returns: Tree object
+
+        """
+
+        root = Tree()
+        trees = {'': root}
+        for path in sorted(self.dirs):
+            (parent, _, name) = path.rpartition('/')
+            trees[path] = trees[parent][name] = Tree()
+        for path in self.others:
+            (parent, _, name) = path.rpartition('/')
+            trees[parent][name] = None
+        for (path, (size, blob, lines)) in self.files.items():
+            (parent, _, name) = path.rpartition('/')
+            trees[parent][name] = blob
+        for path in sorted(trees, key=len, reverse=True):
+            trees[path].hash = trees[path].entries_hash('manifest')
+        return root
+
+    def blob_paths(self, dir):
+        """Paths of files in a directory with this manifest, by blob hash.
+
+        :param dir: directory
+        :returns:   dictionary {blob hash: path of a file with that blob}
+
+        """
+
+        return {blob: os.path.join(dir, path)
+                for (path, (size, blob, lines)) in self.files.items()}
+
+
+def pack_path(dir):
+    """Path of the file with the pack of blobs for a directory.
+
+    The pack is a sibling of the directory (see BlobPack).
+
+    :param dir: directory
+    :returns:   path of the pack
+
+    """
+
+    return os.path.normpath(dir) + '.blobs'
+
+
+class BlobPack:
+    """Pack of blobs (contents of files), by git blob hash, in a single file.
+
+    A pack holds the contents of the files of a directory which is
+    not on disk (for example, a Debian source package read from its
+    archives, see techlag.dpkg), so that they can be read when comparing
+    it (see BaseDir.read_blob). The file starts with a line (magic), and
+    then has an entry per blob: its hash (20 bytes), the length of its
+    compressed content (8 bytes, big endian), and its content,
+    compressed with zlib. Each blob is stored only once.
+
+    Packs are read by objects in this class, and written by BlobPackWriter.
+    The index of the pack (offsets of blobs) is built when first needed,
+    by reading the headers of entries.
+
+    :param path: path of the pack
+
+    """
+
+    magic = b'techlag blobs 1\n'
+    # Size of the header of entries
+    header_size = 28
+
+    def __init__(self, path):
+
+        self.path = path
+        self.file = None
+        self.offsets = None
+
+    def __getstate__(self):
+        """Get state for pickling (open files can't be pickled)
+
+        """
+
+        state = self.__dict__.copy()
+        state['file'] = None
+        return state
+
+    def _open(self):
+        """Open the pack, and build its index, if not done yet.
+
+        """
+
+        if self.file is None:
+            self.file = open(self.path, 'rb')
+        if self.offsets is None:
+            if self.file.read(len(self.magic)) != self.magic:
+                raise ValueError("Not a pack of blobs", self.path)
+            self.offsets = {}
+            offset = len(self.magic)
+            while True:
+                header = self.file.read(self.header_size)
+                if len(header) < self.header_size:
+                    break
+                length = int.from_bytes(header[20:], 'big')
+                self.offsets[header[:20].hex()] = (offset + self.header_size,
+                                                    length)
+                offset += self.header_size + length
+                self.file.seek(offset)
+
+    def __contains__(self, hash):
+
+        self._open()
+        return hash in self.offsets
+
+    def read(self, hash):
+        """Read the content of a blob.
+
+        :param hash: git blob hash
+        :returns:    content (bytes)
+
+        """
+
+        self._open()
+        (offset, length) = self.offsets[hash]
+        self.file.seek(offset)
+        return zlib.decompress(self.file.read(length))
+
+    def close(self):
+
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class BlobPackWriter:
+    """Writer of packs of blobs (see BlobPack).
+
+    The pack is written to a temporary file, which is renamed when
+    closed, so that an incomplete pack is never found. Blobs already
+    added can be read while writing.
+
+    :param path: path of the pack
+
+    """
+
+    # Compression level (fast, since most blobs are never read)
+    level = 1
+
+    def __init__(self, path):
+
+        self.path = path
+        self.tmp_path = path + '.' + str(os.getpid())
+        self.file = open(self.tmp_path, 'w+b')
+        self.file.write(BlobPack.magic)
+        self.offset = len(BlobPack.magic)
+        self.offsets = {}
+
+    def add(self, data):
+        """Add a blob to the pack (if not already in it).
+
+        :param data: content of the blob (bytes)
+        :returns:    git blob hash
+
+        """
+
+        hash = blob_hash(data)
+        if hash not in self.offsets:
+            compressed = zlib.compress(data, self.level)
+            self.file.write(bytes.fromhex(hash)
+                            + len(compressed).to_bytes(8, 'big') + compressed)
+            self.offsets[hash] = (self.offset + BlobPack.header_size,
+                                    len(compressed))
+            self.offset += BlobPack.header_size + len(compressed)
+        return hash
+
+    def read(self, hash):
+        """Read the content of a blob already added.
+
+        :param hash: git blob hash
+        :returns:    content (bytes)
+
+        """
+
+        (offset, length) = self.offsets[hash]
+        self.file.flush()
+        return zlib.decompress(os.pread(self.file.fileno(), length, offset))
+
+    def close(self):
+        """Finish writing the pack, renaming it to its path.
+
+        """
+
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        """Stop writing the pack, removing the temporary file.
+
+        """
+
+        self.file.close()
+        os.remove(self.tmp_path)
+
+
+# Names of days and months, as used by git in dates (default format)
+_DAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+_MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+            'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+def format_date(epoch, offset):
+    """Format a date the way git does by default (as in git log).
+
+    :param epoch:  date, as seconds since the epoch
+    :param offset: time zone offset, in minutes
+    :returns:      date, as a string (eg: 'Sat Aug 27 17:00:32 2016 +0200')
+
+    """
+
+    date = datetime.datetime.fromtimestamp(epoch,
+                        datetime.timezone(datetime.timedelta(minutes=offset)))
+    sign = '-' if offset < 0 else '+'
+    return "%s %s %d %02d:%02d:%02d %d %s%02d%02d" % (
+        _DAYS[date.weekday()], _MONTHS[date.month-1], date.day,
+        date.hour, date.minute, date.second, date.year,
+        sign, abs(offset) // 60, abs(offset) % 60)
+
+def _parse_offset(date):
+    """Time zone offset, in minutes, of a date in ISO-like format.
+
+    :param date: date, as produced by %ci in git log (eg: '2016-08-27 17:00:32 +0200')
+    :returns:    offset, in minutes
+
+    """
+
+    zone = date[-5:]
+    offset = int(zone[1:3]) * 60 + int(zone[3:5])
+    return -offset if zone[0] == '-' else offset
+
+
+class CommitIndex:
+    """Compact index of the commits of a git repository.
+
+    Data for commits is stored in columns, each of them a compact
+    array with an element per commit: commit hashes (20 bytes each,
+    in binary form), commit and author dates (as seconds since the
+    epoch, and time zone offsets in minutes), and authors (as ids
+    in the list of authors, so that each author is stored only once).
+
+    The index is built by parsing the output of git log (see from_git),
+    as it is produced, with no intermediate list of commits. It
+    remembers the heads of the branches it was built from, so that
+    it can be updated later with only the new commits (see update).
+    It can be saved to a file, in a compact format (see save), and
+    loaded from it, with no need of unpickling.
+
+    :param after:    commits considered are those after this date
+    :type after:     datetime.datetime
+    :param branches: branches considered (None means "all branches")
+
+    """
+
+    # Version of the format of files with the index (see save)
+    version = 1
+    # First line of files with the index
+    magic = b'techlag commit index\n'
+
+    def __init__(self, after=None, branches=['master']):
+
+        self.after = after
+        self.branches = branches
+        # Hashes of the heads of the branches, when last read from git
+        self.heads = []
+        self.hashes = bytearray()
+        self.dates = array.array('q')
+        self.date_offsets = array.array('h')
+        self.author_ids = array.array('i')
+        self.author_dates = array.array('q')
+        self.author_offsets = array.array('h')
+        # Authors (by id), and ids (by author)
+        self.authors = []
+        self._ids = {}
+
+    def __len__(self):
+
+        return len(self.dates)
+
+    def __getstate__(self):
+        """Get state for pickling (ids by author are not pickled)
+
+        """
+
+        state = self.__dict__.copy()
+        del state['_ids']
+        return state
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+        self._ids = {author: id for (id, author) in enumerate(self.authors)}
+
+    def author_id(self, author):
+        """Get the id for an author, adding it if it is new.
+
+        :param author: author (name and email)
+        :returns:      id of the author
+
+        """
+
+        if author not in self._ids:
+            self._ids[author] = len(self.authors)
+            self.authors.append(author)
+        return self._ids[author]
+
+    def append(self, hash, date, date_offset, author, author_date, author_offset):
+        """Add a commit to the index.
+
+        :param hash:          commit hash (hexadecimal string)
+        :param date:          commit date (seconds since the epoch)
+        :param date_offset:   time zone offset for commit date (minutes)
+        :param author:        author (name and email)
+        :param author_date:   author date (seconds since the epoch)
+        :param author_offset: time zone offset for author date (minutes)
+
+        """
+
+        self.hashes += bytes.fromhex(hash)
+        self.dates.append(date)
+        self.date_offsets.append(date_offset)
+        self.author_ids.append(self.author_id(author))
+        self.author_dates.append(author_date)
+        self.author_offsets.append(author_offset)
+
+    def hash(self, commit_no):
+        """Get the hash of a commit (hexadecimal string).
+
+        """
+
+        return self.hashes[commit_no*20:(commit_no+1)*20].hex()
+
+    def date(self, commit_no):
+        """Get the commit date of a commit, formatted as git does.
+
+        """
+
+        return format_date(self.dates[commit_no], self.date_offsets[commit_no])
+
+    def author(self, commit_no):
+        """Get the author of a commit (name and email).
+
+        """
+
+        return self.authors[self.author_ids[commit_no]]
+
+    def author_date(self, commit_no):
+        """Get the author date of a commit, formatted as git does.
+
+        """
+
+        return format_date(self.author_dates[commit_no],
+                            self.author_offsets[commit_no])
+
+    # Format for git log: a line per commit, with fields separated by \0
+    log_format = '%H%x00%ct%x00%ci%x00%aN <%aE>%x00%at%x00%ai'
+
+    def parse_log(self, lines):
+        """Add to the index the commits in lines produced by git log.
+
+        :param lines: iterator of lines (str), in log_format
+
+        """
+
+        for line in lines:
+            fields = line.rstrip('\n').split('\0')
+            if len(fields) != 6:
+                continue
+            (hash, date, date_iso, author, author_date, author_iso) = fields
+            self.append(hash, int(date), _parse_offset(date_iso),
+                        author, int(author_date), _parse_offset(author_iso))
+
+    def _columns(self):
+        """Columns of the index, in the order they are saved.
+
+        """
+
+        return [self.hashes, self.dates, self.date_offsets,
+                self.author_ids, self.author_dates, self.author_offsets]
+
+    def _log(self, dir, heads, exclude=[]):
+        """Add to the index the commits produced by git log.
+
+        Commits are produced in reverse order, and in topological order.
+
+        :param dir:     directory with the git repository
+        :param heads:   hashes of the commits to start from
+        :param exclude: hashes of commits to exclude (with their ancestors)
+
+        """
+
+        if len(heads) == 0:
+            return
+        cmd = ['git', '-C', dir, 'log', '--reverse', '--topo-order',
+                '--format=' + self.log_format]
+        if self.after is not None:
+            after = self.after
+            if after.tzinfo is not None:
+                after = after.astimezone(datetime.timezone.utc)
+            cmd.append('--since=' + after.strftime("%Y-%m-%d %H:%M:%S") + ' +0000')
+        cmd.extend(heads)
+        if exclude:
+            cmd.append('--not')
+            cmd.extend(exclude)
+        logging.debug("Running: " + ' '.join(cmd))
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE) as proc:
+            lines = io.TextIOWrapper(proc.stdout, encoding='utf-8',
+                                    errors='surrogateescape')
+            self.parse_log(lines)
+        if proc.returncode != 0:
+            raise ChildProcessError('Error running git log', dir)
+
+    def read_heads(self, dir):
+        """Read the hashes of the heads of the branches considered.
+
+        Branches are those in the origin remote or, for branches not
+        in it (for example, if there is no origin remote), local branches.
+
+        :param dir: directory with the git repository
+        :returns:   list of hashes of heads
+
+        """
+
+        if self.branches is None:
+            revisions = ['--all', '--remotes=origin']
+        else:
+            revisions = []
+            for branch in self.branches:
+                remote = 'refs/remotes/origin/' + branch
+                if subprocess.call(['git', '-C', dir, 'rev-parse', '--verify',
+                                    '--quiet', remote],
+                                    stdout=subprocess.DEVNULL) == 0:
+                    revisions.append(remote)
+                else:
+                    revisions.append('refs/heads/' + branch)
+        if len(revisions) == 0:
+            return []
+        output = subprocess.check_output(['git', '-C', dir, 'rev-parse']
+                                        + revisions, universal_newlines=True)
+        return sorted(set(output.split()))
+
+    @classmethod
+    def from_git(cls, dir, after=None, branches=['master']):
+        """Build the index for the commits in a git repository.
+
+        Commits are those produced by git log (in reverse order, and
+        in topological order) for the remote branches specified
+        (in the origin remote), authored after a date.
+
+        :param dir:      directory with the git repository
+        :param after:    consider only commits after this date (default None)
+        :type after:     datetime.datetime
+        :param branches: branches to consider (None means "all branches")
+        :returns:        CommitIndex object
+
+        """
+
+        index = cls(after=after, branches=branches)
+        index.heads = index.read_heads(dir)
+        index._log(dir, index.heads)
+        return index
+
+    def update(self, dir):
+        """Add to the index the commits new since it was built.
+
+        New commits are those reachable from the current heads of
+        the branches, but not from the heads when the index was last
+        read from git. They are appended to the index, so that numbers
+        of commits already in it don't change. If some of the old heads
+        is not reachable from the current heads (history was rewritten),
+        the index can't be updated.
+
+        :param dir: directory with the git repository
+        :returns:   number of commits added, or None if the index
+                    can't be updated
+
+        """
+
+        heads = self.read_heads(dir)
+        if heads == self.heads:
+            return 0
+        if self.heads:
+            unreachable = subprocess.check_output(['git', '-C', dir,
+                                    'rev-list', '--max-count=1'] + self.heads
+                                    + ['--not'] + heads, universal_newlines=True)
+            if unreachable.strip():
+                return None
+        commits = len(self)
+        self._log(dir, heads, exclude=self.heads)
+        self.heads = heads
+        return len(self) - commits
+
+    def save(self, path):
+        """Save the index to a file.
+
+        The file has a first line (magic), then a line with a JSON
+        header (version, parameters, heads, number of commits, authors),
+        and then the bytes of each column, in the order of _columns.
+        The file is written to a temporary file first (specific to the
+        process), and then renamed, so that it is never left half-written,
+        even if several processes save it at the same time.
+
+        :param path: path of the file
+
+        """
+
+        header = {'version': self.version, 'byteorder': sys.byteorder,
+                'after': None if self.after is None else self.after.isoformat(),
+                'branches': self.branches, 'heads': self.heads,
+                'commits': len(self), 'authors': self.authors}
+        # Temporary name specific to the process, in case several of them
+        # save the same index at the same time
+        tmp_path = path + '.' + str(os.getpid())
+        try:
+            with open(tmp_path, 'wb') as file:
+                file.write(self.magic)
+                file.write(json.dumps(header).encode() + b'\n')
+                for column in self._columns():
+                    file.write(column)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        """Load an index from a file (see save).
+
+        :param path: path of the file
+        :returns:    CommitIndex object, or None if the file doesn't
+                     exist or is not in the current format
+
+        """
+
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as file:
+            if file.readline() != cls.magic:
+                return None
+            header = json.loads(file.readline().decode())
+            if header.get('version') != cls.version:
+                return None
+            after = header['after']
+            if after is not None:
+                after = datetime.datetime.fromisoformat(after)
+            index = cls(after=after, branches=header['branches'])
+            index.heads = header['heads']
+            index.authors = header['authors']
+            index._ids = {author: id for (id, author)
+                            in enumerate(index.authors)}
+            commits = header['commits']
+            index.hashes = bytearray(file.read(20 * commits))
+            for column in index._columns()[1:]:
+                column.frombytes(file.read(column.itemsize * commits))
+                if header['byteorder'] != sys.byteorder:
+                    column.byteswap()
+            if any(len(column) != commits for column in index._columns()[1:]) \
+                    or len(index.hashes) != 20 * commits:
+                logging.warning("Truncated commit index: " + path)
+                return None
+        return index
+
+
+class CommitList(collections.abc.Sequence):
+    """List of commits, as [hash, commit date], backed by a CommitIndex.
+
+    """
+
+    def __init__(self, index):
+
+        self.index = index
+
+    def __len__(self):
+
+        return len(self.index)
+
+    def __getitem__(self, commit_no):
+
+        if isinstance(commit_no, slice):
+            return [self[no] for no in range(*commit_no.indices(len(self)))]
+        if commit_no < 0:
+            commit_no += len(self)
+        if not 0 <= commit_no < len(self):
+            raise IndexError('commit number out of range', commit_no)
+        return [self.index.hash(commit_no), self.index.date(commit_no)]
+
+
+class AuthorshipList(collections.abc.Sequence):
+    """List of authorship data for commits, backed by a CommitIndex.
+
+    Elements are dictionaries with keys 'author' and 'authordate'.
+
+    """
+
+    def __init__(self, index):
+
+        self.index = index
+
+    def __len__(self):
+
+        return len(self.index)
+
+    def __getitem__(self, commit_no):
+
+        if isinstance(commit_no, slice):
+            return [self[no] for no in range(*commit_no.indices(len(self)))]
+        if commit_no < 0:
+            commit_no += len(self)
+        if not 0 <= commit_no < len(self):
+            raise IndexError('commit number out of range', commit_no)
+        return {'author': self.index.author(commit_no),
+                'authordate': self.index.author_date(commit_no)}
+
+
+class EffortIndex:
+    """Index for computing normalized effort for ranges of commits.
+
+    Normalized effort between two commits is the number of distinct
+    (author, day) pairs for commits in that range, with days in the
+    time zone of the author date (see Metrics.normalized_effort).
+
+    The index is built once for a CommitIndex. It has a column with
+    the (author, day) pair of each commit (as an id), and a column
+    with the number of the next commit with the same pair (or the
+    number of commits, if there is none). The number of distinct pairs
+    in the range [left, right] is then the number of commits in it
+    whose next commit with the same pair is beyond right, which needs
+    no parsing of dates, and no dictionaries. If NumPy is available,
+    it is used for counting.
+
+    :param index: CommitIndex
+
+    """
+
+    def __init__(self, index):
+
+        commits = len(index)
+        # Day of each commit (days since the epoch, in author's time zone)
+        self.days = array.array('l', ((date + offset * 60) // 86400
+                                        for (date, offset)
+                                        in zip(index.author_dates,
+                                                index.author_offsets)))
+        pair_ids = {}
+        self.author_days = array.array('l', (pair_ids.setdefault(pair,
+                                                                len(pair_ids))
+                                        for pair in zip(index.author_ids,
+                                                        self.days)))
+        self.next = array.array('q', [commits]) * commits
+        last_seen = {}
+        for commit_no in range(commits - 1, -1, -1):
+            pair = self.author_days[commit_no]
+            self.next[commit_no] = last_seen.get(pair, commits)
+            last_seen[pair] = commit_no
+        if numpy is not None:
+            self.next = numpy.frombuffer(self.next, dtype=numpy.int64)
+
+    def __len__(self):
+
+        return len(self.next)
+
+    def effort(self, left, right):
+        """Normalized effort for the commits in [left, right].
+
+        :param left:  first commit number
+        :param right: last commit number
+        :returns:     number of distinct (author, day) pairs
+
+        """
+
+        if left > right:
+            return 0
+        if numpy is not None:
+            return int(numpy.count_nonzero(self.next[left:right+1] > right))
+        return sum(1 for next in self.next[left:right+1] if next > right)
+
+    def efforts(self, lefts, right=None):
+        """Normalized effort for several ranges ending in the same commit.
+
+        Efforts for all ranges are computed in a single pass, from the
+        first of lefts to right.
+
+        :param lefts: list of first commit numbers
+        :param right: last commit number (default None, last commit)
+        :returns:     list of efforts, one for each element of lefts
+
+        """
+
+        if right is None:
+            right = len(self) - 1
+        lefts = list(lefts)
+        start = min([left for left in lefts if left <= right], default=right+1)
+        # counts[n] is the effort for [start + n, right]
+        if numpy is not None:
+            last = (self.next[start:right+1] > right)[::-1]
+            counts = numpy.cumsum(last)[::-1].tolist()
+        else:
+            counts = []
+            count = 0
+            for next in reversed(self.next[start:right+1]):
+                if next > right:
+                    count += 1
+                counts.append(count)
+            counts.reverse()
+        return [counts[left-start] if left <= right else 0 for left in lefts]
+
 
 class Repo:
     """Metainformation about a git repository.
 
-    This class abstracts a git upstream reposory, by using Perceval.
+    This class abstracts a git upstream reposory.
 
     Upon instantiation of and object in this class, the specified
-    upstream repository is cloned in the specified local directory.
-    Then, Perceval is used again to obtain the list of
-    its commits. The object offers a method for checking out any of
+    upstream repository is cloned in the specified local directory
+    (or updated, if it was already cloned by Repo; see _clone). Then, git log is used
+    to obtain the list of its commits (see CommitIndex). The object
+    offers a method for checking out any of
     those commits as well, and copying the resulting checkout to
     a certain 'storage'directory.
 
@@ -225,18 +1411,21 @@ class Repo:
     By default, only commits from master branch are considered, but
     a list of branches to consider can be provided when instantiating.
 
-    Objects in this class may maintain as well a file cache, using Shelve,
-    with the list of commits, so that there is no need to recompute them if
-    the cache can be read. This is only done if the cache argument is
-    provided when instantiating an object. The cache is maintained so that
-    either the complete list of commits is in it, or no commit is available
-    at all. This is so because it only makes sense to maintain the cache
-    if there is no need to parse git log again.
-
-    Each object maintains the list of commits for its repository. For
-    each commit, a list [hash, commit_date] is maintanined. The order is
-    the one provided by Perceval, which corresponds to the order by
-    git log, in reverse order.
+    Objects in this class may maintain as well a file cache with the index
+    of commits (see CommitIndex.save), so that there is no need to parse
+    all of git log again. This is only done if the cache argument is
+    provided when instantiating an object. When the cache is read,
+    only commits new since it was written are read from git log, and
+    appended to it (so that numbers of commits in the cache don't change).
+    If the history of the branches was rewritten, or the cache was built
+    for other after or branches, the cache is rebuilt.
+
+    Each object maintains the index of commits for its repository,
+    in self.index (see CommitIndex). On top of it, self.commits is
+    a list with an element per commit, [hash, commit_date], and
+    self.authorship a list with an element per commit, a dictionary
+    with 'author' and 'authordate'. The order is that of git log,
+    in reverse order.
 
     :param url:      url of upstream git repository
     :type url:       string
@@ -251,6 +1440,11 @@ class Repo:
 
     """
 
+    # Maximum number of trees (including subtrees) in the cache of trees
+    # read, and of trees with symbolic links resolved (see read_tree, tree)
+    trees_size = 20000
+    resolved_trees_size = 100
+
     def __init__(self, url, dir, after=None, branches=["master"], cache=None):
 
         self.url = url
@@ -263,41 +1457,73 @@ class Repo:
 
         # Get the git repository always, to be able of checking out later,
         # if needed
-        parser = perceval.backends.git.Git(uri=self.url, gitpath=self.dir)
+        with profiling.phase('repo.clone'):
+            self._clone()
 
-        # The cache is ok if the calue for 'done' is True
-        cache_ok = False
+        # Get commits from the cache (updating it with new commits, if any),
+        # or from the repo (git log)
+        self.index = None
         if cache is not None:
-            cache_data = shelve.open(cache)
-            if 'done' in cache_data and cache_data['done']:
-                cache_ok = True
-
-        # Get commits from the cache (if ok) or from the repo (via Perceval)
-        if cache_ok:
-            self.commits = cache_data['commits']
-            self.authorship = cache_data['authorship']
-        else:
-            self.commits = []
-            self.authorship = []
-            commits_fetcher = parser.fetch(from_date = self.after,
-                                            branches=self.branches)
-            for item in commits_fetcher:
-                self.commits.append([item['data']['commit'],
-                                    item['data']['CommitDate']])
-                author = {
-                    'author': item['data']['Author'],
-                    'authordate': item['data']['AuthorDate']
-                    }
-                self.authorship.append(author)
-
-        # Store data in the cache, if needed
-        if cache is not None:
-            if not cache_ok:
-                cache_data['commits'] = self.commits
-                cache_data['authorship'] = self.authorship
-                cache_data['done'] = True
-            cache_data.close()
+            self.index = CommitIndex.load(cache)
+            if self.index is not None and (self.index.after != after
+                                        or self.index.branches != branches):
+                self.index = None
+        changed = True
+        with profiling.phase('repo.log'):
+            if self.index is not None:
+                added = self.index.update(self.dir)
+                if added is None:
+                    logging.info("History rewritten, rebuilding commit cache")
+                    self.index = None
+                else:
+                    logging.info("Commits added to the commit cache: %d" % added)
+                    changed = added > 0
+                    profiling.count('commit_cache.hits')
+            if self.index is None:
+                profiling.count('commit_cache.misses')
+                self.index = CommitIndex.from_git(self.dir, after=after,
+                                                branches=self.branches)
+            if cache is not None and changed:
+                self.index.save(cache)
+        profiling.count('repo.commits', len(self.index))
+        self.commits = CommitList(self.index)
+        self.authorship = AuthorshipList(self.index)
+        self.effort = None
+        # Process for reading git objects (git cat-file --batch),
+        # started when first needed, and caches of trees already read
+        # (and of trees with symbolic links resolved, by hash of the tree)
+        self._cat_file = None
+        self.trees = LRUMemo(self.trees_size)
+        self.resolved_trees = LRUMemo(self.resolved_trees_size)
+
+
+    def _clone(self):
+        """Clone the repository, or update it if it was cloned by Repo.
+
+        Repositories cloned by Repo are marked as such in their git
+        configuration (techlag.cloned). Only those are updated from
+        their origin remote, and then reset to it, so that their working
+        directory is in a known state. Other repositories (for example,
+        a repository of the user, with dir the same as url) are left
+        as they are: commits are read from them, but they are not fetched,
+        and their working directory is not touched.
 
+        """
+
+        if not os.path.exists(self.dir):
+            logging.info("Cloning %s in %s" % (self.url, self.dir))
+            subprocess.check_call(['git', 'clone', '--quiet', self.url, self.dir])
+            subprocess.check_call(['git', '-C', self.dir, 'config',
+                                    'techlag.cloned', 'true'])
+        elif subprocess.call(['git', '-C', self.dir, 'config', '--get',
+                                '--bool', 'techlag.cloned'],
+                            stdout=subprocess.DEVNULL) != 0:
+            logging.info("Not updating %s (not cloned by Repo)" % self.dir)
+            return
+        subprocess.check_call(['git', '-C', self.dir, 'fetch', '--quiet',
+                                'origin'])
+        subprocess.check_call(['git', '-C', self.dir, 'reset', '--quiet',
+                                '--hard', 'origin'])
 
     def get_commits (self):
         """Get list of commits.
@@ -310,6 +1536,17 @@ class Repo:
 
         return self.commits
 
+    def effort_index (self):
+        """Get the index for computing normalized effort (see EffortIndex).
+
+        The index is built the first time it is needed.
+
+        """
+
+        if self.effort is None:
+            self.effort = EffortIndex(self.index)
+        return self.effort
+
     def last_commit (self):
         """Get last commit number.
 
@@ -321,39 +1558,175 @@ class Repo:
 
         return len(self.commits) - 1
 
-    def checkout(self, commit_no, copy=None):
-        """Checkout the version of the repository corresponding to commit_no.
+    def checkout(self, commit_no, copy=None):
+        """Checkout the version of the repository corresponding to commit_no.
+
+        If copy is None, just checkout the commit in the repo itself,
+        but don't copy it to a directory.
+
+        If copy is not None, it will be the directory for storage,
+        where a copy of the checkout will be produced (excluding the
+        .git subdirectory). If the directory does already exist,
+        no checkout will be done: its contents will be assumed to
+        be that checkout. If the directory does not exist, it will be
+        created, and git archive will be used, which means that the
+        repository will not be really checked out (it will remain in
+        the same commit as it was before calling this function).
+
+        :param commit_no: commit number to check out
+        :param copy:      directory to copy the checkout to (default: None)
+        :returns:         path of directory with the checkout, or None if none
+
+        """
+
+        hash = self.commits[commit_no][0]
+        if copy is None:
+            with profiling.phase('repo.checkout'):
+                subprocess.call(["git", "-C", self.dir, "checkout", hash],
+                        stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+            return None
+        elif not os.path.isdir(copy):
+            os.makedirs(copy)
+            with profiling.phase('repo.checkout'):
+                subprocess.check_call("git -C " + shlex.quote(self.dir) \
+                                    + " archive --format tar " + hash \
+                                    + " | tar -x -C " + shlex.quote(copy),
+                                    shell=True)
+        return copy
+
+    def __getstate__(self):
+        """Get state for pickling (the cat-file process can't be pickled,
+        and caches of trees are not pickled)
+
+        """
+
+        state = self.__dict__.copy()
+        state['_cat_file'] = None
+        state['trees'] = LRUMemo(self.trees_size)
+        state['resolved_trees'] = LRUMemo(self.resolved_trees_size)
+        return state
+
+    def add_worktree(self, dir):
+        """Add a git worktree for the repository, in dir.
+
+        The worktree is detached, and can be used to check out commits
+        independently of the checkout in the repository itself.
+
+        :param dir: directory for the worktree (should not exist)
+
+        """
+
+        subprocess.check_call(["git", "-C", self.dir, "worktree", "add",
+                                "--detach", dir, self.commits[-1][0]],
+                        stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+
+    def prune_worktrees(self):
+        """Prune information about worktrees which were removed.
+
+        """
+
+        subprocess.call(["git", "-C", self.dir, "worktree", "prune"],
+                        stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+
+    def read_object(self, name):
+        """Read an object from the git repository.
+
+        Objects are read via a git cat-file --batch process, which is
+        started the first time an object is read, and kept running
+        afterwards, so that reading objects is cheap.
+
+        :param name: name of the object (hash, or any git revision expression)
+        :returns:    tuple (hash, type, content)
+
+        """
+
+        if self._cat_file is None:
+            self._cat_file = subprocess.Popen(
+                ["git", "-C", self.dir, "cat-file", "--batch"],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self._cat_file.stdin.write(name.encode() + b'\n')
+        self._cat_file.stdin.flush()
+        header = self._cat_file.stdout.readline().split()
+        if len(header) != 3:
+            raise ValueError("Object not found in git repository", name)
+        (hash, type, size) = header
+        content = self._cat_file.stdout.read(int(size) + 1)[:-1]
+        profiling.count('repo.objects')
+        profiling.count('repo.bytes_read', len(content))
+        return (hash.decode(), type.decode(), content)
+
+    def read_blob(self, hash):
+        """Read the content of a blob (a file) from the git repository.
+
+        :param hash: hash of the blob
+        :returns:    content of the blob (bytes)
+
+        """
+
+        return self.read_object(hash)[2]
+
+    def read_tree(self, name):
+        """Read a tree (recursively) from the git repository.
+
+        Trees are cached by hash, so that subtrees which are the same
+        in several commits are usually read once, and are the same object.
+        The cache is bounded (see trees_size): the least recently used
+        trees are removed from it, and read again if needed.
+        Submodules are considered as empty directories, since that is
+        how they appear in a checkout. Symbolic links are considered as
+        files, with the link as content, and are noted in the links
+        of the tree (see Tree, and resolve_links).
+
+        :param name: name of the tree (hash, or any git revision expression)
+        :returns:    Tree object
+
+        """
+
+        if name in self.trees:
+            return self.trees[name]
+        (hash, type, content) = self.read_object(name)
+        if hash in self.trees:
+            return self.trees[hash]
+        assert type == 'tree'
+        tree = Tree(hash=hash)
+        pos = 0
+        while pos < len(content):
+            end = content.index(b'\0', pos)
+            (mode, entry_name) = content[pos:end].split(b' ', 1)
+            entry_hash = content[end+1:end+21].hex()
+            pos = end + 21
+            entry_name = os.fsdecode(entry_name)
+            if mode == b'40000':
+                tree[entry_name] = self.read_tree(entry_hash)
+                tree.has_links |= tree[entry_name].has_links
+            elif mode == b'160000':
+                tree[entry_name] = Tree()
+            else:
+                tree[entry_name] = entry_hash
+                if mode == b'120000':
+                    tree.links.add(entry_name)
+                    tree.has_links = True
+        self.trees[hash] = tree
+        return tree
 
-        If copy is None, just checkout the commit in the repo itself,
-        but don't copy it to a directory.
+    def tree(self, commit_no):
+        """Get the tree of files for commit_no, without checking it out.
 
-        If copy is not None, it will be the directory for storage,
-        where a copy of the checkout will be produced (excluding the
-        .git subdirectory). If the directory does already exist,
-        no checkout will be done: its contents will be assumed to
-        be that checkout. If the directory does not exist, it will be
-        created, and git archive will be used, which means that the
-        repository will not be really checked out (it will remain in
-        the same commit as it was before calling this function).
+        Symbolic links are resolved (see resolve_links), so that the
+        tree has the same files a checkout would have.
 
-        :param commit_no: commit number to check out
-        :param copy:      directory to copy the checkout to (default: None)
-        :returns:         path of directory with the checkout, or None if none
+        :param commit_no: commit number
+        :returns:         Tree object
 
         """
 
-        hash = self.commits[commit_no][0]
-        if copy is None:
-            subprocess.call(["git", "-C", self.dir, "checkout", hash],
-                        stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
-            return None
-        elif not os.path.isdir(copy):
-            os.makedirs(copy)
-            subprocess.check_call("git -C " + shlex.quote(self.dir) \
-                                + " archive --format tar " + hash \
-                                + " | tar -x -C " + shlex.quote(copy),
-                                shell=True)
-        return copy
+        tree = self.read_tree(self.commits[commit_no][0] + '^{tree}')
+        if not tree.has_links:
+            return tree
+        if tree.hash not in self.resolved_trees:
+            self.resolved_trees[tree.hash] = resolve_links(tree,
+                                                            self.read_blob)
+        return self.resolved_trees[tree.hash]
 
 
 class BaseDir():
@@ -374,71 +1747,95 @@ class BaseDir():
     the metrics computed, read comments for the compare function. By default,
     metrics of kind 'diff' will be produced.
 
-    Objects in this class maintain a in-memory cache of the number of lines
-    of each file in dir which is computed. Usually, those files are computed
+    When instantiated, the directory is read once, producing its
+    Manifest (paths, sizes, blob hashes and number of lines of all files),
+    and all comparisons are done against it, so that the directory is not
+    read again. If manifest is the path of a file, the manifest is loaded
+    from it if it exists, or saved to it otherwise, so that later runs
+    don't need to read the directory either (see manifest_path).
+
+    Objects in this class record as well the number of lines of each file
+    in dir which is counted in comparisons. Usually, those files are counted
     when they are found to be exactly equal to the version in the directory
     being compared (to increment the number of equal lines), or when it is
     found to be only inn dir (to increment the number of different lines).
 
+    The 'engine' instantiation parameter is the engine used for counting
+    lines added, removed and equal in files which are different
+    (see techlag.diffstat).
+
+    Objects in this class maintain as well a cache of the number of
+    lines for each blob hash computed (see compare_tree). By default, this
+    cache is in-memory, and specific for each object. But a lines_cache
+    can be provided, which can be shared by several objects, and
+    may be persistent (see techlag.cache.LinesCache).
+
+    If the directory is not on disk, but there is a pack of blobs for
+    it (see pack_path), and its manifest, contents of files are read
+    from the pack (for example, for Debian source packages read with
+    techlag.dpkg.read_dpkg, without extracting them).
+
+    Instead of a directory, the base directory can be a Tree (for
+    example, the tree of a commit in a git repository). In that case,
+    the tree and a function to read its blobs should be provided when
+    instantiating, and only compare_tree can be used for comparing.
+    No manifest is produced in this case.
+
     :param name: name (full path) of directory to compare
     :param metrics: metrics to produce when comparing (list)
+    :param engine: engine for counting differences in files
+    :param lines_cache: cache for number of lines, by blob hash
+    :param tree: Tree to use as base directory (default None)
+    :param read_blob: function to read blobs in tree, given their hash
+    :param manifest: path of the file with the manifest (default None)
 
     """
 
-    def __init__(self, name, metrics=['diff']):
+    def __init__(self, name, metrics=['diff'], engine=diffstat.DEFAULT_ENGINE,
+                lines_cache=None, tree=None, read_blob=None, manifest=None):
         for metric in metrics:
             assert metric in ['diff', 'same']
+        assert engine in diffstat.ENGINES
         self.dir = name
         self.metrics = metrics
-        # Cache for metrics of unique files in self.dir
+        self.engine = engine
+        # Number of lines of files in self.dir counted in comparisons,
+        # by path (see _count_entries)
         self.lines = {}
-
-    def count_files(self, dir, files, use_cache=False):
-        """Count some files in a directory, and their number of lines
-
-        Given a list of files in a directory, count them (number of
-        elements in the list) and count the lines in all of them.
-
-        If use_cache is True, use an in-memory cache to store the
-        result for each file computed. Please note that this only make
-        sense if the directory in which those files are is always the
-        same. Therefore it is used usually only with files corresp0nding
-        to the directory managed by the object. Usually it is an error
-        to have use_cache True for a directory which is not the managed
-        directory.
-
-        :param files:     files to compute
-        :param dir:       directory with files (default, None)
-        :param use_cache: use cache for files computed (default False)
-        :returns:         tuple [number of files, total lines in those files]
-
-        """
-
-        num_files = len(files)
-        num_lines = 0
-        for file in files:
-            name = os.path.join(dir, file)
-            if os.path.isfile(name):
-                if use_cache and (name in self.lines):
-                    # Get result from cache
-                    file_lines = self.lines[name]
-                    logging.debug("Computed file from cache: %s (lines: %d)" %
-                                (name, file_lines))
-                else:
-                    with open(name, encoding="ascii", errors="surrogateescape") as f:
-                        file_lines = sum(1 for line in f)
-                    logging.debug("Counted file: %s (lines: %d)" % (name, file_lines))
-                    if use_cache:
-                        logging.debug("Counted file to cache: %s (lines: %d)" %
-                                        (name, file_lines))
-                        self.lines[name] = file_lines
-                num_lines += file_lines
-        logging.debug ("Counted files in dir %s: files: %d, lines: %d"
-            % (dir, num_files, num_lines))
-        return (num_files, num_lines)
+        # Cache for number of lines in blobs, and for comparison of
+        # pairs of blobs (left, right), used by compare_tree
+        if lines_cache is None:
+            self.blob_lines = {}
+        else:
+            self.blob_lines = lines_cache
+        self.blob_diffs = {}
+        # Manifest and Tree for self.dir (with blob hashes for files),
+        # and path for each blob
+        self.manifest = None
+        self.tree = tree
+        self.blob_paths = {}
+        self.pack = None
+        if read_blob is not None:
+            self.read_blob = read_blob
+        if tree is None:
+            self.manifest = self._get_manifest(manifest)
+            self.tree = self.manifest.tree()
+            self.blob_paths = self.manifest.blob_paths(self.dir)
+            if not os.path.isdir(self.dir) \
+                    and os.path.exists(pack_path(self.dir)):
+                self.pack = BlobPack(pack_path(self.dir))
+            for (size, blob, lines) in self.manifest.files.values():
+                if lines is not None:
+                    self.blob_lines[blob] = lines
+        # Cache for metrics of subtrees, see _compare_trees
+        self.tree_metrics = {}
+        # Cache for screening metrics of subtrees, and number of files
+        # in subtrees, see screen_tree
+        self.tree_screens = {}
+        self.tree_files = {}
 
     @staticmethod
-    def compare_files(file_left, file_right):
+    def compare_files(file_left, file_right, engine=diffstat.DEFAULT_ENGINE):
         """Compare two files.
 
         Compares two files, given their paths. Checks if they are equal
@@ -447,37 +1844,38 @@ class BaseDir():
         a tuple, with the first element being 1 (if different) or 0 (if equal),
         and then the number of lines added, lines removed, and lines equal.
 
-        Uses a difflib Differ to do the job.
+        Uses the engine specified (see techlag.diffstat) to do the job.
 
         :param file_left: left file to compare
         :param file_right: left file to compare
+        :param engine: engine for counting differences
         :returns: tuple [equality_check, added, removed, equal]
 
         """
 
-        added = 0
-        removed = 0
-        equal = 0
         with open(file_left,'r', encoding="ascii", errors="surrogateescape") as left, \
             open(file_right,'r', encoding="ascii", errors="surrogateescape") as right:
-            differ = difflib.Differ()
-            diff = differ.compare(left.readlines(), right.readlines())
-
-            for line in diff:
-                if line.startswith('+'):
-                    added += 1
-                elif line.startswith('-'):
-                    removed += 1
-                elif line.startswith(' '):
-                    equal += 1
-        if (added + removed) > 0:
-            different = 1
-        else:
-            different = 0
-        return (different, added, removed, equal)
+            return BaseDir.compare_lines(left.readlines(), right.readlines(),
+                                        engine=engine)
+
+    @staticmethod
+    def compare_lines(lines_left, lines_right, engine=diffstat.DEFAULT_ENGINE):
+        """Compare two lists of lines.
+
+        Same as compare_files, but for the lines of the files, already read.
+
+        :param lines_left: lines of left file to compare
+        :param lines_right: lines of right file to compare
+        :param engine: engine for counting differences
+        :returns: tuple [equality_check, added, removed, equal]
+
+        """
+
+        return diffstat.diff_stat(lines_left, lines_right, engine=engine)
 
     @classmethod
-    def count_diff(cls, dir_left, dir_right, files):
+    def count_diff(cls, dir_left, dir_right, files,
+                    engine=diffstat.DEFAULT_ENGINE):
         """Count differences in files present in two directories.
 
         Given a list of files supposed to be present in two directories,
@@ -491,6 +1889,7 @@ class BaseDir():
         :param dir_left:  left directory to consider
         :param dir_right: right directory to consider
         :param files:     files to compute, supposed to be in both directories
+        :param engine:    engine for counting differences
         :returns:         tuple [diff_files, added, removed, changed]
         """
 
@@ -502,50 +1901,35 @@ class BaseDir():
             name_left = os.path.join(dir_left, file)
             name_right = os.path.join(dir_right, file)
             (diff, added_l, removed_l, equal_l) = \
-                cls.compare_files(name_left, name_right)
+                cls.compare_files(name_left, name_right, engine=engine)
             diff_files += diff
             added += added_l
             removed += removed_l
             equal += equal_l
         return (diff_files, added, removed, equal)
 
-    def _compare_dirs(self, dcmp):
-        """Compare two directories given their filecmp.dircmp object.
+    def _get_manifest(self, path=None):
+        """Get the Manifest for self.dir.
 
-        This function is needed to search recursively, using dcmp objects,
-        all the subdirs common in both of the directories being commpared.
+        If path is not None, the manifest is loaded from it if it exists
+        (and has the current version), or saved to it after reading
+        self.dir otherwise.
 
-        Produces as a result a dictionary with metrics about the comparison
-        (see compare function for details), aggregated for the directory
-        corresponding to dcmp, and all the common subdirectories.
-
-        When this function is called by compare, as usual, the file on
-        the left is self.dir.
-
-        :param dcmp: filecmp.dircmp object for directories to compare
-        :returns:    dictionary with comparison metrics
+        :param path: path of the file with the manifest (default None)
+        :returns:    Manifest object
 
         """
 
-        logging.debug('Comparing dirs: ' + dcmp.left + ', ' + dcmp.right)
-        m = {}
-        if 'diff' in self.metrics:
-            (m["left_files"], m["left_lines"]) \
-                = self.count_files(dir = dcmp.left, files = dcmp.left_only,
-                                    use_cache=True)
-            (m["right_files"], m["right_lines"]) \
-                = self.count_files(dir = dcmp.right, files = dcmp.right_only)
-        if 'same' in self.metrics:
-            (m["same_files"], m["same_lines"]) \
-                = self.count_files(dir = dcmp.left, files = dcmp.same_files,
-                                    use_cache=True)
-        (m['diff_files'], m['added_lines'], m['removed_lines'], m['equal_lines']) \
-            = self.count_diff(dcmp.left, dcmp.right, dcmp.diff_files)
-        for sub_dcmp in dcmp.subdirs.values():
-            m_subdir = self._compare_dirs(sub_dcmp)
-            for metric, value in m_subdir.items():
-                m[metric] += value
-        return m
+        if path is not None and os.path.exists(path):
+            manifest = Manifest.load(path)
+            if manifest is not None:
+                logging.debug("Manifest loaded: " + path)
+                return manifest
+        manifest = Manifest.from_dir(self.dir)
+        if path is not None:
+            manifest.save(path)
+            logging.debug("Manifest saved: " + path)
+        return manifest
 
     def compare(self, dir):
         """Compare the base directory with name directory
@@ -577,13 +1961,226 @@ class BaseDir():
         Theh results produced by the function is a dictionary with the metrics
         corresponding to the metrics_kinds specified when instantiating the object.
 
-        :param dir: name (full path) of directory to compare
-        :returns:   dictionary with comparison metrics
+        Files are compared by their blob hashes: the directory to compare
+        is read (and its files hashed) to produce its Manifest, but
+        the base directory is not read again (its manifest is used).
+        Lines of files are read only for files which are different.
+
+        :param dir:  name (full path) of directory to compare
+        :returns:    dictionary with comparison metrics
+
+        """
+
+        manifest = Manifest.from_dir(dir, lines=False)
+        paths = manifest.blob_paths(dir)
+
+        def read_blob(hash):
+            with open(paths[hash], 'rb') as f:
+                return f.read()
+
+        m = self._compare_trees(self.tree, manifest.tree(),
+                                self.read_blob, read_blob, path=self.dir)
+        self._summary_metrics(m)
+        logging.debug("BaseDir.compare(): " + str(m))
+        return m
+
+    def get_tree(self):
+        """Get the Tree for self.dir.
+
+        """
+
+        return self.tree
+
+    def fingerprint(self):
+        """Fingerprint of the contents of self.dir.
+
+        The fingerprint is a hash of the names of all entries in self.dir,
+        and the blob hashes of all files. Therefore, two directories with
+        the same fingerprint will produce the same comparison metrics.
+
+        :returns: fingerprint (hexadecimal string)
+
+        """
+
+        def update(sha, tree):
+            for name in sorted(tree):
+                entry = tree[name]
+                sha.update(os.fsencode(name) + b'\0')
+                if isinstance(entry, Tree):
+                    sha.update(b'tree\0')
+                    update(sha, entry)
+                    sha.update(b'end\0')
+                else:
+                    sha.update(str(entry).encode() + b'\0')
+
+        sha = hashlib.sha1()
+        update(sha, self.get_tree())
+        return sha.hexdigest()
+
+    def read_blob(self, hash):
+        """Read the content of a file in self.dir, given its blob hash.
+
+        :param hash: git blob hash for the file
+        :returns:    content of the file (bytes)
+
+        """
+
+        if self.pack is not None:
+            data = self.pack.read(hash)
+        else:
+            with open(self.blob_paths[hash], 'rb') as f:
+                data = f.read()
+        profiling.count('basedir.bytes_read', len(data))
+        return data
+
+    def _blob_lines(self, hash, read_blob):
+        """Number of lines of a blob, using the cache if possible.
+
+        :param hash:      blob hash
+        :param read_blob: function to read the blob, given its hash
+        :returns:         number of lines
+
+        """
+
+        lines = self.blob_lines.get(hash)
+        if lines is None:
+            profiling.count('lines.misses')
+            data = read_blob(hash)
+            with profiling.phase('basedir.count_lines'):
+                lines = count_lines(data)
+            self.blob_lines[hash] = lines
+        else:
+            profiling.count('lines.hits')
+        return lines
+
+    def _count_entries(self, tree, names, read_blob, path=None):
+        """Count entries in a tree, and the number of lines of its files
+
+        Directories, and entries which are not files, are counted,
+        but add no lines.
+
+        If path is not None, it is the path of the directory for the
+        tree in self.dir, and lines counted are recorded in self.lines.
+
+        :param tree:      Tree with the entries
+        :param names:     names of entries to count
+        :param read_blob: function to read blobs in the tree, given their hash
+        :param path:      path of the directory for the tree (default None)
+        :returns:         tuple [number of entries, total lines in those files]
+
+        """
+
+        num_lines = 0
+        for name in names:
+            if isinstance(tree[name], str):
+                file_lines = self._blob_lines(tree[name], read_blob)
+                if path is not None:
+                    self.lines[os.path.join(path, name)] = file_lines
+                num_lines += file_lines
+        return (len(names), num_lines)
+
+    def _compare_blobs(self, left, right, read_left, read_right):
+        """Compare two blobs, using the cache if possible.
+
+        :param left:       left blob hash
+        :param right:      right blob hash
+        :param read_left:  function to read the left blob
+        :param read_right: function to read the right blob
+        :returns:          tuple [equality_check, added, removed, equal]
+
+        """
+
+        if (left, right) not in self.blob_diffs:
+            profiling.count('diffs.misses')
+            (data_left, data_right) = (read_left(left), read_right(right))
+            with profiling.phase('basedir.diff'):
+                self.blob_diffs[(left, right)] = self.compare_lines(
+                    read_lines(data_left), read_lines(data_right),
+                    engine=self.engine)
+        else:
+            profiling.count('diffs.hits')
+        return self.blob_diffs[(left, right)]
+
+    def _compare_trees(self, left, right, read_left, read_right, path=None):
+        """Compare two trees, producing the metrics explained in compare.
+
+        Files are considered equal if their blob hashes are equal, and
+        therefore only files with different blob hashes are read.
+        Entries ignored by filecmp.dircmp are ignored here too, and,
+        as filecmp.dircmp does, entries which are a file in one tree,
+        and a directory in the other, are not considered.
+
+        Metrics for trees with a git hash on the right are cached in
+        self.tree_metrics, so that subtrees not changed from a previously
+        compared tree are not compared again. Therefore, comparing a
+        tree close to another one already compared (for example, the
+        tree for the next commit) only needs to compare the subtrees
+        including changed files.
+
+        :param left:       left Tree
+        :param right:      right Tree
+        :param read_left:  function to read blobs in left tree, given their hash
+        :param read_right: function to read blobs in right tree, given their hash
+        :param path:       path of the directory for left tree in self.dir
+                           (default None, see _count_entries)
+        :returns:          dictionary with comparison metrics
+
+        """
+
+        if right.hash is not None:
+            key = (left.hash or id(left), right.hash)
+            if key in self.tree_metrics:
+                return dict(self.tree_metrics[key])
+        left_names = set(left) - IGNORED_NAMES
+        right_names = set(right) - IGNORED_NAMES
+        m = {}
+        if 'diff' in self.metrics:
+            (m["left_files"], m["left_lines"]) = self._count_entries(
+                left, left_names - right_names, read_left, path)
+            (m["right_files"], m["right_lines"]) = self._count_entries(
+                right, right_names - left_names, read_right)
+        same = []
+        diff_files = []
+        subdirs = []
+        for name in left_names & right_names:
+            (left_entry, right_entry) = (left[name], right[name])
+            if isinstance(left_entry, str) and isinstance(right_entry, str):
+                if left_entry == right_entry:
+                    same.append(name)
+                else:
+                    diff_files.append(name)
+            elif isinstance(left_entry, Tree) and isinstance(right_entry, Tree):
+                subdirs.append(name)
+        if 'same' in self.metrics:
+            (m["same_files"], m["same_lines"]) = self._count_entries(
+                left, same, read_left, path)
+        (m['diff_files'], m['added_lines'], m['removed_lines'], m['equal_lines']) \
+            = (0, 0, 0, 0)
+        for name in diff_files:
+            (diff, added_l, removed_l, equal_l) = self._compare_blobs(
+                left[name], right[name], read_left, read_right)
+            m['diff_files'] += diff
+            m['added_lines'] += added_l
+            m['removed_lines'] += removed_l
+            m['equal_lines'] += equal_l
+        for name in subdirs:
+            subpath = os.path.join(path, name) if path is not None else None
+            m_subdir = self._compare_trees(left[name], right[name],
+                                            read_left, read_right, subpath)
+            for metric, value in m_subdir.items():
+                m[metric] += value
+        if right.hash is not None:
+            self.tree_metrics[key] = dict(m)
+        return m
+
+    def _summary_metrics(self, m):
+        """Add summary metrics to those produced when comparing directories.
+
+        :param m: dictionary with comparison metrics (modified in place)
+        :returns: dictionary with comparison metrics
 
         """
 
-        dcmp = filecmp.dircmp(self.dir, dir)
-        m = self._compare_dirs(dcmp)
         if 'diff' in self.metrics:
             m["different_files"] = (m["left_files"] + m["right_files"]) // 2 \
                     + m["diff_files"]
@@ -592,9 +2189,216 @@ class BaseDir():
         if 'same' in self.metrics:
             m['common_files'] = m['same_files']
             m['common_lines'] = m['same_lines'] + m['equal_lines']
-        logging.debug("BaseDir.compare(): " + str(m))
         return m
 
+    def compare_tree(self, tree, read_blob):
+        """Compare the base directory with a tree (usually from a git repository)
+
+        Produces the same metrics as compare (see comments in it), but
+        comparing with a Tree object, such as those produced by
+        Repo.tree, instead of with a directory. This means that
+        there is no need for checking out the tree: files with the same
+        blob hash are known to be equal, and only files with different
+        blob hashes (and files only in the tree, for 'diff' metrics) are read,
+        by using read_blob.
+
+        The base directory is not read: its Manifest (or the Tree
+        provided when instantiating) is used.
+
+        :param tree:      Tree to compare
+        :param read_blob: function to read blobs in tree, given their hash
+        :returns:         dictionary with comparison metrics
+
+        """
+
+        path = self.dir if self.manifest is not None else None
+        m = self._compare_trees(self.tree, tree, self.read_blob, read_blob,
+                                path=path)
+        self._summary_metrics(m)
+        logging.debug("BaseDir.compare_tree(): " + str(m))
+        return m
+
+    def _count_tree_files(self, tree):
+        """Count files in a tree, including those in its subtrees.
+
+        :param tree: Tree
+        :returns:    number of files
+
+        """
+
+        key = tree.hash or id(tree)
+        if key not in self.tree_files:
+            files = 0
+            for name in set(tree) - IGNORED_NAMES:
+                if isinstance(tree[name], str):
+                    files += 1
+                elif isinstance(tree[name], Tree):
+                    files += self._count_tree_files(tree[name])
+            self.tree_files[key] = files
+        return self.tree_files[key]
+
+    def _screen_trees(self, left, right):
+        """Count files with the same path, and with the same path and blob.
+
+        Results for subtrees are cached in self.tree_screens, the
+        same way _compare_trees does.
+
+        :param left:  left Tree
+        :param right: right Tree
+        :returns:     tuple (files with same path, files with same blob)
+
+        """
+
+        key = (left.hash or id(left), right.hash or id(right))
+        if key in self.tree_screens:
+            return self.tree_screens[key]
+        (common_paths, same_blobs) = (0, 0)
+        for name in (set(left) & set(right)) - IGNORED_NAMES:
+            (left_entry, right_entry) = (left[name], right[name])
+            if isinstance(left_entry, str) and isinstance(right_entry, str):
+                common_paths += 1
+                if left_entry == right_entry:
+                    same_blobs += 1
+            elif isinstance(left_entry, Tree) and isinstance(right_entry, Tree):
+                (paths, blobs) = self._screen_trees(left_entry, right_entry)
+                common_paths += paths
+                same_blobs += blobs
+        if right.hash is not None:
+            self.tree_screens[key] = (common_paths, same_blobs)
+        return (common_paths, same_blobs)
+
+    def screen_tree(self, tree):
+        """Compute cheap similarity metrics with a tree.
+
+        These metrics are computed only from names and blob hashes of
+        files (as git ls-tree would list them), with no file being read.
+        Therefore, they are much cheaper than those computed by compare,
+        and can be used for screening a lot of trees, before computing
+        the full metrics only for the most similar ones:
+
+        * same_blobs: number of files with the same path and blob hash
+        * common_paths: number of files with the same path
+        * jaccard: Jaccard similarity of the sets of paths of files
+        (common_paths divided by the number of paths in any of the trees)
+
+        :param tree: Tree to compare
+        :returns:    dictionary with screening metrics
+
+        """
+
+        (common_paths, same_blobs) = self._screen_trees(self.tree, tree)
+        all_paths = self._count_tree_files(self.tree) \
+            + self._count_tree_files(tree) - common_paths
+        m = {'same_blobs': same_blobs, 'common_paths': common_paths,
+            'jaccard': common_paths / all_paths if all_paths else 1.0}
+        logging.debug("BaseDir.screen_tree(): " + str(m))
+        return m
+
+class MetricsPool:
+    """Pool of processes for computing metrics for commits of a repository.
+
+    The pool is created when first used, and then it can be used by
+    several Metrics objects for the same repository, one after the other
+    (for example, for comparing all the versions of a package with its
+    upstream repository, see lag), so that processes (and worktrees)
+    are not created again for each of them. If worktrees is True, a git
+    worktree for each process is created, for checking out commits
+    ('checkout' mode in Metrics).
+
+    Processes receive the repository when they start. The state of each
+    Metrics object using the pool is written to a file in the directory
+    of the pool, and read by each process the first time it computes
+    metrics for it. The directory, with the worktrees, is removed when
+    calling close.
+
+    :param repo:      Repo object (git repository)
+    :param workers:   number of processes
+    :param worktrees: create a git worktree for each process
+    :param store:     directory for the directory of the pool
+                      (default None, a temporary directory)
+
+    """
+
+    def __init__(self, repo, workers, worktrees=True, store=None):
+
+        self.repo = repo
+        self.workers = workers
+        self.worktrees = worktrees
+        self.store = store
+        # Pool of processes, and its directory, created when first needed
+        self.executor = None
+        self.dir = None
+        # Number of Metrics objects published for processes (see publish)
+        self.published = 0
+
+    def _get_executor(self):
+        """Get the pool of processes, creating it if it does not exist.
+
+        """
+
+        if self.executor is None:
+            self.dir = tempfile.mkdtemp(prefix='pool_', dir=self.store)
+            # Processes are spawned, so that they don't inherit open
+            # connections to databases or pipes to git processes
+            context = multiprocessing.get_context('spawn')
+            worktrees = None
+            if self.worktrees:
+                worktrees = context.Queue()
+                for worker in range(self.workers):
+                    worktree = os.path.join(self.dir, 'worktree-' + str(worker))
+                    logging.info("Adding worktree: " + worktree)
+                    self.repo.add_worktree(worktree)
+                    worktrees.put(worktree)
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=context,
+                initializer=_init_worker,
+                initargs=(self.repo, worktrees, profiling.enabled()))
+        return self.executor
+
+    def publish(self, metrics):
+        """Write the state of a Metrics object, to be read by processes.
+
+        :param metrics: Metrics object
+        :returns:       path of the file with its state
+
+        """
+
+        self._get_executor()
+        path = os.path.join(self.dir, 'metrics-{}.pickle'.format(self.published))
+        self.published += 1
+        with open(path, 'wb') as f:
+            pickle.dump(metrics, f)
+        return path
+
+    def map(self, path, commits):
+        """Compute metrics for commits, for a Metrics object published.
+
+        :param path:    path of the file with the state of the Metrics
+                        object (see publish)
+        :param commits: numbers of the commits to compute
+        :returns:       iterator of tuples (dictionary with metrics,
+                        profiling report or None), in the order of commits
+
+        """
+
+        return self._get_executor().map(_worker_commit_metrics,
+                                        [path] * len(commits), commits)
+
+    def close(self):
+        """Release resources (processes, worktrees, directory of the pool).
+
+        """
+
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        if self.dir is not None:
+            shutil.rmtree(self.dir)
+            if self.worktrees:
+                self.repo.prune_worktrees()
+            self.dir = None
+
+
 class Metrics:
     """Class for computing metrics comparing a git repository with a directory.
 
@@ -605,30 +2409,141 @@ class Metrics:
     If provided and not None, store will be used as a directory for
     intermediate storage. If provided, the directory should exist.
 
+    mode is the way commits are compared with the directory:
+
+    * 'checkout': each commit is checked out in the git repository,
+    and the checkout is compared with the directory.
+    * 'blobs': files in the directory are hashed (once) as git blobs,
+    and compared with the tree for each commit, as read from the git
+    repository. Only blobs which are different are read and compared.
+
+    If workers is larger than 1, commits in each range are computed
+    in parallel by a pool of that many processes (see MetricsPool).
+    In 'checkout' mode, each process checks out commits in its own git
+    worktree of the repository. The pool, and its worktrees, are
+    created in the store, and are removed when calling close. If pool
+    is not None, it is used instead (and workers is ignored), and it is
+    not closed when calling close, so that it can be used by other
+    Metrics objects for the same repository.
+
+    If cache is not None, it is a MetricsCache object, which will be
+    checked for metrics before computing them for a commit, and
+    updated with the metrics computed. Since this cache is persistent,
+    metrics computed by previous runs with the same directory can be reused.
+
+    If manifest is not None, it is the path of the file with the
+    manifest for dir, which will be loaded from it, or saved to it if it
+    doesn't exist (see BaseDir).
+
     :param repo:          Repo object (git repository)
     :param dir:           directory to compare with the git repository
     :param metrics_kinds: kinds of metrics to analyze each commit
     :param store:         directory for intermediate storage
+    :param mode:          way of comparing commits ('checkout' or 'blobs')
+    :param workers:       number of processes for computing metrics
+    :param cache:         persistent cache of metrics (MetricsCache)
+    :param engine:        engine for counting differences in files
+    :param lines_cache:   cache for number of lines, by blob hash (LinesCache)
+    :param manifest:      path of the file with the manifest for dir
+    :param pool:          pool of processes for computing metrics (MetricsPool)
 
     """
 
-    def __init__(self, repo, dir, metrics_kinds=['diff'], store=None):
+    def __init__(self, repo, dir, metrics_kinds=['diff'], store=None,
+                mode='checkout', workers=1, cache=None,
+                engine=diffstat.DEFAULT_ENGINE, lines_cache=None, manifest=None,
+                pool=None):
 
         self.repo = repo
         self.dir = dir
         for metric in metrics_kinds:
             assert metric in ['diff', 'same']
         self.metrics_kinds = metrics_kinds
-
-        self.basedir = BaseDir(self.dir, metrics=self.metrics_kinds)
+        assert mode in MODES
+        self.mode = mode
+
+        self.engine = engine
+        self.lines_cache = lines_cache
+        self.basedir = BaseDir(self.dir, metrics=self.metrics_kinds,
+                                engine=self.engine, lines_cache=lines_cache,
+                                manifest=manifest)
         # List of commit hashes, ordered as returned by git log (reverse)
         self.commits = self.repo.get_commits()
         logging.info("Metrics: %d commits parsed." % len(self.commits))
         # Dictionary with metrics, key is the commit number (order in commits)
         self.metrics = {}
+        # Number of commits evaluated (metrics computed) by closest_commit
+        self.evaluated = 0
+        # Dates of commits (seconds since the epoch, sorted) with their
+        # numbers of commits, and numbers of commits by hash,
+        # produced when first needed
+        self.dates = None
+        self.commit_nos = None
+        # Dictionary with screening metrics, key is the commit number
+        self.screens = {}
         if store is not None:
             assert os.path.isdir(store)
         self.store = store
+        self.cache = cache
+        self.fingerprint = None
+        # Pool of processes (created when first needed, if not provided),
+        # and path of the file with the state of this object for them
+        self.pool = pool
+        self.own_pool = pool is None
+        self.published = None
+        if pool is not None:
+            assert mode == 'blobs' or pool.worktrees
+            workers = pool.workers
+        self.workers = workers
+        # Worktree used for checkouts (None means the repository itself)
+        self.worktree = None
+
+    def __getstate__(self):
+        """Get state for pickling (see MetricsPool.publish)
+
+        The repository and the pool are not included: processes
+        in the pool have their own copy of the repository.
+
+        """
+
+        state = self.__dict__.copy()
+        state['repo'] = None
+        state['pool'] = None
+        return state
+
+    def _get_pool(self):
+        """Get the pool of processes for computing metrics.
+
+        If there is no pool, it is created. In 'checkout' mode, it has a
+        worktree for each process. The state of this object is published
+        for the processes the first time.
+
+        :returns: tuple (MetricsPool, path of the file with the state)
+
+        """
+
+        if self.pool is None:
+            self.pool = MetricsPool(self.repo, self.workers,
+                                    worktrees=(self.mode == 'checkout'),
+                                    store=self._get_store_dir())
+        if self.published is None:
+            if self.cache is not None and self.fingerprint is None:
+                # Compute it only once, instead of once per process
+                self.fingerprint = self.basedir.fingerprint()
+            self.published = self.pool.publish(self)
+        return (self.pool, self.published)
+
+    def close(self):
+        """Release resources (pool of processes, worktrees).
+
+        If the pool was provided when instantiating, it is not closed.
+
+        """
+
+        if self.pool is not None and self.own_pool:
+            self.pool.close()
+            self.pool = None
+        self.published = None
 
     def _get_store_dir (self):
         """Get a directory suitable for intermediate storage.
@@ -648,11 +2563,27 @@ class Metrics:
 
         return self.repo.last_commit()
 
+    def _cache_kinds(self):
+        """Kinds of metrics, for the persistent cache.
+
+        Metrics also depend on the engine for counting differences,
+        and on the mode for getting files of commits (both modes may
+        differ, for example, for files not readable in a checkout),
+        so both are included as if they were kinds of metrics.
+
+        """
+
+        return self.metrics_kinds + ['engine:' + self.engine,
+                                    'mode:' + self.mode]
+
     def commit_metrics(self, commit_no):
         """Compute comparison metrics for a given commit.
 
         Check out the corresponding commit in the git repository, and
         compute the metrics for commparing it with the base directory.
+        In 'blobs' mode, the tree for the commit is compared instead,
+        with no check out.
+        If there is a persistent cache, metrics are looked up in it first.
 
         The returned metrics are those produced by BaseDir.compare plus:
          * commit: hash for the commit
@@ -661,9 +2592,9 @@ class Metrics:
         For an explanation of the metrics instantiation parameter, read
         the comments for the BaseDir.compare function.
 
-        commit_no is as provided by the Repo class, which in turn
-        is provided by Perceval. This is the order as by git log,
-        reversed.
+        commit_no is as provided by the Repo class: the position of the
+        commit in its index, built from the output of
+        git log --reverse --topo-order (see CommitIndex).
 
         :param commit_no: commit number (starting in 0)
         :returns:         dictionary with metrics for comparison
@@ -671,9 +2602,34 @@ class Metrics:
         """
 
         commit = self.commits[commit_no]
-        subprocess.call(["git", "-C", self.repo.dir, "checkout", commit[0]],
-                        stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
-        m = self.basedir.compare(self.repo.dir)
+        m = None
+        if self.cache is not None:
+            if self.fingerprint is None:
+                self.fingerprint = self.basedir.fingerprint()
+            m = self.cache.get(self.fingerprint, commit[0], self._cache_kinds())
+            if m is not None:
+                logging.debug ("Commit %s. Metrics from cache." % str(commit))
+                profiling.count('metrics_cache.hits')
+            else:
+                profiling.count('metrics_cache.misses')
+        if m is None:
+            if self.mode == 'blobs':
+                with profiling.phase('metrics.compare'):
+                    m = self.basedir.compare_tree(self.repo.tree(commit_no),
+                                                self.repo.read_blob)
+            else:
+                checkout_dir = self.worktree or self.repo.dir
+                with profiling.phase('metrics.checkout'):
+                    subprocess.call(["git", "-C", checkout_dir, "checkout",
+                                    commit[0]], stdout = subprocess.DEVNULL,
+                                    stderr = subprocess.DEVNULL)
+                with profiling.phase('metrics.compare'):
+                    m = self.basedir.compare(checkout_dir)
+            if self.cache is not None:
+                self.cache.put(self.fingerprint, commit[0],
+                                self._cache_kinds(), m)
+            if self.lines_cache is not None:
+                self.lines_cache.flush()
         m["commit_no"] = commit_no
         m["commit"] = commit[0]
         m["date"] = commit[1]
@@ -697,6 +2653,9 @@ class Metrics:
         For example, if range is 1:40, and steps is 10, the computed
         commits will be 1, 11, 21, 31 and 40.
 
+        If there is more than one worker, commits are computed in parallel
+        by the pool of processes.
+
         :param first: first commit to consider
         :param last:  last commit to consider
         :param step:  only compute commits coincident with step
@@ -705,12 +2664,61 @@ class Metrics:
 
         logging.info("Computing metrics for range: %d - %d, step %d" %
                     (first, last, step))
-        for seq_no in list(range(first, last, step)) + [last]:
-            if seq_no not in self.metrics:
+        self.commits_metrics(list(range(first, last, step)) + [last])
+
+    def commits_metrics (self, commits):
+        """Compute metrics for a list of commits.
+
+        Metrics are stored in the internal data structure maintained by
+        the object (see range_metrics). Commits with metrics already
+        computed are not computed again, and the rest are counted
+        in self.evaluated.
+
+        If there is more than one worker, commits are computed in parallel
+        by the pool of processes.
+
+        :param commits: numbers of the commits to compute
+
+        """
+
+        to_compute = [seq_no for seq_no in sorted(set(commits))
+                        if seq_no not in self.metrics]
+        self.evaluated += len(to_compute)
+        profiling.count('search.iterations')
+        profiling.count('search.evaluated', len(to_compute))
+        if self.workers > 1 and len(to_compute) > 1:
+            logging.info("Computing metrics for %s (%d workers)."
+                        % (str(to_compute), self.workers))
+            (pool, published) = self._get_pool()
+            computed = pool.map(published, to_compute)
+            for seq_no, (m, report) in zip(to_compute, computed):
+                self.metrics[seq_no] = m
+                profiling.merge(report)
+        else:
+            for seq_no in to_compute:
                 logging.info("Computing metrics for %d." % seq_no)
                 m = self.commit_metrics(seq_no)
                 self.metrics[seq_no] = m
 
+    def screen_metrics (self, commits):
+        """Compute screening metrics for a list of commits.
+
+        Screening metrics are cheap metrics computed from the tree of
+        each commit, as read from the git repository, with no checkout
+        or file read (see BaseDir.screen_tree), in any mode. They are
+        stored in self.screens, and are not computed again.
+
+        :param commits: numbers of the commits to compute
+        :returns:       dictionary with screening metrics, by commit number
+
+        """
+
+        for commit_no in commits:
+            if commit_no not in self.screens:
+                self.screens[commit_no] = self.basedir.screen_tree(
+                    self.repo.tree(commit_no))
+        return {commit_no: self.screens[commit_no] for commit_no in commits}
+
     def closest_range (self, length, metric='diff_files',closest_fn=min):
         """Find range of minimum values.
 
@@ -812,8 +2820,64 @@ class Metrics:
             m['hash']=m['commit'][0:7]
             logging.info(csv_string.format(name=name, **m))
 
+    def commit_number (self, hash):
+        """Get the number of a commit, given its hash.
+
+        :param hash: hash of the commit
+        :returns:    commit number, or None if the commit is not in self.commits
+
+        """
+
+        if self.commit_nos is None:
+            self.commit_nos = {commit[0]: commit_no for (commit_no, commit)
+                                in enumerate(self.commits)}
+        return self.commit_nos.get(hash)
+
+    def date_window (self, date, slack):
+        """Find the window of commits with dates close to a given date.
+
+        The window is from the first to the last commit with a commit
+        date in the interval [date - slack, date + slack]. If there is
+        no commit in that interval, the window is the commit with the
+        date closest to date.
+
+        :param date:  date (datetime.datetime, if naive it is assumed UTC)
+        :param slack: slack around date (datetime.timedelta)
+        :returns:     tuple (first, last), commit numbers for the window
+
+        """
+
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=datetime.timezone.utc)
+        if self.dates is None:
+            # Dates of commits are not in order (commits are in topological
+            # order), so they are sorted, to find windows with bisect
+            dates = self.repo.index.dates
+            order = sorted(range(len(dates)),
+                            key=lambda commit_no: (dates[commit_no], commit_no))
+            self.dates = ([dates[commit_no] for commit_no in order], order)
+        (epochs, commit_nos) = self.dates
+        epoch = date.timestamp()
+        first = bisect.bisect_left(epochs, epoch - slack.total_seconds())
+        last = bisect.bisect_right(epochs, epoch + slack.total_seconds())
+        if first < last:
+            close = commit_nos[first:last]
+            return (min(close), max(close))
+        # No commit in the interval: closest commits are those with the
+        # date right before it, or right after it (lower number if a tie)
+        neighbours = []
+        if first > 0:
+            before = bisect.bisect_left(epochs, epochs[first-1])
+            neighbours.append((epoch - epochs[before], commit_nos[before]))
+        if first < len(epochs):
+            neighbours.append((epochs[first] - epoch, commit_nos[first]))
+        closest = min(neighbours)[1]
+        return (closest, closest)
+
     def closest_commit (self, ratio=10, range=3, name=None,
-                        closest_fn=min, metric='diff_files'):
+                        closest_fn=min, metric='diff_files', strategy='ratio',
+                        date=None, slack=datetime.timedelta(days=90),
+                        seed=None, candidates=None, top=10, window=3):
         """Find the closest commit, for the given function and metric.
 
         Compares the base directory with the checkouts from a
@@ -825,7 +2889,8 @@ class Metrics:
         or minimize it (for difference metrics).
 
         Instead of checking all checkouts, which may be very time consuming,
-        we will follow an interative strategy:
+        a search strategy is followed (see techlag.search). By default
+        ('ratio' strategy), we will follow an interative strategy:
 
         * We compute an initial step by using ratio, just dividing the
         number of commits by the ratio.
@@ -849,6 +2914,36 @@ class Metrics:
         during each iteration. The larger the range, the less likely to
         find a local minimum (or maximum) instead of the true closest value.
 
+        Other strategies can be specified with strategy, which may be
+        the name of a strategy, or a techlag.search.Strategy object.
+        'golden' and 'ternary' strategies assume that the metric is
+        unimodal along the commits, and use range as the length of
+        the interval for evaluating all commits. 'screen' evaluates the
+        top commits ranked by screening metrics, and then up to window
+        neighbours of the closest one. 'exhaustive' evaluates
+        all commits. The number of commits evaluated is available,
+        after the search, in self.evaluated.
+
+        If date is not None, it is the date of the directory (for example,
+        the date when a package was published), and the search starts
+        in the window of commits with dates close to it, up to slack
+        (see date_window). If the closest commit found is in an edge of
+        the window (other than the first or last commit), the window is
+        widened on that edge, doubling its length, and the search is
+        repeated (metrics for commits already computed are not computed
+        again), until the closest commit is not in an edge.
+
+        If seed is not None, it is a commit number expected to be close
+        to the closest commit (for example, the closest commit for the
+        previous version of the same package). The search starts then
+        in the window of range commits on each side of it, which is
+        widened the same way. seed takes precedence over date.
+
+        If candidates is not None, it is a list of commit numbers likely
+        to be close to the closest commit (for example, those found by
+        techlag.sketch.SketchIndex). They are evaluated (with seed, if any),
+        and the closest of them is used as seed.
+
         If name parameter is None, or is not present, name will be
         the last component of the base directory.
 
@@ -858,6 +2953,15 @@ class Metrics:
         :type name:         string
         :param closest_fn:  function to evaluate the closest commit (min or max)
         :param metric:      metric to decide if a commit is closer or not
+        :param strategy:    search strategy (name or Strategy object)
+        :param date:        date of the directory (datetime.datetime)
+        :param slack:       slack around date for the initial window
+                            (datetime.timedelta)
+        :param seed:        commit number to start the search around
+        :param candidates:  commit numbers to choose the seed from
+        :param top:         number of commits to evaluate ('screen' strategy)
+        :param window:      number of neighbours for local refinement
+                            ('screen' strategy)
         :returns:           dictionary with infom about most similar commit
 
         """
@@ -865,26 +2969,45 @@ class Metrics:
         if name is None:
             name = os.path.basename(self.dir)
 
-        left = 0
-        right = len(self.commits) - 1
-        # Next calculates the ceiling integer division
-        # Needed because we want eg. 1/3 to be 1
-        step = -( -len(self.commits) // ratio)
-        while step >= 1:
-            self.range_metrics (left, right, step)
-            closest = self.closest_range(length=range, metric=metric,
-                                        closest_fn=closest_fn)
-            (left, right, closest_seq, closest_value) = closest
-            logging.info("Step: %d, left: %d, right: %d, closest seq: %d, closest value: %d."
-                    % (step, left, right, closest_seq, closest_value))
-            if step == 1:
-                step = 0
+        if isinstance(strategy, str):
+            strategy = search.get_strategy(strategy, ratio=ratio, range=range,
+                                            top=top, window=window)
+        self.evaluated = 0
+        last_commit = len(self.commits) - 1
+        if candidates:
+            candidates = list(candidates)
+            if seed is not None:
+                candidates.append(seed)
+            self.commits_metrics(candidates)
+            seed = strategy.closest(self, candidates, metric, closest_fn)
+            logging.info("Seed from candidates %s: %d."
+                        % (str(candidates), seed))
+        if seed is not None:
+            seed = min(max(seed, 0), last_commit)
+            (first, last) = (max(seed - range, 0),
+                            min(seed + range, last_commit))
+        elif date is not None:
+            (first, last) = self.date_window(date, slack)
+        else:
+            (first, last) = (0, last_commit)
+        while True:
+            logging.info("Searching window: %d - %d." % (first, last))
+            with profiling.phase('metrics.search'):
+                closest_seq = strategy.search(self, metric=metric,
+                                                closest_fn=closest_fn,
+                                                first=first, last=last)
+            length = last - first + 1
+            if closest_seq <= first and first > 0:
+                first = max(first - length, 0)
+            elif closest_seq >= last and last < last_commit:
+                last = min(last + length, last_commit)
             else:
-                candidate_step = -( -(right-left+1) // ratio)
-                if (candidate_step >= step // 2) and (step // 2 >= 1):
-                    step = step // 2
-                else:
-                    step = candidate_step
+                break
+        closest_value = self.metrics[closest_seq][metric]
+        logging.info("Strategy %s: closest seq: %d, closest value: %d, "
+                    "commits evaluated: %d."
+                    % (strategy.name, closest_seq, closest_value,
+                    self.evaluated))
         closest_commit = self.commits[closest_seq]
         most_similar = {
             'sequence': closest_seq,
@@ -904,6 +3027,11 @@ class Metrics:
         that store remains, the checkout won't be done again, and the
         contents of that directory are assumed to correspond to the checkout.
 
+        In 'blobs' mode, no commit is checked out: the trees for both
+        commits are compared as read from the git repository, so that only
+        blobs which are different are read (and diffed), and the number of
+        lines of the rest are got from the cache of lines, if possible.
+
         :param left_commit:   commit number to be considered as left checkout
         :param right_commit:  commit number to be considered as right checkout
         :param metrics_kinds: kinds of metrics to analyze each commit
@@ -912,16 +3040,29 @@ class Metrics:
 
         if metrics_kinds is None:
              metrics_kinds = self.metrics_kinds
+        if self.mode == 'blobs':
+            left_tree = BaseDir (name=self.commits[left_commit][0],
+                                metrics=metrics_kinds, engine=self.engine,
+                                lines_cache=self.lines_cache,
+                                tree=self.repo.tree(left_commit),
+                                read_blob=self.repo.read_blob)
+            with profiling.phase('metrics.compare_checkouts'):
+                return left_tree.compare_tree(self.repo.tree(right_commit),
+                                            self.repo.read_blob)
         # Checkout left_commit to a new directory
         store = self._get_store_dir()
         left_dir = os.path.join(store, self.commits[left_commit][0])
         self.repo.checkout (commit_no=left_commit, copy=left_dir)
-        # Create a BaseDir with left commit for comparing
-        left_dir = BaseDir (name=left_dir, metrics=metrics_kinds)
+        # Create a BaseDir with left commit for comparing (its manifest
+        # is stored with the checkout, and is valid as long as it remains)
+        left_dir = BaseDir (name=left_dir, metrics=metrics_kinds,
+                            engine=self.engine, lines_cache=self.lines_cache,
+                            manifest=manifest_path(left_dir))
         # Checkout right_commit
         self.repo.checkout (commit_no=right_commit, copy=None)
         # Compare
-        m = left_dir.compare (self.repo.dir)
+        with profiling.phase('metrics.compare_checkouts'):
+            m = left_dir.compare (self.repo.dir)
         return m
 
     def normalized_effort (self, left_commit, right_commit):
@@ -936,33 +3077,106 @@ class Metrics:
         for all the authors active during the period between those
         two commits.
 
-        :param eft_commit:   commit number to be considered as left checkout
+        Days are those of the author dates, in the time zone of
+        the author. The effort is computed with the EffortIndex
+        of the repository.
+
+        :param left_commit:  commit number to be considered as left checkout
         :param right_commit: commit number to be considered as right checkout
 
         """
 
-        author_dates = {}
-        for commit in range(left_commit,right_commit+1):
-            author = self.repo.authorship[commit]['author']
-            date = self.repo.authorship[commit]['authordate']
-            date = datetime.datetime.strptime(date, "%a %b %d %H:%M:%S %Y %z")
-            date_str = str(date.year)+'.'+str(date.month)+'.'+str(date.day)
-            if author not in author_dates:
-                author_dates[author] = {}
-            if date_str in author_dates[author]:
-                author_dates[author][date_str] += 1
-            else:
-                author_dates[author][date_str] = 1
-        effort = 0
-        for commit_days in author_dates.values():
-            effort += len(commit_days)
-        return(effort)
+        return self.repo.effort_index().effort(left_commit, right_commit)
+
+    def normalized_efforts (self, left_commits, right_commit=None):
+        """Computes the normalized effort between many commits and another one.
+
+        This is faster than calling normalized_effort for each of
+        left_commits, since all efforts are computed in a single pass.
+
+        :param left_commits: commit numbers to be considered as left checkouts
+        :param right_commit: commit number to be considered as right checkout
+            (default None, last commit)
+        :returns:            list of efforts, one for each of left_commits
+
+        """
+
+        return self.repo.effort_index().efforts(left_commits, right_commit)
+
+# Repository and worktree for each process in a MetricsPool, and
+# Metrics object in use (and path of the file with its state)
+_worker_repo = None
+_worker_worktree = None
+_worker_metrics = None
+_worker_published = None
 
-def lag (name, upstream, dir, after, store, ratio=10, range=3):
+def _init_worker(repo, worktrees, profile=False):
+    """Initialize a process in a MetricsPool.
+
+    :param repo:      Repo object for this process
+    :param worktrees: queue with worktrees (None if not needed)
+    :param profile:   enable profiling in this process
+
+    """
+
+    global _worker_repo, _worker_worktree
+    _worker_repo = repo
+    if profile:
+        profiling.enable()
+    if worktrees is not None:
+        _worker_worktree = worktrees.get()
+    # Run when the process exits normally (when the pool is shut down)
+    multiprocessing.util.Finalize(None, _flush_worker_cache, exitpriority=10)
+
+def _flush_worker_cache():
+    """Write pending times of use in the cache of the Metrics object in use.
+
+    """
+
+    if _worker_metrics is not None and _worker_metrics.cache is not None:
+        _worker_metrics.cache.flush()
+
+def _worker_commit_metrics(published, commit_no):
+    """Compute metrics for a commit in a process in a MetricsPool.
+
+    The Metrics object is read from the file with its state, unless
+    it is the one already in use in this process.
+    The profiling report for the computation is returned too (see
+    profiling.collect), to be merged in the main process.
+
+    :param published: path of the file with the state of the Metrics object
+    :param commit_no: commit number
+    :returns:         tuple (dictionary with metrics for comparison,
+                      profiling report or None)
+
+    """
+
+    global _worker_metrics, _worker_published
+    if published != _worker_published:
+        _flush_worker_cache()
+        with open(published, 'rb') as f:
+            metrics = pickle.load(f)
+        metrics.repo = _worker_repo
+        metrics.worktree = _worker_worktree
+        (_worker_metrics, _worker_published) = (metrics, published)
+    m = _worker_metrics.commit_metrics(commit_no)
+    return (m, profiling.collect())
+
+def lag (name, upstream, dir, after, store, ratio=10, range=3,
+        mode='checkout', workers=1, cache=None,
+        engine=diffstat.DEFAULT_ENGINE, lines_cache=None, manifest=None,
+        strategy='ratio', date=None, slack=datetime.timedelta(days=90),
+        seed_hash=None, sketch=None, pool=None, top=10, window=3):
     """Compute technical lag for directory with respect to upstream repository.
 
     This is a part of the high level interface of this module.
 
+    Results include, besides the metrics comparing the closest commit
+    with the last one, the number of commits between them (diff_commits),
+    the number of commits evaluated in the search (evaluated_commits),
+    and the number and hash of the closest commit (closest_sequence,
+    closest_hash).
+
     :param name:      name of package being computed
     :type name:       string
     :param upstream: upstream git repository Metainformation
@@ -973,15 +3187,62 @@ def lag (name, upstream, dir, after, store, ratio=10, range=3):
     :param ratio:     do approximation according to this ratio
     :param range:     do approximation according to this range
     :param store:    directory to store checkouts
+    :param mode:      way of comparing commits ('checkout' or 'blobs')
+    :param workers:   number of processes for computing metrics
+    :param cache:     persistent cache of metrics
+    :type cache:      techlag.cache.MetricsCache
+    :param engine:    engine for counting differences in files
+    :param lines_cache: cache for number of lines, by blob hash
+    :type lines_cache:  techlag.cache.LinesCache
+    :param manifest:  path of the file with the manifest for dir (see BaseDir)
+    :param strategy:  strategy for searching the closest commit
+                      (see Metrics.closest_commit)
+    :param date:      date of the directory, to start the search
+                      with commits close to it (default None)
+    :type date:       datetime.datetime
+    :param slack:     slack around date for starting the search
+    :type slack:      datetime.timedelta
+    :param seed_hash: hash of the commit to start the search around,
+                      usually closest_hash for the previous version of the
+                      package (default None). It is ignored if the commit
+                      is not in upstream (for example, if it was rewritten)
+    :param sketch:    index of sketches of commits in upstream, to find
+                      candidates for seeding the search (default None)
+    :type sketch:     techlag.sketch.SketchIndex
+    :param pool:      pool of processes for computing metrics, to use
+                      instead of creating one, usually shared by the calls
+                      for all versions of a package (default None)
+    :type pool:       techlag.gitlag.MetricsPool
+    :param top:       number of commits to evaluate ('screen' strategy)
+    :param window:    number of neighbours for local refinement
+                      ('screen' strategy)
 
     """
 
     # Create a Metrics object and compute the closest commit
     metrics = Metrics(repo=upstream, dir=dir,
-                                    metrics_kinds=['same'], store=store)
-    commit = metrics.closest_commit (closest_fn=max, metric='common_lines',
-                                    ratio=ratio, range=range,
-                                    name=name)
+                                    metrics_kinds=['same'], store=store,
+                                    mode=mode, workers=workers, cache=cache,
+                                    engine=engine, lines_cache=lines_cache,
+                                    manifest=manifest, pool=pool)
+    try:
+        seed = None
+        if seed_hash is not None:
+            seed = metrics.commit_number(seed_hash)
+        candidates = None
+        if sketch is not None:
+            candidates = [metrics.commit_number(hash) for (hash, similarity)
+                            in sketch.query(metrics.basedir.tree)]
+            candidates = [commit_no for commit_no in candidates
+                            if commit_no is not None]
+        commit = metrics.closest_commit (closest_fn=max, metric='common_lines',
+                                        ratio=ratio, range=range,
+                                        name=name, strategy=strategy,
+                                        date=date, slack=slack, seed=seed,
+                                        candidates=candidates,
+                                        top=top, window=window)
+    finally:
+        metrics.close()
     info_str = "{}: most similar upstream checkout is {} " \
         + "(diff: {}, date: {}, hash: {})."
     logging.info (info_str.format(
@@ -994,8 +3255,15 @@ def lag (name, upstream, dir, after, store, ratio=10, range=3):
     metrics_data = metrics.compare_checkouts (commit['sequence'],
                                             metrics.last_commit_no(),
                                             metrics_kinds=['same', 'diff'])
+    if cache is not None:
+        cache.flush()
+    if lines_cache is not None:
+        lines_cache.flush()
     logging.info ("Metrics comparing with last commit: " + str(metrics_data))
     metrics_data['diff_commits'] = metrics.last_commit_no() - commit['sequence']
+    metrics_data['evaluated_commits'] = metrics.evaluated
+    metrics_data['closest_sequence'] = commit['sequence']
+    metrics_data['closest_hash'] = commit['hash']
     metrics_data['normal_effort'] = metrics.normalized_effort(
         left_commit=commit['sequence'], right_commit=metrics.last_commit_no()
         )
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2016 Bitergia
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+##
+## Authors:
+##   Jesus M. Gonzalez-Barahona <jgb@bitergia.com>
+##
+
+
+"""Pipelines of stages, for preparing items while others are processed.
+
+A Pipeline runs each item (for example, a version of a package) through
+a list of stages (for example, downloading it, and then reading it),
+each with its own pool of threads, so that items in different stages
+run at the same time. Results are produced in the order of the items,
+so that they can be processed (for example, compared with upstream)
+in that order, while the next items are being prepared.
+
+The number of items in the pipeline, ahead of the one being processed,
+is bounded (back-pressure), so that preparing items doesn't get too far
+(for example, using too much disk for packages not compared yet).
+
+"""
+
+import collections
+import concurrent.futures
+import logging
+
+
+class Stage:
+    """Stage of a pipeline.
+
+    :param name:     name of the stage (for logging)
+    :param function: function to run for each item, with the result of
+                     the previous stage (or the item, for the first stage)
+    :param workers:  number of threads running the function
+
+    """
+
+    def __init__(self, name, function, workers=1):
+
+        assert workers >= 1
+        self.name = name
+        self.function = function
+        self.workers = workers
+
+
+class Pipeline:
+    """Pipeline of stages, running items concurrently, with results in order.
+
+    Each stage has a pool of threads, and when an item is done in a
+    stage, it is submitted to the next one. Exceptions raised by a stage
+    for an item are produced as its result (and the item is not run
+    by the next stages), so that an item failing doesn't stop the
+    pipeline. Stages are run in threads, so they are useful for
+    I/O (downloads, reading files) or for code releasing the GIL
+    (for example, decompressing, or running subprocesses).
+
+    :param stages: list of Stage
+    :param ahead:  maximum number of items in the pipeline, not counting
+                   the one being processed (0 to run items one by one)
+
+    """
+
+    def __init__(self, stages, ahead=2):
+
+        assert len(stages) > 0 and ahead >= 0
+        self.stages = stages
+        self.ahead = ahead
+        self.executors = [concurrent.futures.ThreadPoolExecutor(
+                                max_workers=stage.workers,
+                                thread_name_prefix='pipeline-' + stage.name)
+                            for stage in stages]
+
+    def _submit(self, stage_no, value, future):
+        """Submit a value to a stage, chaining its result to the next one.
+
+        :param stage_no: number of the stage
+        :param value:    value to run the stage with
+        :param future:   Future for the result of the last stage
+
+        """
+
+        stage = self.stages[stage_no]
+
+        def done(step):
+            if future.cancelled():
+                # Result no longer wanted
+                return
+            try:
+                result = step.result()
+            except BaseException as error:
+                logging.info("Pipeline: stage {} failed: {}".format(
+                                stage.name, str(error)))
+                self._set(future, exception=error)
+                return
+            if stage_no + 1 < len(self.stages):
+                self._submit(stage_no + 1, result, future)
+            else:
+                self._set(future, result=result)
+
+        try:
+            step = self.executors[stage_no].submit(stage.function, value)
+        except RuntimeError as error:
+            # Pipeline closed
+            self._set(future, exception=error)
+            return
+        step.add_done_callback(done)
+
+    @staticmethod
+    def _set(future, result=None, exception=None):
+        """Set the result (or exception) of a Future, unless cancelled.
+
+        """
+
+        try:
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+        except concurrent.futures.InvalidStateError:
+            pass
+
+    def run(self, items):
+        """Run items through the pipeline.
+
+        This is a generator, producing results in the order of items.
+        Items are submitted to the pipeline while there are less than
+        ahead items in it waiting to be produced, and the next item is
+        produced as soon as it is done.
+
+        :param items: iterable of items
+        :returns:     iterator of tuples (item, result of the last stage,
+                      exception raised by a stage, or None)
+
+        """
+
+        pending = collections.deque()
+        try:
+            for item in items:
+                future = concurrent.futures.Future()
+                self._submit(0, item, future)
+                pending.append((item, future))
+                if len(pending) > self.ahead:
+                    yield self._result(*pending.popleft())
+            while pending:
+                yield self._result(*pending.popleft())
+        finally:
+            # Results not produced (generator closed early) are discarded
+            for (item, future) in pending:
+                future.cancel()
+
+    @staticmethod
+    def _result(item, future):
+        """Wait for the result of an item.
+
+        :returns: tuple (item, result, exception)
+
+        """
+
+        try:
+            return (item, future.result(), None)
+        except Exception as error:
+            return (item, None, error)
+
+    def close(self):
+        """Stop the pools of threads, waiting for stages running.
+
+        """
+
+        for executor in self.executors:
+            executor.shutdown(cancel_futures=True)
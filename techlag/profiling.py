@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2016 Bitergia
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+##
+## Authors:
+##   Jesus M. Gonzalez-Barahona <jgb@bitergia.com>
+##
+
+
+"""Instrumentation: wall time of phases, and counters.
+
+When profiling is enabled (see enable), code in this package records
+the wall time and number of calls of its phases (for example, cloning
+a repository, or diffing files, see phase), and some counters (for
+example, bytes read, or hits and misses of caches, see count), in
+the Profile for the process. It is disabled by default, and then
+recording has almost no cost.
+
+Phases are named by component and phase (for example, 'repo.clone',
+'basedir.diff'). Counters named '<cache>.hits' and '<cache>.misses'
+produce a hit rate for the cache in reports (see Profile.report).
+Time for phases run by several threads at the same time (for example,
+downloads) is added, so it may be larger than the wall time of the run.
+
+Each process has its own Profile, so reports of worker processes
+should be collected (see collect) and merged (see merge) in the
+process managing them. Reports for several packages can be written
+to a JSON file, with their total (see dump).
+
+"""
+
+import json
+import threading
+import time
+
+
+class Profile:
+    """Wall time and number of calls of phases, and counters.
+
+    """
+
+    def __init__(self):
+
+        self.lock = threading.Lock()
+        # Phases: name -> [calls, seconds]
+        self.phases = {}
+        self.counters = {}
+
+    def add(self, name, seconds, calls=1):
+        """Add time (and calls) to a phase.
+
+        :param name:    name of the phase
+        :param seconds: wall time, in seconds
+        :param calls:   number of calls
+
+        """
+
+        with self.lock:
+            phase = self.phases.setdefault(name, [0, 0.0])
+            phase[0] += calls
+            phase[1] += seconds
+
+    def count(self, name, value=1):
+        """Increment a counter.
+
+        :param name:  name of the counter
+        :param value: increment
+
+        """
+
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self):
+        """Produce a report, suitable for dumping as JSON.
+
+        :returns: dictionary with 'phases' (calls and seconds, by name),
+                  'counters', and 'hit_rates' (by cache)
+
+        """
+
+        with self.lock:
+            phases = {name: {'calls': calls, 'seconds': round(seconds, 6)}
+                        for (name, (calls, seconds))
+                        in sorted(self.phases.items())}
+            counters = dict(sorted(self.counters.items()))
+        hit_rates = {}
+        for name in counters:
+            if name.endswith('.hits'):
+                cache = name[:-len('.hits')]
+                total = counters[name] + counters.get(cache + '.misses', 0)
+                hit_rates[cache] = round(counters[name] / total, 4) \
+                                    if total else None
+        for name in counters:
+            if name.endswith('.misses'):
+                hit_rates.setdefault(name[:-len('.misses')], 0.0)
+        return {'phases': phases, 'counters': counters,
+                'hit_rates': dict(sorted(hit_rates.items()))}
+
+    def merge(self, report):
+        """Add the phases and counters in a report (see report).
+
+        :param report: report to merge (None to do nothing)
+
+        """
+
+        if report is None:
+            return
+        for (name, phase) in report['phases'].items():
+            self.add(name, phase['seconds'], phase['calls'])
+        for (name, value) in report['counters'].items():
+            self.count(name, value)
+
+
+class _Phase:
+    """Context manager recording the wall time of a phase in a Profile.
+
+    """
+
+    __slots__ = ('profile', 'name', 'start')
+
+    def __init__(self, profile, name):
+
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+
+        self.profile.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NoPhase:
+    """Context manager doing nothing (profiling disabled).
+
+    """
+
+    __slots__ = ()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc):
+
+        return False
+
+_NO_PHASE = _NoPhase()
+
+# Profile for this process (None if profiling is disabled)
+_profile = None
+
+def enable():
+    """Enable profiling in this process (if not enabled yet).
+
+    """
+
+    global _profile
+    if _profile is None:
+        _profile = Profile()
+
+def disable():
+    """Disable profiling in this process (its Profile is discarded).
+
+    """
+
+    global _profile
+    _profile = None
+
+def enabled():
+    """Check if profiling is enabled in this process.
+
+    """
+
+    return _profile is not None
+
+def phase(name):
+    """Context manager for recording the wall time of a phase.
+
+    Example: with profiling.phase('repo.clone'): ...
+
+    :param name: name of the phase
+    :returns:    context manager
+
+    """
+
+    if _profile is None:
+        return _NO_PHASE
+    return _Phase(_profile, name)
+
+def count(name, value=1):
+    """Increment a counter (if profiling is enabled).
+
+    :param name:  name of the counter
+    :param value: increment
+
+    """
+
+    if _profile is not None:
+        _profile.count(name, value)
+
+def collect():
+    """Get the report for this process, and start a new Profile.
+
+    :returns: report (see Profile.report), or None if profiling is disabled
+
+    """
+
+    global _profile
+    if _profile is None:
+        return None
+    (profile, _profile) = (_profile, Profile())
+    return profile.report()
+
+def merge(report):
+    """Merge a report (for example, from a worker process) in this process.
+
+    :param report: report (see Profile.report), or None
+
+    """
+
+    if _profile is not None:
+        _profile.merge(report)
+
+def dump(path, reports, setup=None):
+    """Write reports for several packages, and their total, to a JSON file.
+
+    :param path:    path of the file
+    :param reports: dictionary with reports (see Profile.report), by package
+    :param setup:   report for work not specific to a package (default None)
+
+    """
+
+    total = Profile()
+    total.merge(setup)
+    for report in reports.values():
+        total.merge(report)
+    with open(path, 'w') as file:
+        json.dump({'setup': setup, 'packages': reports,
+                    'total': total.report()}, file, indent=2)
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2016 Bitergia
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+##
+## Authors:
+##   Jesus M. Gonzalez-Barahona <jgb@bitergia.com>
+##
+
+
+"""Store of results of technical lag, for versions of packages.
+
+Results (the metrics produced by gitlag.lag) are stored in a SQLite
+file, with a row per version of a package, and a column per metric,
+so that they can be queried (for example, all versions of a package,
+or versions in a range of dates) without reading all of them.
+Versions which could not be computed are stored too, with the error.
+Results stored by earlier versions of debsnapshotlag, in shelves
+(data-done and data-missing), can be imported (see import_shelves).
+
+Since the store is a SQLite file in WAL mode (see cache.SQLiteStore),
+it can be written by several processes at the same time (for example,
+workers processing different packages).
+
+"""
+
+import json
+import logging
+import shelve
+
+from .cache import SQLiteStore
+
+# Metrics produced by gitlag.lag, and their SQL types (in order)
+METRICS = [('left_files', 'INTEGER'), ('left_lines', 'INTEGER'),
+            ('right_files', 'INTEGER'), ('right_lines', 'INTEGER'),
+            ('same_files', 'INTEGER'), ('same_lines', 'INTEGER'),
+            ('diff_files', 'INTEGER'), ('added_lines', 'INTEGER'),
+            ('removed_lines', 'INTEGER'), ('equal_lines', 'INTEGER'),
+            ('different_files', 'INTEGER'), ('different_lines', 'INTEGER'),
+            ('common_files', 'INTEGER'), ('common_lines', 'INTEGER'),
+            ('diff_commits', 'INTEGER'), ('evaluated_commits', 'INTEGER'),
+            ('closest_sequence', 'INTEGER'), ('closest_hash', 'TEXT'),
+            ('normal_effort', 'INTEGER')]
+METRIC_NAMES = [name for (name, type) in METRICS]
+
+
+class ResultsStore(SQLiteStore):
+    """Persistent store of results, by package and version.
+
+    The primary key (package, version) is the index for finding
+    the results of a package, and there is an index on date, too.
+    Results are read with cursors, so that they are produced one by
+    one, and not all of them are kept in memory.
+
+    :param path: path of the SQLite file
+
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS results (
+            package TEXT, version TEXT, date TEXT, {},
+            PRIMARY KEY (package, version));
+        CREATE INDEX IF NOT EXISTS results_date ON results (date);
+        CREATE TABLE IF NOT EXISTS missing (
+            package TEXT, version TEXT, error TEXT,
+            PRIMARY KEY (package, version));
+        """.format(', '.join(name + ' ' + type for (name, type) in METRICS))
+
+    def put(self, package, version, date, result):
+        """Store the result for a version of a package.
+
+        If it was stored as missing, it is not missing any more.
+
+        :param package: name of the package
+        :param version: version of the package
+        :param date:    date of the version
+        :param result:  dictionary with metrics (as produced by gitlag.lag)
+
+        """
+
+        unknown = set(result) - set(METRIC_NAMES)
+        if unknown:
+            logging.warning("ResultsStore: metrics not stored: "
+                            + str(sorted(unknown)))
+        conn = self._connect()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO results VALUES ({})".format(
+                            ','.join('?' * (len(METRICS) + 3))),
+                        [package, version, date]
+                        + [result.get(name) for name in METRIC_NAMES])
+            conn.execute("DELETE FROM missing WHERE package=? AND version=?",
+                        (package, version))
+
+    def put_missing(self, package, version, error):
+        """Store a version of a package as missing (not computed).
+
+        :param package: name of the package
+        :param version: version of the package
+        :param error:   arguments of the exception raised (tuple)
+
+        """
+
+        conn = self._connect()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO missing VALUES (?,?,?)",
+                        (package, version, json.dumps(error, default=str)))
+
+    def import_shelves(self, done=None, missing=None):
+        """Import results from shelves written by earlier debsnapshotlag.
+
+        In those shelves, keys are package:version. In the done shelf,
+        values are dictionaries with date and result. In the missing
+        shelf, values are the arguments of the exception raised.
+        Versions already in the store are replaced.
+
+        :param done:    path of the shelf with results (as for shelve.open),
+                        default None (no results imported)
+        :param missing: path of the shelf with missing versions
+                        (default None, no missing versions imported)
+        :returns:       tuple (results imported, missing imported)
+
+        """
+
+        imported = [0, 0]
+        if done is not None:
+            with shelve.open(done, flag='r') as shelf:
+                for key in shelf:
+                    (package, version) = key.split(':', 1)
+                    self.put(package, version, shelf[key]['date'],
+                            shelf[key]['result'])
+                    imported[0] += 1
+        if missing is not None:
+            with shelve.open(missing, flag='r') as shelf:
+                for key in shelf:
+                    (package, version) = key.split(':', 1)
+                    self.put_missing(package, version, shelf[key])
+                    imported[1] += 1
+        logging.info("ResultsStore: imported %d results, %d missing"
+                    % tuple(imported))
+        return tuple(imported)
+
+    def clear_missing(self):
+        """Remove all versions stored as missing.
+
+        """
+
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM missing")
+
+    @staticmethod
+    def _result(row):
+        """Result for a row of the results table.
+
+        :returns: tuple (package, version, date, dictionary with metrics)
+
+        """
+
+        return (row[0], row[1], row[2], dict(zip(METRIC_NAMES, row[3:])))
+
+    def get(self, package, version):
+        """Get the result for a version of a package.
+
+        :returns: tuple (date, dictionary with metrics), or None if not found
+
+        """
+
+        row = self._connect().execute("SELECT * FROM results "
+                                    "WHERE package=? AND version=?",
+                                    (package, version)).fetchone()
+        if row is None:
+            return None
+        return self._result(row)[2:]
+
+    def results(self, package=None):
+        """Get results, ordered by package and date.
+
+        :param package: name of the package (default None, all packages)
+        :returns:       iterator of tuples (package, version, date,
+                        dictionary with metrics)
+
+        """
+
+        conn = self._connect()
+        if package is None:
+            rows = conn.execute("SELECT * FROM results "
+                                "ORDER BY package, date, version")
+        else:
+            rows = conn.execute("SELECT * FROM results WHERE package=? "
+                                "ORDER BY date, version", (package,))
+        for row in rows:
+            yield self._result(row)
+
+    def missing(self, package=None):
+        """Get versions stored as missing, ordered by package and version.
+
+        :param package: name of the package (default None, all packages)
+        :returns:       iterator of tuples (package, version, error)
+
+        """
+
+        conn = self._connect()
+        if package is None:
+            rows = conn.execute("SELECT * FROM missing "
+                                "ORDER BY package, version")
+        else:
+            rows = conn.execute("SELECT * FROM missing WHERE package=? "
+                                "ORDER BY version", (package,))
+        for (package, version, error) in rows:
+            yield (package, version, tuple(json.loads(error)))
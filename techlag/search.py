@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2016 Bitergia
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+##
+## Authors:
+##   Jesus M. Gonzalez-Barahona <jgb@bitergia.com>
+##
+
+"""Strategies for searching the closest commit to a directory.
+
+Strategies are used by gitlag.Metrics.closest_commit. All of them
+work on a Metrics object, computing metrics for the commits they need
+to evaluate (by calling its commits_metrics method), and return the
+number of the closest commit found. The search may be limited to a
+window of commits (see Metrics.closest_commit).
+
+Strategies:
+
+* 'ratio': the original coarse to fine strategy, controlled by ratio
+and range (see RatioSearch).
+* 'golden': golden-section search, assuming the metric is unimodal
+along the list of commits, with local refinement (see UnimodalSearch).
+* 'ternary': same as 'golden', but splitting in thirds.
+* 'screen': screen all commits with cheap metrics, computed only from
+names and blob hashes of files, and evaluate only the most similar
+ones (see ScreenSearch).
+* 'exhaustive': evaluate all commits. Useful as a reference for
+checking the results of the other strategies.
+
+"""
+
+import logging
+
+STRATEGIES = ['ratio', 'golden', 'ternary', 'screen', 'exhaustive']
+
+# Fraction of the interval kept in each iteration of the golden-section search
+GOLDEN_FRACTION = (5 ** 0.5 - 1) / 2
+
+
+class Strategy:
+    """Base class for search strategies.
+
+    Subclasses should define search.
+
+    """
+
+    name = None
+
+    def search(self, metrics, metric, closest_fn, first=None, last=None):
+        """Search for the closest commit.
+
+        :param metrics:    Metrics object to use for evaluating commits
+        :param metric:     metric to decide if a commit is closer or not
+        :param closest_fn: function to evaluate the closest commit (min or max)
+        :param first:      first commit to consider (default None, first commit)
+        :param last:       last commit to consider (default None, last commit)
+        :returns:          number of the closest commit
+
+        """
+
+        raise NotImplementedError
+
+    @staticmethod
+    def bounds(metrics, first, last):
+        """Bounds of the window of commits to consider, with defaults.
+
+        :returns: tuple (first, last)
+
+        """
+
+        if first is None:
+            first = 0
+        if last is None:
+            last = len(metrics.commits) - 1
+        return (first, last)
+
+    @staticmethod
+    def closest(metrics, commits, metric, closest_fn):
+        """Find the closest commit among some evaluated commits.
+
+        If several commits have the closest value, the first one is returned.
+
+        :param metrics:    Metrics object with the evaluated commits
+        :param commits:    numbers of the commits to consider
+        :param metric:     metric to decide if a commit is closer or not
+        :param closest_fn: function to evaluate the closest commit (min or max)
+        :returns:          number of the closest commit
+
+        """
+
+        commits = sorted(commits)
+        values = [metrics.metrics[commit_no][metric] for commit_no in commits]
+        return commits[values.index(closest_fn(values))]
+
+    @staticmethod
+    def closer(metrics, metric, closest_fn, commit_1, commit_2):
+        """Check if an evaluated commit is closer than other.
+
+        :returns: True if commit_1 is closer than commit_2 (not equal)
+
+        """
+
+        (value_1, value_2) = (metrics.metrics[commit_1][metric],
+                                metrics.metrics[commit_2][metric])
+        return value_1 != value_2 and closest_fn([value_1, value_2]) == value_1
+
+    @classmethod
+    def refine(cls, metrics, metric, closest_fn, closest_seq, first, last,
+                window):
+        """Local refinement around the closest commit.
+
+        Neighbours of the closest commit (up to window commits on each
+        side, inside first and last) are evaluated, moving to the closest
+        of them while it is closer.
+
+        :returns: number of the closest commit
+
+        """
+
+        while True:
+            neighbours = [commit_no for commit_no
+                            in range(max(closest_seq - window, first),
+                                    min(closest_seq + window, last) + 1)
+                            if commit_no != closest_seq]
+            metrics.commits_metrics(neighbours)
+            closer_neighbours = [commit_no for commit_no in neighbours
+                                    if cls.closer(metrics, metric, closest_fn,
+                                                commit_no, closest_seq)]
+            if not closer_neighbours:
+                break
+            closest_seq = cls.closest(metrics, closer_neighbours,
+                                        metric, closest_fn)
+        return closest_seq
+
+
+class RatioSearch(Strategy):
+    """Coarse to fine search, controlled by ratio and range.
+
+    This is the strategy explained in Metrics.closest_commit: commits
+    are evaluated every step commits, and then the range of the closest
+    ones (of length range) is searched again, with a smaller step,
+    until a step of 1 is reached. Commits computed before the search
+    (for example, outside the window) are considered too when finding
+    the range of the closest ones.
+
+    :param ratio: ratio to calcuate steps each iteration
+    :param range: length of the range for each iteration
+
+    """
+
+    name = 'ratio'
+
+    def __init__(self, ratio=10, range=3):
+
+        self.ratio = ratio
+        self.range = range
+
+    def search(self, metrics, metric, closest_fn, first=None, last=None):
+
+        ratio = self.ratio
+        (left, right) = self.bounds(metrics, first, last)
+        # Next calculates the ceiling integer division
+        # Needed because we want eg. 1/3 to be 1
+        step = -( -(right-left+1) // ratio)
+        while step >= 1:
+            metrics.range_metrics (left, right, step)
+            closest = metrics.closest_range(length=self.range, metric=metric,
+                                            closest_fn=closest_fn)
+            (left, right, closest_seq, closest_value) = closest
+            logging.info("Step: %d, left: %d, right: %d, closest seq: %d, closest value: %d."
+                    % (step, left, right, closest_seq, closest_value))
+            if step == 1:
+                step = 0
+            else:
+                candidate_step = -( -(right-left+1) // ratio)
+                if (candidate_step >= step // 2) and (step // 2 >= 1):
+                    step = step // 2
+                else:
+                    step = candidate_step
+        return closest_seq
+
+
+class UnimodalSearch(Strategy):
+    """Search assuming that the metric is unimodal along the commits.
+
+    If the metric has a single closest value, with values getting
+    farther on both sides of it, the interval with the closest commit
+    can be shrunk in each iteration by evaluating two commits inside it,
+    and discarding the part beyond the farthest one. When the interval
+    is no longer than window, all its commits are evaluated, and then
+    neighbours of the closest one (up to window commits on each side) are
+    evaluated, moving to the closest of them while it is closer
+    (local refinement), in case the metric is not exactly unimodal.
+
+    fraction is the fraction of the interval kept in each iteration.
+    With GOLDEN_FRACTION (golden-section search), one of the commits
+    evaluated is (approximately) reused in the next iteration, since
+    metrics for commits are computed only once. With 2/3 (ternary
+    search), two new commits are evaluated in each iteration.
+
+    :param fraction: fraction of the interval kept in each iteration
+    :param window:   length of interval for evaluating all commits in it
+
+    """
+
+    def __init__(self, fraction=GOLDEN_FRACTION, window=3):
+
+        assert 0.5 < fraction < 1
+        self.fraction = fraction
+        self.window_length = max(window, 2)
+        if fraction == GOLDEN_FRACTION:
+            self.name = 'golden'
+        else:
+            self.name = 'ternary'
+
+    def search(self, metrics, metric, closest_fn, first=None, last=None):
+
+        (first, last) = self.bounds(metrics, first, last)
+        (left, right) = (first, last)
+        while right - left > self.window_length:
+            shift = round(self.fraction * (right - left))
+            (inner_left, inner_right) = (right - shift, left + shift)
+            if inner_left >= inner_right:
+                inner_right = inner_left + 1
+            metrics.commits_metrics([inner_left, inner_right])
+            if self.closer(metrics, metric, closest_fn,
+                            inner_right, inner_left):
+                left = inner_left
+            else:
+                right = inner_right
+            logging.info("Interval: left: %d, right: %d." % (left, right))
+        metrics.commits_metrics(list(range(left, right + 1)))
+        closest_seq = self.closest(metrics, range(left, right + 1),
+                                    metric, closest_fn)
+        return self.refine(metrics, metric, closest_fn, closest_seq,
+                            first, last, self.window_length)
+
+
+class ScreenSearch(Strategy):
+    """Screen commits with cheap metrics, and evaluate the most similar ones.
+
+    Screening metrics (see Metrics.screen_metrics) are computed for all
+    commits in the window, which only needs their trees. Commits are
+    ranked by proxy (and then by the other screening metrics), and
+    only the top ones are evaluated. Then, as UnimodalSearch does,
+    neighbours of the closest one (up to window commits on each side)
+    are evaluated while a closer one is found, in case the ranking
+    by proxy is not exactly the ranking by the metric.
+
+    :param top:    number of commits to evaluate, from the ranking
+    :param proxy:  screening metric for the ranking ('same_blobs', 'jaccard')
+    :param window: number of neighbours on each side for local refinement
+
+    """
+
+    name = 'screen'
+
+    def __init__(self, top=10, proxy='same_blobs', window=3):
+
+        assert proxy in ['same_blobs', 'jaccard']
+        self.top = max(top, 1)
+        self.proxy = proxy
+        self.window_length = max(window, 1)
+
+    def search(self, metrics, metric, closest_fn, first=None, last=None):
+
+        (first, last) = self.bounds(metrics, first, last)
+        screens = metrics.screen_metrics(range(first, last + 1))
+        ranking = sorted(screens, key=lambda commit_no: (
+            screens[commit_no][self.proxy],
+            screens[commit_no]['same_blobs'], screens[commit_no]['jaccard']),
+            reverse=True)
+        candidates = ranking[:self.top]
+        logging.info("Screened %d commits, candidates: %s."
+                    % (len(ranking), str(sorted(candidates))))
+        metrics.commits_metrics(candidates)
+        closest_seq = self.closest(metrics, candidates, metric, closest_fn)
+        return self.refine(metrics, metric, closest_fn, closest_seq,
+                            first, last, self.window_length)
+
+
+class ExhaustiveSearch(Strategy):
+    """Evaluate all commits, and find the closest one.
+
+    """
+
+    name = 'exhaustive'
+
+    def search(self, metrics, metric, closest_fn, first=None, last=None):
+
+        (first, last) = self.bounds(metrics, first, last)
+        commits = list(range(first, last + 1))
+        metrics.commits_metrics(commits)
+        return self.closest(metrics, commits, metric, closest_fn)
+
+
+def get_strategy(name, ratio=10, range=3, top=10, window=3):
+    """Get a strategy, given its name.
+
+    :param name:   name of the strategy (see STRATEGIES)
+    :param ratio:  ratio to calcuate steps each iteration ('ratio' strategy)
+    :param range:  length of the range for each iteration ('ratio' strategy),
+                   or length of the interval for evaluating all commits
+                   ('golden' and 'ternary' strategies)
+    :param top:    number of commits to evaluate ('screen' strategy)
+    :param window: number of neighbours for local refinement
+                   ('screen' strategy)
+    :returns:      Strategy object
+
+    """
+
+    if name == 'ratio':
+        return RatioSearch(ratio=ratio, range=range)
+    elif name == 'golden':
+        return UnimodalSearch(fraction=GOLDEN_FRACTION, window=range)
+    elif name == 'ternary':
+        return UnimodalSearch(fraction=2/3, window=range)
+    elif name == 'screen':
+        return ScreenSearch(top=top, window=window)
+    elif name == 'exhaustive':
+        return ExhaustiveSearch()
+    raise ValueError("Unknown search strategy", name)
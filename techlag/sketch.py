@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2016 Bitergia
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+##
+## Authors:
+##   Jesus M. Gonzalez-Barahona <jgb@bitergia.com>
+##
+
+"""MinHash sketches of trees, and an index of sketches of commits.
+
+The sketch of a tree is a MinHash of the set of (path, blob hash)
+pairs for its files. The fraction of positions where the sketches of
+two trees are equal is an estimation of the Jaccard similarity of
+their sets, that is, of how many files they have in common, with the
+same content.
+
+Sketches of the commits of a repository are stored in a SketchIndex,
+with locality sensitive hashing (LSH) by bands, so that the commits most
+similar to a directory can be found without comparing with all of them.
+
+"""
+
+import array
+import hashlib
+import logging
+import random
+
+from .cache import SQLiteStore
+from .gitlag import IGNORED_NAMES, LRUMemo, Tree
+
+# Number of hash functions (permutations) in sketches
+NUM_PERM = 64
+# Number of bands for LSH (each band has NUM_PERM // BANDS positions)
+BANDS = 16
+
+# Hash functions are (a * x + b) mod PRIME, with fixed a and b,
+# so that sketches are the same in any run
+PRIME = (1 << 61) - 1
+_random = random.Random(20160827)
+PERMUTATIONS = [(_random.randrange(1, PRIME), _random.randrange(0, PRIME))
+                for _ in range(NUM_PERM)]
+# Sketch of an empty set
+EMPTY = (PRIME,) * NUM_PERM
+
+
+def element_hash(path, blob):
+    """Hash for a (path, blob hash) pair, as an integer.
+
+    :param path: path of the file
+    :param blob: blob hash of the file
+    :returns:    hash (integer, less than PRIME)
+
+    """
+
+    sha = hashlib.sha1(path.encode(errors='surrogateescape') + b'\0'
+                        + blob.encode())
+    return int.from_bytes(sha.digest()[:8], 'big') % PRIME
+
+def merge(sketches):
+    """Sketch of the union of several sets, given their sketches.
+
+    :param sketches: list of sketches
+    :returns:        sketch (tuple)
+
+    """
+
+    if not sketches:
+        return EMPTY
+    return tuple(map(min, *sketches)) if len(sketches) > 1 else sketches[0]
+
+def tree_sketch(tree, memo=None, path=''):
+    """Sketch for the files in a tree, including those in its subtrees.
+
+    Sketches of subtrees are merged, so that if memo is a dictionary,
+    the sketches of subtrees (by path and hash of the subtree) are
+    cached in it, and subtrees shared by several trees (for example,
+    trees for consecutive commits) are sketched only once. A LRUMemo
+    can be used as memo, to bound its size.
+    Entries ignored when comparing trees are ignored here too.
+
+    :param tree: Tree
+    :param memo: dictionary with sketches of subtrees (default None)
+    :param path: path of the tree (default '', root of the tree)
+    :returns:    sketch (tuple)
+
+    """
+
+    key = (path, tree.hash)
+    if memo is not None and tree.hash is not None and key in memo:
+        return memo[key]
+    sketches = []
+    hashes = []
+    for name in set(tree) - IGNORED_NAMES:
+        entry = tree[name]
+        if isinstance(entry, str):
+            hashes.append(element_hash(path + name, entry))
+        elif isinstance(entry, Tree):
+            sketches.append(tree_sketch(entry, memo, path + name + '/'))
+    if hashes:
+        sketches.append(tuple(min((a * x + b) % PRIME for x in hashes)
+                            for (a, b) in PERMUTATIONS))
+    sketch = merge(sketches)
+    if memo is not None and tree.hash is not None:
+        memo[key] = sketch
+    return sketch
+
+def similarity(sketch_1, sketch_2):
+    """Estimated Jaccard similarity of two sets, given their sketches.
+
+    :returns: similarity (between 0 and 1)
+
+    """
+
+    return sum(1 for (value_1, value_2) in zip(sketch_1, sketch_2)
+                if value_1 == value_2) / NUM_PERM
+
+def band_keys(sketch):
+    """Keys of the bands of a sketch, for LSH.
+
+    :returns: list of keys (integers), one per band
+
+    """
+
+    rows = NUM_PERM // BANDS
+    return [int.from_bytes(hashlib.sha1(array.array('Q',
+                sketch[band*rows:(band+1)*rows]).tobytes()).digest()[:7], 'big')
+            for band in range(BANDS)]
+
+
+class SketchIndex(SQLiteStore):
+    """Persistent index of sketches of commits.
+
+    The index stores the sketch of the tree of each commit (by commit hash),
+    and the keys of its bands. Commits sharing the key of any band with
+    a tree are candidates to be similar to it (the more similar, the
+    more likely to share a band key).
+
+    The index is usually built once for an upstream repository (see
+    update, which only adds commits not in the index yet), and then
+    queried for the trees of many packages (or versions of packages)
+    derived from it.
+
+    When updating, memory use is bounded: sketches of subtrees are
+    memoized in a LRUMemo, and trees read from the repository for
+    each batch of commits are removed from its caches (see Repo.trees)
+    once the batch is done.
+
+    :param path: path of the SQLite file
+
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS sketches (
+            commit_hash TEXT PRIMARY KEY, sketch BLOB);
+        CREATE TABLE IF NOT EXISTS bands (
+            band INTEGER, key INTEGER, commit_hash TEXT);
+        CREATE INDEX IF NOT EXISTS bands_key ON bands (band, key);
+        """
+
+    # Number of commits inserted in each transaction
+    batch = 1000
+    # Maximum number of sketches of subtrees memoized while updating
+    memo_size = 100000
+
+    def update(self, repo):
+        """Add to the index the commits in a repository not yet in it.
+
+        :param repo: Repo object (git repository)
+        :returns:    number of commits added
+
+        """
+
+        conn = self._connect()
+        indexed = set(row[0] for row
+                        in conn.execute("SELECT commit_hash FROM sketches"))
+        to_add = [commit_no for (commit_no, commit) in enumerate(repo.commits)
+                    if commit[0] not in indexed]
+        logging.info("SketchIndex: adding %d commits" % len(to_add))
+        memo = LRUMemo(self.memo_size)
+        known_trees = set(repo.trees)
+        known_resolved = set(repo.resolved_trees)
+        for start in range(0, len(to_add), self.batch):
+            sketches = []
+            bands = []
+            for commit_no in to_add[start:start+self.batch]:
+                commit = repo.commits[commit_no][0]
+                sketch = tree_sketch(repo.tree(commit_no), memo)
+                sketches.append((commit, array.array('Q', sketch).tobytes()))
+                bands.extend((band, key, commit) for (band, key)
+                                in enumerate(band_keys(sketch)))
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO sketches VALUES (?,?)",
+                                sketches)
+                conn.executemany("INSERT INTO bands VALUES (?,?,?)", bands)
+            for (cache, known) in ((repo.trees, known_trees),
+                                    (repo.resolved_trees, known_resolved)):
+                for hash in set(cache) - known:
+                    del cache[hash]
+        return len(to_add)
+
+    def query(self, tree, k=5, memo=None):
+        """Find the commits most similar to a tree.
+
+        Candidates are the commits sharing some band key with the tree.
+        If there is none, all commits are considered (which is slower).
+        Candidates are ranked by the similarity of their sketches.
+
+        :param tree: Tree (for example, the tree of a BaseDir)
+        :param k:    maximum number of commits to return
+        :param memo: dictionary with sketches of subtrees (see tree_sketch)
+        :returns:    list of tuples (commit hash, similarity),
+                     most similar first
+
+        """
+
+        conn = self._connect()
+        sketch = tree_sketch(tree, memo)
+        candidates = set()
+        for (band, key) in enumerate(band_keys(sketch)):
+            candidates.update(row[0] for row in conn.execute(
+                "SELECT commit_hash FROM bands WHERE band=? AND key=?",
+                (band, key)))
+        if candidates:
+            rows = []
+            for commit in candidates:
+                rows.extend(conn.execute("SELECT commit_hash, sketch "
+                                        "FROM sketches WHERE commit_hash=?",
+                                        (commit,)))
+        else:
+            logging.info("SketchIndex: no candidates, checking all commits")
+            rows = conn.execute("SELECT commit_hash, sketch FROM sketches")
+        similar = [(commit, similarity(sketch, array.array('Q', blob)))
+                    for (commit, blob) in rows]
+        similar.sort(key=lambda item: (-item[1], item[0]))
+        logging.debug("SketchIndex.query(): " + str(similar[:k]))
+        return similar[:k]
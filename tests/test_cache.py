@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2016 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#     Jesus M. Gonzalez-Barahona <jgb@bitergia.com>
+#
+
+import gzip
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+if not '..' in sys.path:
+    sys.path.insert(0, '..')
+
+import techlag.gitlag
+import techlag.cache
+
+class TestMetricsCache(unittest.TestCase):
+    """Tests for the MetricsCache class"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_path = tempfile.mkdtemp(prefix='gitlag_')
+        cls.dir1 = os.path.join(cls.tmp_path, 'dirs', 'dir1')
+        cls.dir2 = os.path.join(cls.tmp_path, 'dirs', 'dir2')
+        cls.url_git = os.path.join(cls.tmp_path, 'dir_git')
+        cls.cloned_git = os.path.join(cls.tmp_path, 'cloned_git')
+
+        subprocess.check_call(['tar', '-xzf', 'data/dirs.tar.gz',
+                               '-C', cls.tmp_path])
+        subprocess.check_call(['tar', '-xzf', 'data/dir_git.tar.gz',
+                               '-C', cls.tmp_path])
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_path)
+
+    def test_get_put(self):
+        """Test MetricsCache.get and MetricsCache.put"""
+
+        path = os.path.join(self.tmp_path, 'get_put.cache')
+        cache = techlag.cache.MetricsCache(path)
+        self.assertIsNone(cache.get('f1', 'c1', ['same']))
+        cache.put('f1', 'c1', ['same', 'diff'], {'same_files': 3})
+        self.assertEqual(cache.get('f1', 'c1', ['diff', 'same']),
+                        {'same_files': 3})
+        self.assertIsNone(cache.get('f1', 'c1', ['same']))
+        cache.close()
+        # Persistent across objects
+        cache = techlag.cache.MetricsCache(path)
+        self.assertEqual(cache.get('f1', 'c1', ['diff', 'same']),
+                        {'same_files': 3})
+        cache.close()
+
+    def test_evict(self):
+        """Test that MetricsCache evicts least recently used entries"""
+
+        path = os.path.join(self.tmp_path, 'evict.cache')
+        cache = techlag.cache.MetricsCache(path, max_entries=10)
+        for commit in range(10):
+            cache.put('f', str(commit), ['same'], {'commit': commit})
+        cache.get('f', '0', ['same'])
+        cache.put('f', '10', ['same'], {'commit': 10})
+        cache.evict()
+        self.assertEqual(cache.get('f', '0', ['same']), {'commit': 0})
+        self.assertIsNone(cache.get('f', '1', ['same']))
+        self.assertEqual(cache.get('f', '10', ['same']), {'commit': 10})
+        cache.close()
+
+    def test_used_batched(self):
+        """Test that MetricsCache writes times of use in batches"""
+
+        path = os.path.join(self.tmp_path, 'used.cache')
+        cache = techlag.cache.MetricsCache(path)
+        cache.put('f', 'c', ['same'], {'commit': 0})
+        query = "SELECT used FROM metrics WHERE commit_hash='c'"
+        (stored,) = cache._connect().execute(query).fetchone()
+        self.assertEqual(cache.get('f', 'c', ['same']), {'commit': 0})
+        self.assertEqual(cache._connect().execute(query).fetchone(), (stored,))
+        self.assertEqual(len(cache.used), 1)
+        cache.flush()
+        (used,) = cache._connect().execute(query).fetchone()
+        self.assertGreaterEqual(used, stored)
+        self.assertEqual(cache.used, {})
+
+    def test_metrics_cache(self):
+        """Test that Metrics uses the cache"""
+
+        path = os.path.join(self.tmp_path, 'metrics.cache')
+        repo = techlag.gitlag.Repo(url=self.url_git, dir=self.cloned_git)
+        cache = techlag.cache.MetricsCache(path)
+        metrics = techlag.gitlag.Metrics(repo=repo, dir=self.dir2,
+                                        metrics_kinds=['same'], cache=cache)
+        expected = metrics.closest_commit(closest_fn=max,
+                                        metric='common_lines')
+        computed = metrics.metrics_items()
+        # A new Metrics object, for a copy of the directory, which
+        # cannot compare (all metrics should come from the cache)
+        copy = os.path.join(self.tmp_path, 'copy')
+        shutil.copytree(self.dir2, copy)
+        metrics = techlag.gitlag.Metrics(repo=repo, dir=copy,
+                                        metrics_kinds=['same'], cache=cache)
+        metrics.basedir.compare = None
+        result = metrics.closest_commit(closest_fn=max,
+                                        metric='common_lines')
+        self.assertEqual(result, expected)
+        self.assertEqual(metrics.metrics_items(), computed)
+        cache.close()
+
+class TestLinesCache(unittest.TestCase):
+    """Tests for the LinesCache class"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_path = tempfile.mkdtemp(prefix='gitlag_')
+        cls.dir1 = os.path.join(cls.tmp_path, 'dirs', 'dir1')
+        cls.dir2 = os.path.join(cls.tmp_path, 'dirs', 'dir2')
+        cls.url_git = os.path.join(cls.tmp_path, 'dir_git')
+        cls.cloned_git = os.path.join(cls.tmp_path, 'cloned_git')
+
+        subprocess.check_call(['tar', '-xzf', 'data/dirs.tar.gz',
+                               '-C', cls.tmp_path])
+        subprocess.check_call(['tar', '-xzf', 'data/dir_git.tar.gz',
+                               '-C', cls.tmp_path])
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_path)
+
+    def test_get_set(self):
+        """Test LinesCache.get, setting items, and persistence"""
+
+        path = os.path.join(self.tmp_path, 'get_set.cache')
+        blob = techlag.gitlag.blob_hash(b'one\ntwo\n')
+        cache = techlag.cache.LinesCache(path)
+        self.assertIsNone(cache.get(blob))
+        cache[blob] = 2
+        self.assertEqual(cache.get(blob), 2)
+        cache.close()
+        cache = techlag.cache.LinesCache(path)
+        self.assertEqual(cache.get(blob), 2)
+        cache.close()
+
+    def test_shared(self):
+        """Test a LinesCache shared by Metrics objects, in both modes"""
+
+        path = os.path.join(self.tmp_path, 'shared.cache')
+        repo = techlag.gitlag.Repo(url=self.url_git, dir=self.cloned_git)
+        cache = techlag.cache.LinesCache(path)
+        for mode in techlag.gitlag.MODES:
+            for dir in [self.dir1, self.dir2]:
+                expected = techlag.gitlag.Metrics(repo=repo, dir=dir,
+                                        metrics_kinds=['same', 'diff'],
+                                        mode=mode)
+                metrics = techlag.gitlag.Metrics(repo=repo, dir=dir,
+                                        metrics_kinds=['same', 'diff'],
+                                        mode=mode, lines_cache=cache)
+                for commit_no in range(repo.last_commit() + 1):
+                    self.assertEqual(metrics.commit_metrics(commit_no),
+                                    expected.commit_metrics(commit_no))
+        cache.close()
+        # Lines for files only in commits (eg, only2/some.txt) are cached
+        cache = techlag.cache.LinesCache(path)
+        blob = repo.tree(2)['only2']['some.txt']
+        self.assertEqual(cache.get(blob), 5)
+        cache.close()
+
+class TestResponseCache(unittest.TestCase):
+    """Tests for the ResponseCache class"""
+
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp(prefix='gitlag_')
+        self.path = os.path.join(self.tmp_path, 'http.cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def test_get_put(self):
+        """Test ResponseCache.get, ResponseCache.put, and persistence"""
+
+        url = 'http://snapshot.debian.org/mr/file/0123abcd/info'
+        cache = techlag.cache.ResponseCache(self.path)
+        self.assertEqual(cache.get(url), (False, None))
+        cache.put(url, [{'name': 'pkg_1.0.dsc'}])
+        self.assertEqual(cache.get(url), (True, [{'name': 'pkg_1.0.dsc'}]))
+        cache.close()
+        cache = techlag.cache.ResponseCache(self.path)
+        self.assertEqual(cache.get(url), (True, [{'name': 'pkg_1.0.dsc'}]))
+        cache.close()
+
+    def test_expires(self):
+        """Test that only results for immutable urls are kept forever"""
+
+        urls = {'http://snapshot.debian.org/mr/file/0123abcd/info': [1],
+            'http://snapshot.debian.org/mr/package/pkg/1.0/srcfiles': [2],
+            'http://snapshot.debian.org/mr/package/pkg/': [3],
+            'http://snapshot.debian.org/mr/package/pkg/2.0/srcfiles': None}
+        cache = techlag.cache.ResponseCache(self.path, ttl=-1)
+        for (url, result) in urls.items():
+            cache.put(url, result)
+        found = {url: cache.get(url)[0] for url in urls}
+        self.assertEqual(list(found.values()), [True, True, False, False])
+        found = {url: cache.get(url, expired=True) for url in urls}
+        self.assertEqual(found, {url: (True, result)
+                                for (url, result) in urls.items()})
+        cache.close()
+
+class TestSourcesCatalogue(unittest.TestCase):
+    """Tests for the SourcesCatalogue class, and parsing Sources.gz"""
+
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp(prefix='gitlag_')
+        self.sources = os.path.join(self.tmp_path, 'Sources.gz')
+        with gzip.open(self.sources, 'wt') as file:
+            file.write("Package: pkg1\nVersion: 1.0\nFiles:\n"
+                " 0123 10 pkg1_1.0.dsc\n 4567 20 pkg1_1.0.orig.tar.gz\n"
+                "Directory: pool/main/p/pkg1\n\n"
+                "Package: pkg2\nDirectory: pool/main/p/pkg2\nFiles:\n"
+                " 89ab 30 pkg2_2.0.dsc\nChecksums-Sha1:\n"
+                " cdef 30 pkg2_2.0.dsc\n\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def test_parse_sources(self):
+        """Test parse_sources and get_dpkg_data"""
+
+        expected = [('pkg1', {'directory': 'pool/main/p/pkg1',
+                            'dsc': 'pkg1_1.0.dsc',
+                            'components': ['pkg1_1.0.dsc',
+                                            'pkg1_1.0.orig.tar.gz']}),
+                    ('pkg2', {'directory': 'pool/main/p/pkg2',
+                            'dsc': 'pkg2_2.0.dsc',
+                            'components': ['pkg2_2.0.dsc']})]
+        result = list(techlag.gitlag.parse_sources(self.sources))
+        self.assertEqual(result, expected)
+        result = techlag.gitlag.get_dpkg_data(self.sources, 'pkg2')
+        self.assertEqual(result, expected[1][1])
+        result = techlag.gitlag.get_dpkg_data(self.sources, 'pkg3')
+        self.assertEqual(result, {'components': []})
+
+    def test_catalogue(self):
+        """Test SourcesCatalogue.load, SourcesCatalogue.get, and expiration"""
+
+        path = os.path.join(self.tmp_path, 'sources.catalogue')
+        catalogue = techlag.cache.SourcesCatalogue(path)
+        self.assertTrue(catalogue.expired('testing/main'))
+        result = catalogue.load('testing/main',
+                                techlag.gitlag.parse_sources(self.sources))
+        self.assertEqual(result, 2)
+        self.assertFalse(catalogue.expired('testing/main'))
+        self.assertTrue(catalogue.expired('stable/main'))
+        catalogue.close()
+        catalogue = techlag.cache.SourcesCatalogue(path)
+        self.assertEqual(catalogue.get('testing/main', 'pkg1'),
+                        techlag.gitlag.get_dpkg_data(self.sources, 'pkg1'))
+        self.assertIsNone(catalogue.get('testing/main', 'pkg3'))
+        self.assertIsNone(catalogue.get('stable/main', 'pkg1'))
+        catalogue.close()
+        catalogue = techlag.cache.SourcesCatalogue(path, ttl=-1)
+        self.assertTrue(catalogue.expired('testing/main'))
+        catalogue.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -27,6 +27,7 @@ import subprocess
 import sys
 import tempfile
 import unittest
+import unittest.mock
 import filecmp
 import logging
 
@@ -133,6 +134,54 @@ class TestCompareDir(unittest.TestCase):
         dircmp.compare(self.dir3)
         self.assertEqual(dircmp.lines, result)
 
+    def test_manifest(self):
+        """Test that manifests are built, saved and loaded
+
+        """
+
+        manifest = techlag.gitlag.Manifest.from_dir(self.dir1)
+        self.assertEqual(manifest.files['dir_common/only_1.txt'][2], 6)
+        self.assertEqual(manifest.files['file_dir1.txt'][2], 3)
+        self.assertIn('dir_common', manifest.dirs)
+        path = os.path.join(self.tmp_path, 'dir1.manifest')
+        manifest.save(path)
+        loaded = techlag.gitlag.Manifest.load(path)
+        self.assertEqual(loaded.files, manifest.files)
+        self.assertEqual(loaded.dirs, manifest.dirs)
+        self.assertEqual(loaded.others, manifest.others)
+        self.assertEqual(loaded.tree(), manifest.tree())
+        self.assertEqual(loaded.tree().hash, manifest.tree().hash)
+        os.remove(path)
+
+    def test_basedir_manifest(self):
+        """Test that BaseDir uses a saved manifest, not reading its directory
+
+        """
+
+        path = techlag.gitlag.manifest_path(self.dir1)
+        dircmp = techlag.gitlag.BaseDir(self.dir1, metrics=['same', 'diff'],
+                                        manifest=path)
+        self.assertTrue(os.path.exists(path))
+        expected = dircmp.compare(self.dir2)
+
+        # Directory is not read again: files are read only to compare
+        # different files
+        opened = []
+        real_open = open
+        def tracked_open(file, *args, **kwargs):
+            opened.append(file)
+            return real_open(file, *args, **kwargs)
+        with unittest.mock.patch('builtins.open', tracked_open):
+            dircmp = techlag.gitlag.BaseDir(self.dir1,
+                                            metrics=['same', 'diff'],
+                                            manifest=path)
+            m = dircmp.compare(self.dir2)
+        self.assertEqual(m, expected)
+        dir1_files = [file for file in opened if file.startswith(self.dir1 + os.sep)]
+        self.assertEqual(dir1_files, [os.path.join(self.dir1,
+                                    'dir_common', 'diff.txt')])
+        os.remove(path)
+
 if __name__ == "__main__":
 #    logging.basicConfig(level=logging.DEBUG)
     unittest.main()
@@ -103,6 +103,135 @@ class TestCompareGit(TestGitSimple):
                                                 metric='common_lines')
         self.assertEqual(result, expected_3)
 
+class TestCompareBlobs(TestGitSimple):
+    """Tests for comparing a directory to a git repository, in blobs mode"""
+
+    def test_commit_metrics(self):
+        """Test that Metrics.commit_metrics is the same for both modes"""
+
+        repo = techlag.gitlag.Repo(url=self.url_git, dir=self.cloned_git)
+        for dir in [self.dir1, self.dir2, self.dir3]:
+            checkout = techlag.gitlag.Metrics(repo=repo, dir=dir,
+                                        metrics_kinds=['same', 'diff'])
+            blobs = techlag.gitlag.Metrics(repo=repo, dir=dir,
+                                        metrics_kinds=['same', 'diff'],
+                                        mode='blobs')
+            for commit_no in range(repo.last_commit() + 1):
+                self.assertEqual(blobs.commit_metrics(commit_no),
+                                checkout.commit_metrics(commit_no))
+
+    def test_compare_tree_incremental(self):
+        """Test that BaseDir.compare_tree only compares changed subtrees"""
+
+        repo = techlag.gitlag.Repo(url=self.url_git, dir=self.cloned_git)
+        basedir = techlag.gitlag.BaseDir(self.dir1, metrics=['same', 'diff'])
+        # Root, dir_common and only_1 are compared
+        first = basedir.compare_tree(repo.tree(0), repo.read_blob)
+        self.assertEqual(len(basedir.tree_metrics), 3)
+        # Same tree again: nothing new is compared
+        self.assertEqual(basedir.compare_tree(repo.tree(0), repo.read_blob),
+                        first)
+        self.assertEqual(len(basedir.tree_metrics), 3)
+        # Next commit, which changes files in dir_common, but not
+        # in only_1: only root and dir_common are compared
+        second = basedir.compare_tree(repo.tree(1), repo.read_blob)
+        self.assertEqual(len(basedir.tree_metrics), 5)
+        self.assertEqual(second, techlag.gitlag.BaseDir(self.dir1,
+                                metrics=['same', 'diff']).compare_tree(
+                                repo.tree(1), repo.read_blob))
+
+    def test_closest_commit(self):
+        """Test Metrics.closest_commit in blobs mode"""
+
+        expected = {
+            'date': 'Sat Aug 27 17:02:06 2016 +0200',
+            'sequence': 1, 'diff': 27,
+            'hash': 'a8c58489359197983a2e7235fd3e09346313a430'
+            }
+
+        repo = techlag.gitlag.Repo(url=self.url_git, dir=self.cloned_git)
+        metrics = techlag.gitlag.Metrics(repo=repo, dir=self.dir2,
+                                        metrics_kinds=['same'], mode='blobs')
+        result = metrics.closest_commit(closest_fn=max,
+                                                metric='common_lines')
+        self.assertEqual(result, expected)
+
+class TestCompareSymlinks(unittest.TestCase):
+    """Tests for comparing with commits with symbolic links, in both modes"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_path = tempfile.mkdtemp(prefix='gitlag_')
+        cls.url_git = os.path.join(cls.tmp_path, 'links_git')
+        cls.cloned_git = os.path.join(cls.tmp_path, 'cloned_git')
+        cls.dir = os.path.join(cls.tmp_path, 'dir')
+        git = ['git', '-C', cls.url_git, '-c', 'user.name=Test',
+                '-c', 'user.email=test@example.com']
+        os.makedirs(os.path.join(cls.url_git, 'sub', 'deep'))
+        for (path, lines) in [('f.txt', 3), ('sub/g.txt', 2),
+                            ('sub/deep/h.txt', 4)]:
+            with open(os.path.join(cls.url_git, path), 'w') as f:
+                f.write(''.join('line {}\n'.format(n) for n in range(lines)))
+        links = [('link', 'f.txt'), ('chain', 'link'), ('sublink', 'sub'),
+                ('broken', 'missing'), ('absolute', '/nonexistent/f.txt'),
+                ('sub/up', '../f.txt'), ('sub/loop', '..'),
+                ('sub/deep/cross', '../../sublink/g.txt'),
+                ('outside', '../f.txt'), ('notdir', 'f.txt/'),
+                ('loop1', 'loop2'), ('loop2', 'loop1')]
+        for (path, target) in links:
+            os.symlink(target, os.path.join(cls.url_git, path))
+        subprocess.check_call(['git', 'init', '-q', cls.url_git])
+        subprocess.check_call(git + ['add', '-A'])
+        subprocess.check_call(git + ['commit', '-q', '-m', 'Links'])
+        # Base directory: regular copies of files, and some links
+        os.makedirs(os.path.join(cls.dir, 'sub', 'deep'))
+        for path in ['f.txt', 'sub/g.txt', 'sub/deep/h.txt']:
+            shutil.copy(os.path.join(cls.url_git, path),
+                        os.path.join(cls.dir, path))
+        shutil.copy(os.path.join(cls.url_git, 'f.txt'),
+                    os.path.join(cls.dir, 'link'))
+        shutil.copy(os.path.join(cls.url_git, 'sub/g.txt'),
+                    os.path.join(cls.dir, 'sub', 'deep', 'cross'))
+        os.symlink('sub', os.path.join(cls.dir, 'sublink'))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_path)
+
+    def test_commit_metrics(self):
+        """Test that Metrics.commit_metrics is the same for both modes"""
+
+        repo = techlag.gitlag.Repo(url=self.url_git, dir=self.cloned_git)
+        checkout = techlag.gitlag.Metrics(repo=repo, dir=self.dir,
+                                        metrics_kinds=['same', 'diff'])
+        blobs = techlag.gitlag.Metrics(repo=repo, dir=self.dir,
+                                        metrics_kinds=['same', 'diff'],
+                                        mode='blobs')
+        expected = checkout.commit_metrics(0)
+        # f.txt, link, sub/g.txt, sub/deep/h.txt, sub/deep/cross,
+        # and the last three in sublink
+        self.assertEqual(expected['same_files'], 8)
+        self.assertEqual(expected['diff_files'], 0)
+        self.assertEqual(blobs.commit_metrics(0), expected)
+
+    def test_tree(self):
+        """Test Repo.tree, with symbolic links resolved"""
+
+        repo = techlag.gitlag.Repo(url=self.url_git, dir=self.cloned_git)
+        tree = repo.tree(0)
+        self.assertEqual(tree['link'], tree['f.txt'])
+        self.assertEqual(tree['chain'], tree['f.txt'])
+        self.assertEqual(tree['sub']['up'], tree['f.txt'])
+        self.assertEqual(tree['sub']['deep']['cross'], tree['sub']['g.txt'])
+        self.assertEqual(tree['sublink']['g.txt'], tree['sub']['g.txt'])
+        self.assertEqual(tree['sublink'].hash, tree['sub'].hash)
+        for name in ['broken', 'absolute', 'outside', 'notdir', 'loop1']:
+            self.assertIsNone(tree[name])
+        self.assertIsNone(tree['sub']['loop'])
+        self.assertIsNone(tree['sublink']['loop'])
+        # Same tree for the same commit
+        self.assertIs(repo.tree(0), tree)
+
 class TestCompareCheckouts(TestGitSimple):
     """Tests for comparing checkouts"""
 
@@ -120,6 +249,24 @@ class TestCompareCheckouts(TestGitSimple):
         result = metrics.compare_checkouts(1, 0)
         self.assertEqual (result, expected)
 
+    def test_compare_checkouts_blobs (self):
+        """Test Metrics.compare_checkouts in blobs mode"""
+
+        repo = techlag.gitlag.Repo(url=self.url_git, dir=self.cloned_git)
+        store = tempfile.mkdtemp(dir=self.tmp_path)
+        checkout = techlag.gitlag.Metrics(repo=repo, dir=self.dir2,
+                                        metrics_kinds=['same'])
+        blobs = techlag.gitlag.Metrics(repo=repo, dir=self.dir2,
+                                        metrics_kinds=['same'],
+                                        mode='blobs', store=store)
+        for left in range(repo.last_commit() + 1):
+            for right in range(repo.last_commit() + 1):
+                for kinds in [['same'], ['diff'], ['same', 'diff']]:
+                    self.assertEqual(blobs.compare_checkouts(left, right, kinds),
+                                checkout.compare_checkouts(left, right, kinds))
+        # No checkout was stored
+        self.assertEqual(os.listdir(store), [])
+
 class TestCompareGitSmall(unittest.TestCase):
     """Tests for comparing a dirctory to a small git repository
 
@@ -193,6 +340,58 @@ class TestCompareGitSmall(unittest.TestCase):
                                         metric='common_lines')
         self.assertEqual(result, self.expected[2])
 
+    def test_closest_commit_blobs (self):
+        """Test Metrics.closest_commit in blobs mode"""
+
+        for (dir, expected) in zip([self.dir1, self.dir2, self.dir3],
+                                    self.expected):
+            metrics = techlag.gitlag.Metrics(repo=self.repo, dir=dir,
+                                            metrics_kinds=['same'],
+                                            mode='blobs')
+            result = metrics.closest_commit(closest_fn=max,
+                                            metric='common_lines')
+            self.assertEqual(result, expected)
+
+    def test_closest_commit_workers (self):
+        """Test Metrics.closest_commit with a pool of workers"""
+
+        for mode in techlag.gitlag.MODES:
+            metrics = techlag.gitlag.Metrics(repo=self.repo, dir=self.dir2,
+                                            metrics_kinds=['same'],
+                                            mode=mode, workers=3)
+            result = metrics.closest_commit(closest_fn=max,
+                                            metric='common_lines')
+            pool_dir = metrics.pool.dir
+            metrics.close()
+            self.assertEqual(result, self.expected[1])
+            self.assertFalse(os.path.exists(pool_dir))
+
+    def test_closest_commit_pool (self):
+        """Test Metrics.closest_commit with a pool shared by Metrics objects"""
+
+        store = tempfile.mkdtemp(dir=self.tmp_path)
+        for mode in techlag.gitlag.MODES:
+            pool = techlag.gitlag.MetricsPool(self.repo, 3,
+                                            worktrees=(mode == 'checkout'),
+                                            store=store)
+            for (dir, expected) in [(self.dir2, self.expected[1]),
+                                    (self.dir1, self.expected[0]),
+                                    (self.dir2, self.expected[1])]:
+                metrics = techlag.gitlag.Metrics(repo=self.repo, dir=dir,
+                                                metrics_kinds=['same'],
+                                                mode=mode, pool=pool)
+                result = metrics.closest_commit(closest_fn=max,
+                                                metric='common_lines')
+                metrics.close()
+                self.assertEqual(result, expected)
+                # The pool (and its worktrees) is still there
+                self.assertIsNotNone(pool.executor)
+                worktrees = [name for name in os.listdir(pool.dir)
+                            if name.startswith('worktree-')]
+                self.assertEqual(len(worktrees), 3 if mode == 'checkout' else 0)
+            pool.close()
+            self.assertEqual(os.listdir(store), [])
+
     def test_closest_commit_4 (self):
         """Test Metrics.closest_commit"""
 
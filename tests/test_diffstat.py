@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2016 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#     Jesus M. Gonzalez-Barahona <jgb@bitergia.com>
+#
+
+import itertools
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+if not '..' in sys.path:
+    sys.path.insert(0, '..')
+
+import techlag.diffstat
+
+class TestDiffStat(unittest.TestCase):
+    """Tests for the engines in diffstat"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_path = tempfile.mkdtemp(prefix='gitlag_')
+        subprocess.check_call(['tar', '-xzf', 'data/dirs.tar.gz',
+                               '-C', cls.tmp_path])
+        subprocess.check_call(['tar', '-xzf', 'data/dirs2.tar.gz',
+                               '-C', cls.tmp_path])
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_path)
+
+    @staticmethod
+    def read_files(dir):
+        """Read all files in dir, as dictionary of lists of lines"""
+
+        files = {}
+        for (root, dirs, names) in os.walk(dir):
+            for name in names:
+                path = os.path.join(root, name)
+                with open(path, encoding="ascii", errors="surrogateescape") as f:
+                    files[os.path.relpath(path, dir)] = f.readlines()
+        return files
+
+    def test_counting(self):
+        """Test counting engine with simple cases"""
+
+        stat = techlag.diffstat.counting_stat
+        self.assertEqual(stat([], []), (0, 0, 0, 0))
+        self.assertEqual(stat(['a\n'], []), (1, 0, 1, 0))
+        self.assertEqual(stat([], ['a\n', 'b\n']), (1, 2, 0, 0))
+        self.assertEqual(stat(['a\n', 'b\n'], ['a\n', 'b\n']), (0, 0, 0, 2))
+        self.assertEqual(stat(['a\n', 'b\n', 'c\n'], ['a\n', 'x\n', 'c\n']),
+                        (1, 1, 1, 2))
+        self.assertEqual(stat(['a\n', 'b\n', 'c\n', 'd\n'],
+                            ['c\n', 'd\n', 'a\n', 'b\n']),
+                        (1, 2, 2, 2))
+
+    def test_counting_junk(self):
+        """Test counting engine with popular lines, in replaced blocks
+
+        Lines appearing more than 1% of times in right lists of 200 lines
+        or more are not matched by SequenceMatcher, so they end in replaced
+        blocks, where Differ only synchs on them if there are no similar
+        lines.
+
+        """
+
+        left = ['line {}\n'.format(n) for n in range(150)] \
+            + ['}\n', 'similar line 1\n', '}\n'] * 20
+        right = ['line {}\n'.format(n) for n in range(150)] \
+            + ['}\n', 'similar line 2\n'] * 30
+        self.assertEqual(techlag.diffstat.counting_stat(left, right),
+                        techlag.diffstat.difflib_stat(left, right))
+
+    def test_regressions(self):
+        """Test engines with cases where histogram and difflib differ
+
+        counting (and validate) produce the same results as difflib,
+        histogram does not (it is not the default engine).
+
+        """
+
+        left = ['b\n', 'b\n', 'c\n']
+        right = ['c\n', 'b\n', 'b\n']
+        expected = (1, 1, 1, 2)
+        self.assertEqual(techlag.diffstat.difflib_stat(left, right), expected)
+        for engine in ['counting', 'difflib', 'validate']:
+            self.assertEqual(techlag.diffstat.diff_stat(left, right,
+                                                        engine=engine),
+                            expected)
+        self.assertEqual(techlag.diffstat.diff_stat(left, right), expected)
+        self.assertEqual(techlag.diffstat.histogram_stat(left, right),
+                        (1, 2, 2, 1))
+
+    def test_random(self):
+        """Test counting engine against difflib, with random lists of lines"""
+
+        rand = random.Random(20161016)
+        lines = ['line {}\n'.format(n) for n in range(6)] \
+            + ['line {}x\n'.format(n) for n in range(3)] + ['\n', '}\n']
+        for _ in range(2000):
+            left = [rand.choice(lines) for _ in range(rand.randint(0, 20))]
+            right = [rand.choice(lines) for _ in range(rand.randint(0, 20))]
+            self.assertEqual(techlag.diffstat.counting_stat(left, right),
+                            techlag.diffstat.difflib_stat(left, right))
+
+    def test_simple(self):
+        """Test histogram engine with simple cases"""
+
+        stat = techlag.diffstat.histogram_stat
+        self.assertEqual(stat([], []), (0, 0, 0, 0))
+        self.assertEqual(stat(['a\n'], []), (1, 0, 1, 0))
+        self.assertEqual(stat([], ['a\n', 'b\n']), (1, 2, 0, 0))
+        self.assertEqual(stat(['a\n', 'b\n'], ['a\n', 'b\n']), (0, 0, 0, 2))
+        self.assertEqual(stat(['a\n', 'b\n', 'c\n'], ['a\n', 'x\n', 'c\n']),
+                        (1, 1, 1, 2))
+        self.assertEqual(stat(['a\n', 'b\n', 'c\n', 'd\n'],
+                            ['c\n', 'd\n', 'a\n', 'b\n']),
+                        (1, 2, 2, 2))
+
+    def test_frequent_lines(self):
+        """Test histogram engine with regions with only frequent lines"""
+
+        left = ['a\n'] + ['}\n', '\n'] * 100
+        right = ['b\n'] + ['\n', '}\n'] * 100
+        self.assertEqual(techlag.diffstat.histogram_stat(left, right),
+                        (1, 2, 2, 199))
+
+    def test_validate_fixtures(self):
+        """Validate counting engine against difflib with test fixtures
+
+        Results should be equal for all files. Results of histogram
+        should be consistent (equal lines are counted only once).
+
+        """
+
+        dirs = [os.path.join(self.tmp_path, 'dirs', dir)
+                for dir in ['dir1', 'dir2', 'dir3']]
+        dirs2 = [os.path.join(self.tmp_path, 'dirs2', dir)
+                for dir in ['b306b9d', '7beb12a', '6d1c3c1', '7beb12a-close']]
+        pairs = 0
+        equal = 0
+        for (left, right) in itertools.chain(itertools.permutations(dirs, 2),
+                                            itertools.permutations(dirs2, 2)):
+            left_files = self.read_files(left)
+            right_files = self.read_files(right)
+            for name in set(left_files) & set(right_files):
+                (left_lines, right_lines) = (left_files[name], right_files[name])
+                expected = techlag.diffstat.difflib_stat(left_lines, right_lines)
+                result = techlag.diffstat.counting_stat(left_lines, right_lines)
+                self.assertEqual(result, expected)
+                result = techlag.diffstat.histogram_stat(left_lines, right_lines)
+                self.assertEqual(result[0], expected[0])
+                self.assertEqual(result[1] + result[3], len(right_lines))
+                self.assertEqual(result[2] + result[3], len(left_lines))
+                pairs += 1
+        self.assertEqual(pairs, 100)
+
+    def test_validate(self):
+        """Test validate engine"""
+
+        left = ['a\n', 'b\n', 'c\n']
+        right = ['a\n', 'x\n', 'c\n']
+        with self.assertLogs(level='WARNING') as logs:
+            techlag.diffstat.diff_stat(left, left, engine='validate')
+            techlag.diffstat.diff_stat(left, right, engine='validate')
+            # Force a mismatch, by using a wrong counting engine
+            counting_stat = techlag.diffstat.counting_stat
+            techlag.diffstat.counting_stat = lambda left, right: (0, 0, 0, 0)
+            try:
+                result = techlag.diffstat.diff_stat(left, right,
+                                                    engine='validate')
+            finally:
+                techlag.diffstat.counting_stat = counting_stat
+        self.assertEqual(result, (1, 1, 1, 2))
+        self.assertEqual(len(logs.records), 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2016 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#     Jesus M. Gonzalez-Barahona <jgb@bitergia.com>
+#
+
+import gzip
+import hashlib
+import http.server
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+import urllib.error
+
+if not '..' in sys.path:
+    sys.path.insert(0, '..')
+
+import techlag.cache
+import techlag.download
+import techlag.gitlag
+
+
+class Handler(http.server.SimpleHTTPRequestHandler):
+    """Handler for the local HTTP server, serving files in its directory.
+
+    Connections and concurrent requests are counted in the server.
+
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.active += 1
+            self.server.max_active = max(self.server.max_active,
+                                        self.server.active)
+            self.server.paths.append(self.path)
+        try:
+            time.sleep(self.server.delay)
+            if self.path.startswith('/redirect/'):
+                self.send_response(302)
+                self.send_header('Location', self.path[len('/redirect'):])
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            else:
+                super().do_GET()
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+
+
+class TestDownloader(unittest.TestCase):
+    """Tests for Downloader, with a local HTTP server"""
+
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp(prefix='gitlag_')
+        self.served = os.path.join(self.tmp_path, 'served')
+        self.store = os.path.join(self.tmp_path, 'store')
+        os.makedirs(self.served)
+        os.makedirs(self.store)
+        for number in range(12):
+            with open(os.path.join(self.served, 'file%d.txt' % number),
+                        'w') as file:
+                file.write(('Line %d\n' % number) * 10000 * number)
+        with open(os.path.join(self.served, 'data.json'), 'w') as file:
+            json.dump({'result': [1, 2, 3]}, file)
+
+        handler = lambda *args: Handler(*args, directory=self.served)
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.server.daemon_threads = True
+        self.server.lock = threading.Lock()
+        self.server.connections = 0
+        self.server.active = 0
+        self.server.max_active = 0
+        self.server.paths = []
+        self.server.delay = 0
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+        self.downloader = techlag.download.Downloader(workers=8, per_host=2,
+                                                    chunk_size=1000)
+
+    def tearDown(self):
+        self.downloader.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.tmp_path)
+
+    def test_get_json(self):
+        """Test Downloader.get_json"""
+
+        result = self.downloader.get_json(self.url + 'data.json')
+        self.assertEqual(result, [1, 2, 3])
+        result = self.downloader.get_json(self.url + 'missing.json')
+        self.assertIsNone(result)
+        result = self.downloader.get_json(self.url + 'redirect/data.json')
+        self.assertEqual(result, [1, 2, 3])
+
+    def test_download(self):
+        """Test concurrent downloads, limited per host, over few connections"""
+
+        self.server.delay = 0.02
+        names = ['file%d.txt' % number for number in range(12)]
+        paths = self.downloader.map(self.downloader.download,
+                                    [self.url + name for name in names],
+                                    [os.path.join(self.store, name)
+                                        for name in names])
+        self.assertEqual(paths, [os.path.join(self.store, name)
+                                    for name in names])
+        for name in names:
+            with open(os.path.join(self.served, name), 'rb') as file:
+                expected = file.read()
+            with open(os.path.join(self.store, name), 'rb') as file:
+                self.assertEqual(file.read(), expected)
+        self.assertEqual(self.server.max_active, 2)
+        self.assertLessEqual(self.server.connections, 2)
+
+    def test_cache(self):
+        """Test Downloader.get_json with a cache, and offline mode"""
+
+        cache = techlag.cache.ResponseCache(os.path.join(self.tmp_path,
+                                                        'http.cache'))
+        downloader = techlag.download.Downloader(cache=cache)
+        urls = [self.url + 'data.json', self.url + 'missing.json']
+        self.assertEqual(downloader.map(downloader.get_json, urls),
+                        [[1, 2, 3], None])
+        os.remove(os.path.join(self.served, 'data.json'))
+        self.assertEqual(downloader.map(downloader.get_json, urls),
+                        [[1, 2, 3], None])
+        downloader.close()
+        downloader = techlag.download.Downloader(cache=cache, offline=True)
+        self.assertEqual(downloader.get_json(urls[0]), [1, 2, 3])
+        with self.assertRaises(urllib.error.URLError):
+            downloader.get_json(self.url + 'other.json')
+        with self.assertRaises(urllib.error.URLError):
+            downloader.download(self.url + 'file1.txt',
+                                os.path.join(self.store, 'file1.txt'))
+        downloader.close()
+
+    def test_download_error(self):
+        """Test that no file is left when a download fails"""
+
+        path = os.path.join(self.store, 'missing.txt')
+        with self.assertRaises(urllib.error.HTTPError) as context:
+            self.downloader.download(self.url + 'missing.txt', path)
+        self.assertEqual(context.exception.code, 404)
+        self.assertEqual(os.listdir(self.store), [])
+
+    def snapshot(self, versions):
+        """Serve files for versions of a package, as Debian Snapshot does
+
+        :param versions: dictionary, with list of names of files by version
+        :returns:        dictionary with hashes of files, by name
+
+        """
+
+        archive = os.path.join(self.served, 'archive', 'debian',
+                                '20160827T170032Z', 'pool', 'main', 'p', 'pkg')
+        os.makedirs(archive, exist_ok=True)
+        hashes = {}
+        for (version, files) in versions.items():
+            srcfiles = os.path.join(self.served, 'mr', 'package', 'pkg', version)
+            os.makedirs(srcfiles)
+            for name in files:
+                content = ('Content of ' + name).encode()
+                hashes[name] = hashlib.sha1(content).hexdigest()
+                with open(os.path.join(archive, name), 'wb') as file:
+                    file.write(content)
+                info = os.path.join(self.served, 'mr', 'file', hashes[name])
+                os.makedirs(info, exist_ok=True)
+                with open(os.path.join(info, 'info'), 'w') as file:
+                    json.dump({'result': [{'archive_name': 'debian',
+                                        'first_seen': '20160827T170032Z',
+                                        'path': '/pool/main/p/pkg',
+                                        'name': name}]}, file)
+            with open(os.path.join(srcfiles, 'srcfiles'), 'w') as file:
+                json.dump({'result': [{'hash': hashes[name]}
+                                        for name in files]}, file)
+        return hashes
+
+    def test_dpkg_snapshot(self):
+        """Test get_dpkg_snapshot, with the local server as Debian Snapshot"""
+
+        files = ['pkg_1.0.dsc', 'pkg_1.0.orig.tar.gz', 'pkg_1.0.debian.tar.xz']
+        self.snapshot({'1.0': files})
+        # A partial file, which should be downloaded again
+        with open(os.path.join(self.store, files[1]), 'w') as file:
+            file.write('Content')
+        with unittest.mock.patch.object(techlag.gitlag, 'SNAPSHOT_URL',
+                                        self.url):
+            (dsc, date) = techlag.gitlag.get_dpkg_snapshot('pkg', '1.0',
+                                    self.store, downloader=self.downloader)
+            self.assertEqual(dsc, os.path.join(self.store, 'pkg_1.0.dsc'))
+            self.assertEqual(date, '20160827T170032Z')
+            self.assertEqual(sorted(os.listdir(self.store)), sorted(files))
+            for name in files:
+                with open(os.path.join(self.store, name)) as file:
+                    self.assertEqual(file.read(), 'Content of ' + name)
+            with self.assertRaises(ValueError):
+                techlag.gitlag.get_dpkg_snapshot('pkg', '2.0',
+                                    self.store, downloader=self.downloader)
+
+    def test_dpkg_snapshot_objects(self):
+        """Test get_dpkg_snapshot with an ObjectStore"""
+
+        versions = {'1.0-1': ['pkg_1.0-1.dsc', 'pkg_1.0.orig.tar.gz'],
+                    '1.0-2': ['pkg_1.0-2.dsc', 'pkg_1.0.orig.tar.gz']}
+        hashes = self.snapshot(versions)
+        objects = techlag.download.ObjectStore(os.path.join(self.tmp_path,
+                                                            'objects'))
+        downloads = []
+        download = self.downloader.download
+        def counted_download(url, path, sha1=None):
+            downloads.append(url)
+            return download(url, path, sha1)
+        self.downloader.download = counted_download
+        with unittest.mock.patch.object(techlag.gitlag, 'SNAPSHOT_URL',
+                                        self.url):
+            for (version, files) in versions.items():
+                dir = os.path.join(self.store, version)
+                os.makedirs(dir)
+                (dsc, date) = techlag.gitlag.get_dpkg_snapshot('pkg', version,
+                            dir, downloader=self.downloader, objects=objects)
+                self.assertEqual(dsc, os.path.join(dir, files[0]))
+                self.assertEqual(sorted(os.listdir(dir)), sorted(files))
+                for name in files:
+                    with open(os.path.join(dir, name)) as file:
+                        self.assertEqual(file.read(), 'Content of ' + name)
+        self.assertEqual(len(downloads), 3)
+        for hash in hashes.values():
+            self.assertTrue(objects.verify(hash))
+
+    def test_objects_verify(self):
+        """Test that downloads with wrong hash are not stored"""
+
+        objects = techlag.download.ObjectStore(os.path.join(self.tmp_path,
+                                                            'objects'))
+        content = b'Line 1\n' * 10000
+        hash = hashlib.sha1(content).hexdigest()
+        with self.assertRaises(ValueError):
+            objects.fetch(self.downloader, self.url + 'file2.txt', hash)
+        self.assertFalse(objects.has(hash))
+        self.assertEqual(os.listdir(os.path.dirname(objects.path(hash))), [])
+        path = objects.fetch(self.downloader, self.url + 'file1.txt', hash)
+        self.assertEqual(path, objects.path(hash))
+        self.assertTrue(objects.verify(hash))
+        link = objects.link(hash, os.path.join(self.store, 'file1.txt'))
+        with open(link, 'rb') as file:
+            self.assertEqual(file.read(), content)
+        with open(objects.path(hash), 'wb') as file:
+            file.write(b'Corrupted')
+        self.assertFalse(objects.verify(hash))
+        self.assertFalse(objects.has(hash))
+        # Corrupted objects are downloaded again when fetched
+        with open(objects.path(hash), 'wb') as file:
+            file.write(b'Corrupted')
+        path = objects.fetch(self.downloader, self.url + 'file1.txt', hash)
+        with open(path, 'rb') as file:
+            self.assertEqual(file.read(), content)
+
+    def test_dpkg_catalogue(self):
+        """Test get_dpkg with a catalogue, with the local server as mirror"""
+
+        sources = os.path.join(self.served, 'dists', 'testing', 'main',
+                                'source')
+        os.makedirs(sources)
+        with gzip.open(os.path.join(sources, 'Sources.gz'), 'wt') as file:
+            for name in ['pkg1', 'pkg2']:
+                file.write("Package: {name}\nVersion: 1.0\n"
+                    "Directory: pool/main/p/{name}\nFiles:\n"
+                    " 0123 10 {name}_1.0.dsc\n 4567 20 {name}_1.0.tar.gz\n"
+                    "Section: misc\n\n".format(name=name))
+        for name in ['pkg1', 'pkg2']:
+            pool = os.path.join(self.served, 'pool', 'main', 'p', name)
+            os.makedirs(pool)
+            for file_name in [name + '_1.0.dsc', name + '_1.0.tar.gz']:
+                with open(os.path.join(pool, file_name), 'w') as file:
+                    file.write('Content of ' + file_name)
+        catalogue = techlag.cache.SourcesCatalogue(os.path.join(self.tmp_path,
+                                                            'sources.catalogue'))
+        with unittest.mock.patch.object(techlag.gitlag, 'DEBIAN_MIRROR',
+                                        self.url):
+            for name in ['pkg1', 'pkg2']:
+                dsc = techlag.gitlag.get_dpkg(name, 'testing/main', self.store,
+                        downloader=self.downloader, catalogue=catalogue)
+                self.assertEqual(dsc, os.path.join(self.store,
+                                                    name + '_1.0.dsc'))
+                with open(os.path.join(self.store, name + '_1.0.tar.gz')) as file:
+                    self.assertEqual(file.read(),
+                                    'Content of ' + name + '_1.0.tar.gz')
+            with self.assertRaises(ValueError):
+                techlag.gitlag.get_dpkg('pkg3', 'testing/main', self.store,
+                        downloader=self.downloader, catalogue=catalogue)
+        self.assertEqual(self.server.paths.count(
+                            '/dists/testing/main/source/Sources.gz'), 1)
+        catalogue.close()
+
+if __name__ == "__main__":
+    unittest.main()
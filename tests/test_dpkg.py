@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2016 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#     Jesus M. Gonzalez-Barahona <jgb@bitergia.com>
+#
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+import unittest.mock
+
+if not '..' in sys.path:
+    sys.path.insert(0, '..')
+
+import techlag.dpkg
+import techlag.gitlag
+
+CONTROL = """Source: pkg
+Maintainer: Tester <tester@example.com>
+Section: misc
+Priority: optional
+Standards-Version: 3.9.8
+
+Package: pkg
+Architecture: all
+Description: package for testing
+ Package for testing.
+"""
+
+CHANGELOG = """pkg ({version}) unstable; urgency=low
+
+  * Testing.
+
+ -- Tester <tester@example.com>  Sat, 27 Aug 2016 17:00:32 +0200
+"""
+
+UPSTREAM = {'README': 'Read me\n',
+            'src/main.c': ''.join('line %d\n' % no for no in range(40)),
+            'src/old.c': 'old\n',
+            'noeol.txt': 'one\ntwo'}
+
+PATCH = """Description: Change some files
+Author: Tester <tester@example.com>
+
+--- a/src/main.c
++++ b/src/main.c
+@@ -3,4 +3,5 @@
+ line 2
+ line 3
++line 3.5
+ line 4
+ line 5
+@@ -30,3 +31,3 @@
+ line 29
+-line 30
++line 30 changed
+ line 31
+--- a/src/old.c
++++ /dev/null
+@@ -1 +0,0 @@
+-old
+--- /dev/null
++++ b/src/new.c
+@@ -0,0 +1,2 @@
++new
++file
+--- a/noeol.txt
++++ b/noeol.txt
+@@ -1,2 +1,2 @@
+ one
+-two
+\\ No newline at end of file
++three
+\\ No newline at end of file
+"""
+
+
+def write(path, content):
+    """Write content to a file, creating its directory if needed."""
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as file:
+        file.write(content)
+
+def build(dir, format, version, patches={}):
+    """Build a Debian source package with dpkg-source.
+
+    :param dir:     directory for the package
+    :param format:  source format
+    :param version: version of the package
+    :param patches: dictionary with content of patches, by name
+    :returns:       path of the .dsc file
+
+    """
+
+    upstream_version = version.split('-')[0]
+    source = os.path.join(dir, 'pkg-' + upstream_version)
+    for (path, content) in UPSTREAM.items():
+        write(os.path.join(source, path), content)
+    if '-' in version:
+        subprocess.check_call(['tar', 'czf', 'pkg_%s.orig.tar.gz'
+                                % upstream_version, 'pkg-' + upstream_version],
+                                cwd=dir)
+    write(os.path.join(source, 'debian', 'control'), CONTROL)
+    write(os.path.join(source, 'debian', 'changelog'),
+            CHANGELOG.format(version=version))
+    write(os.path.join(source, 'debian', 'source', 'format'), format + '\n')
+    for (name, content) in patches.items():
+        write(os.path.join(source, 'debian', 'patches', name), content)
+    if patches:
+        write(os.path.join(source, 'debian', 'patches', 'series'),
+                ''.join(name + '\n' for name in patches))
+    subprocess.check_call(['dpkg-source', '--no-check', '-b', source],
+                            cwd=dir, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    shutil.rmtree(source)
+    return os.path.join(dir, 'pkg_%s.dsc' % version)
+
+
+class TestPatch(unittest.TestCase):
+    """Test parsing and applying patches"""
+
+    def test_parse_patch(self):
+        """Test parsing a patch for several files"""
+
+        patches = techlag.dpkg.parse_patch(PATCH.encode())
+        self.assertEqual([(patch.old, patch.new) for patch in patches],
+                        [('a/src/main.c', 'b/src/main.c'),
+                        ('a/src/old.c', None), (None, 'b/src/new.c'),
+                        ('a/noeol.txt', 'b/noeol.txt')])
+        self.assertEqual(patches[0].hunks[0],
+                        (3, [b'line 2\n', b'line 3\n', b'line 4\n', b'line 5\n'],
+                        [b'line 2\n', b'line 3\n', b'line 3.5\n', b'line 4\n',
+                        b'line 5\n'], 2, 2))
+        self.assertEqual(patches[3].hunks,
+                        [(1, [b'one\n', b'two'], [b'one\n', b'three'], 1, 0)])
+
+    def test_apply_hunks(self):
+        """Test applying hunks, with offsets"""
+
+        hunks = techlag.dpkg.parse_patch(PATCH.encode())[0].hunks
+        data = UPSTREAM['src/main.c'].encode()
+        result = techlag.dpkg.apply_hunks(data, hunks)
+        self.assertEqual(result, data.replace(b'line 3\n', b'line 3\nline 3.5\n')
+                                    .replace(b'line 30\n', b'line 30 changed\n'))
+        # Same result with some lines before (hunks found with an offset)
+        result = techlag.dpkg.apply_hunks(b'first\nsecond\n' + data, hunks)
+        self.assertEqual(result, b'first\nsecond\n'
+                                + data.replace(b'line 3\n', b'line 3\nline 3.5\n')
+                                    .replace(b'line 30\n', b'line 30 changed\n'))
+        with self.assertRaises(techlag.dpkg.UnsupportedPackage):
+            techlag.dpkg.apply_hunks(b'other\n', hunks)
+
+    def test_apply_hunks_anchored(self):
+        """Test applying hunks with less context on one side"""
+
+        # Less context after the change: only at the end
+        hunks = techlag.dpkg.parse_patch(PATCH.encode())[3].hunks
+        self.assertEqual(techlag.dpkg.apply_hunks(b'one\ntwo', hunks),
+                        b'one\nthree')
+        with self.assertRaises(techlag.dpkg.UnsupportedPackage):
+            techlag.dpkg.apply_hunks(b'one\ntwoone\ntwo\n', hunks)
+        # Less context before the change: only at the start
+        hunks = [(3, [b'b\n', b'c\n'], [b'B\n', b'c\n'], 0, 1)]
+        self.assertEqual(techlag.dpkg.apply_hunks(b'b\nc\nd\n', hunks),
+                        b'B\nc\nd\n')
+        with self.assertRaises(techlag.dpkg.UnsupportedPackage):
+            techlag.dpkg.apply_hunks(b'a\nb\nc\nd\n', hunks)
+
+
+class TestBlobPack(unittest.TestCase):
+    """Test packs of blobs"""
+
+    def setUp(self):
+
+        self.tmp_path = tempfile.mkdtemp(prefix='techlag_')
+        self.path = os.path.join(self.tmp_path, 'dir.blobs')
+
+    def tearDown(self):
+
+        shutil.rmtree(self.tmp_path)
+
+    def test_pack(self):
+        """Test writing and reading a pack"""
+
+        writer = techlag.gitlag.BlobPackWriter(self.path)
+        hashes = [writer.add(data) for data in [b'one\n', b'two\n', b'one\n']]
+        self.assertEqual(hashes[0], techlag.gitlag.blob_hash(b'one\n'))
+        self.assertEqual(hashes[0], hashes[2])
+        self.assertEqual(writer.read(hashes[1]), b'two\n')
+        self.assertFalse(os.path.exists(self.path))
+        writer.close()
+        pack = techlag.gitlag.BlobPack(self.path)
+        self.assertIn(hashes[0], pack)
+        self.assertNotIn(techlag.gitlag.blob_hash(b'three\n'), pack)
+        self.assertEqual(pack.read(hashes[0]), b'one\n')
+        self.assertEqual(pack.read(hashes[1]), b'two\n')
+        pack.close()
+
+    def test_abort(self):
+        """Test aborting writing a pack"""
+
+        writer = techlag.gitlag.BlobPackWriter(self.path)
+        writer.add(b'one\n')
+        writer.abort()
+        self.assertEqual(os.listdir(self.tmp_path), [])
+
+
+@unittest.skipIf(shutil.which('dpkg-source') is None, "dpkg-source not found")
+class TestReadDpkg(unittest.TestCase):
+    """Test reading Debian source packages, compared with dpkg-source"""
+
+    def setUp(self):
+
+        self.tmp_path = tempfile.mkdtemp(prefix='techlag_')
+
+    def tearDown(self):
+
+        shutil.rmtree(self.tmp_path)
+
+    def check(self, dsc):
+        """Check reading a package produces the tree dpkg-source extracts"""
+
+        extracted = os.path.join(self.tmp_path, 'extracted')
+        subprocess.check_call(['dpkg-source', '--extract', dsc, extracted],
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL)
+        expected = techlag.gitlag.Manifest.from_dir(extracted)
+        dir = techlag.dpkg.read_dpkg(dsc)
+        self.assertEqual(dir, os.path.splitext(dsc)[0])
+        self.assertFalse(os.path.exists(dir))
+        manifest = techlag.gitlag.Manifest.load(
+            techlag.gitlag.manifest_path(dir))
+        self.assertEqual(manifest.files, expected.files)
+        self.assertEqual(manifest.dirs, expected.dirs)
+        self.assertEqual(manifest.others, expected.others)
+        return (dir, extracted)
+
+    def test_quilt(self):
+        """Test a '3.0 (quilt)' package, with a patch"""
+
+        dsc = build(self.tmp_path, '3.0 (quilt)', '1.0-1',
+                    patches={'change.patch': PATCH})
+        (dir, extracted) = self.check(dsc)
+        # Contents of files are read from the pack
+        basedir = techlag.gitlag.BaseDir(dir,
+                            manifest=techlag.gitlag.manifest_path(dir))
+        self.assertIsNotNone(basedir.pack)
+        with open(os.path.join(extracted, 'src', 'main.c'), 'rb') as file:
+            data = file.read()
+        self.assertEqual(basedir.read_blob(techlag.gitlag.blob_hash(data)),
+                        data)
+        self.assertEqual(basedir.compare(extracted)['different_files'], 0)
+
+    def test_quilt_no_patches(self):
+        """Test a '3.0 (quilt)' package, with no patches"""
+
+        self.check(build(self.tmp_path, '3.0 (quilt)', '1.0-1'))
+
+    def test_native(self):
+        """Test a '3.0 (native)' package"""
+
+        self.check(build(self.tmp_path, '3.0 (native)', '1.0'))
+
+    def test_diff(self):
+        """Test a '1.0' package, with a diff"""
+
+        self.check(build(self.tmp_path, '1.0', '1.0-1'))
+
+    def test_fallback(self):
+        """Test falling back to dpkg-source, for unsupported packages"""
+
+        dsc = build(self.tmp_path, '3.0 (quilt)', '1.0-1',
+                    patches={'change.patch': PATCH})
+        with unittest.mock.patch.object(techlag.dpkg, 'read_tree',
+                    side_effect=techlag.dpkg.UnsupportedPackage("Testing")):
+            dir = techlag.dpkg.read_dpkg(dsc)
+        self.assertTrue(os.path.isdir(dir))
+        self.assertFalse(os.path.exists(techlag.gitlag.pack_path(dir)))
+        # Already extracted, with its manifest: not read again
+        techlag.gitlag.BaseDir(dir, manifest=techlag.gitlag.manifest_path(dir))
+        with unittest.mock.patch.object(techlag.dpkg, 'read_tree') as read_tree:
+            self.assertEqual(techlag.dpkg.read_dpkg(dsc), dir)
+        read_tree.assert_not_called()
+        self.assertTrue(os.path.isdir(dir))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -29,6 +29,7 @@ import tempfile
 import unittest
 import filecmp
 import logging
+import datetime
 
 if not '..' in sys.path:
     sys.path.insert(0, '..')
@@ -64,6 +65,33 @@ class TestMetrics (unittest.TestCase):
         result = metrics.normalized_effort(left_commit=0, right_commit=3)
         self.assertEqual(result, 2)
 
+    def test_effort_index(self):
+        """Test normalized efforts, compared with counting author days"""
+
+        repo = techlag.gitlag.Repo(url=self.url_git, dir=self.cloned_git)
+        metrics = techlag.gitlag.Metrics(repo=repo, dir=self.dir1,
+                                        metrics_kinds=['same'])
+        last = metrics.last_commit_no()
+        expected = {}
+        for left in range(last + 1):
+            for right in range(last + 1):
+                author_days = set()
+                for commit in range(left, right + 1):
+                    date = datetime.datetime.strptime(
+                                repo.authorship[commit]['authordate'],
+                                "%a %b %d %H:%M:%S %Y %z")
+                    author_days.add((repo.authorship[commit]['author'],
+                                    date.date()))
+                expected[(left, right)] = len(author_days)
+                result = metrics.normalized_effort(left, right)
+                self.assertEqual(result, expected[(left, right)])
+        lefts = list(range(last + 1)) + [last + 1, 0]
+        result = metrics.normalized_efforts(lefts)
+        self.assertEqual(result, [expected[(left, last)] for left in lefts[:-2]]
+                                + [0, expected[(0, last)]])
+        result = metrics.normalized_efforts([0, 1, 3], right_commit=2)
+        self.assertEqual(result, [expected[(0, 2)], expected[(1, 2)], 0])
+
 
 if __name__ == "__main__":
 #    logging.basicConfig(level=logging.DEBUG)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2016 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#     Jesus M. Gonzalez-Barahona <jgb@bitergia.com>
+#
+
+import sys
+import threading
+import time
+import unittest
+
+if not '..' in sys.path:
+    sys.path.insert(0, '..')
+
+import techlag.pipeline
+
+
+class TestPipeline(unittest.TestCase):
+    """Test pipelines of stages"""
+
+    def setUp(self):
+
+        self.lock = threading.Lock()
+        # Items started, and items in the pipeline (started, not produced)
+        self.started = []
+        self.running = 0
+        self.max_running = 0
+
+    def start(self, item):
+        """First stage: record the item as started"""
+
+        with self.lock:
+            self.started.append(item)
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        # Later items are faster, so that they are done out of order
+        time.sleep(0.01 * (5 - item % 5))
+        return item
+
+    def square(self, item):
+        """Second stage: square the item, failing for 3"""
+
+        if item == 3:
+            raise ValueError("Three")
+        return item * item
+
+    def produced(self, results):
+        """Record items produced, while consuming results"""
+
+        for result in results:
+            with self.lock:
+                self.running -= 1
+            yield result
+
+    def test_run(self):
+        """Test results are produced in order, with exceptions"""
+
+        pipeline = techlag.pipeline.Pipeline([
+            techlag.pipeline.Stage('start', self.start, workers=3),
+            techlag.pipeline.Stage('square', self.square)], ahead=4)
+        results = list(self.produced(pipeline.run(range(10))))
+        pipeline.close()
+        self.assertEqual([item for (item, result, error) in results],
+                        list(range(10)))
+        self.assertEqual([result for (item, result, error) in results],
+                        [0, 1, 4, None, 16, 25, 36, 49, 64, 81])
+        self.assertIsInstance(results[3][2], ValueError)
+        self.assertEqual([error for (item, result, error) in results
+                            if item != 3], [None] * 9)
+        self.assertGreater(self.max_running, 1)
+
+    def test_ahead(self):
+        """Test the number of items ahead of the one produced is bounded"""
+
+        pipeline = techlag.pipeline.Pipeline([
+            techlag.pipeline.Stage('start', self.start, workers=4)], ahead=2)
+        for (item, result, error) in self.produced(pipeline.run(range(10))):
+            # Slow consumer
+            time.sleep(0.02)
+            with self.lock:
+                self.assertLessEqual(len(self.started), item + 3)
+        self.assertLessEqual(self.max_running, 3)
+        # No items ahead: one by one
+        self.setUp()
+        pipeline.ahead = 0
+        list(self.produced(pipeline.run(range(5))))
+        self.assertEqual(self.max_running, 1)
+        pipeline.close()
+
+    def test_close_early(self):
+        """Test closing the generator before producing all results"""
+
+        pipeline = techlag.pipeline.Pipeline([
+            techlag.pipeline.Stage('start', self.start)], ahead=5)
+        results = pipeline.run(range(100))
+        self.assertEqual(next(results), (0, 0, None))
+        results.close()
+        pipeline.close()
+        self.assertLessEqual(len(self.started), 7)
+
+if __name__ == "__main__":
+    unittest.main()
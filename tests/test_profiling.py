@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2016 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#     Jesus M. Gonzalez-Barahona <jgb@bitergia.com>
+#
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+if not '..' in sys.path:
+    sys.path.insert(0, '..')
+
+import techlag.gitlag
+import techlag.profiling
+
+class TestProfile(unittest.TestCase):
+    """Tests for Profile, and the functions for the Profile of the process"""
+
+    def tearDown(self):
+
+        techlag.profiling.disable()
+
+    def test_report(self):
+        """Test Profile.add, Profile.count and Profile.report"""
+
+        profile = techlag.profiling.Profile()
+        profile.add('repo.clone', 1.5)
+        profile.add('repo.clone', 0.5)
+        profile.add('basedir.diff', 2.0, calls=4)
+        profile.count('lines.hits', 3)
+        profile.count('lines.misses')
+        profile.count('diffs.misses', 2)
+        profile.count('repo.bytes_read', 100)
+        report = profile.report()
+        self.assertEqual(report['phases'],
+                        {'basedir.diff': {'calls': 4, 'seconds': 2.0},
+                        'repo.clone': {'calls': 2, 'seconds': 2.0}})
+        self.assertEqual(report['counters'],
+                        {'diffs.misses': 2, 'lines.hits': 3,
+                        'lines.misses': 1, 'repo.bytes_read': 100})
+        self.assertEqual(report['hit_rates'], {'diffs': 0.0, 'lines': 0.75})
+        # Reports can be dumped as JSON
+        self.assertEqual(json.loads(json.dumps(report)), report)
+
+    def test_merge(self):
+        """Test Profile.merge"""
+
+        profile = techlag.profiling.Profile()
+        profile.add('repo.clone', 1.0)
+        profile.count('lines.hits')
+        other = techlag.profiling.Profile()
+        other.add('repo.clone', 2.0)
+        other.add('repo.log', 1.0)
+        other.count('lines.hits', 2)
+        profile.merge(other.report())
+        profile.merge(None)
+        report = profile.report()
+        self.assertEqual(report['phases'],
+                        {'repo.clone': {'calls': 2, 'seconds': 3.0},
+                        'repo.log': {'calls': 1, 'seconds': 1.0}})
+        self.assertEqual(report['counters'], {'lines.hits': 3})
+        self.assertEqual(report['hit_rates'], {'lines': 1.0})
+
+    def test_disabled(self):
+        """Test that nothing is recorded if profiling is disabled"""
+
+        self.assertFalse(techlag.profiling.enabled())
+        with techlag.profiling.phase('repo.clone'):
+            techlag.profiling.count('lines.hits')
+        techlag.profiling.merge({'phases': {}, 'counters': {'lines.hits': 1}})
+        self.assertIsNone(techlag.profiling.collect())
+
+    def test_collect(self):
+        """Test phase, count and collect, with profiling enabled"""
+
+        techlag.profiling.enable()
+        self.assertTrue(techlag.profiling.enabled())
+        with techlag.profiling.phase('repo.clone'):
+            techlag.profiling.count('lines.hits')
+        with self.assertRaises(ValueError):
+            with techlag.profiling.phase('repo.log'):
+                raise ValueError
+        report = techlag.profiling.collect()
+        self.assertEqual(report['phases']['repo.clone']['calls'], 1)
+        self.assertEqual(report['phases']['repo.log']['calls'], 1)
+        self.assertEqual(report['counters'], {'lines.hits': 1})
+        # A new Profile is started after collecting
+        report = techlag.profiling.collect()
+        self.assertEqual(report['phases'], {})
+        self.assertEqual(report['counters'], {})
+
+    def test_dump(self):
+        """Test dump"""
+
+        tmp_path = tempfile.mkdtemp(prefix='profiling_')
+        try:
+            profile = techlag.profiling.Profile()
+            profile.add('repo.clone', 1.0)
+            profile.count('lines.misses')
+            report = profile.report()
+            path = os.path.join(tmp_path, 'profile.json')
+            techlag.profiling.dump(path, {'pa': report, 'pb': report},
+                                    setup=report)
+            with open(path) as file:
+                dumped = json.load(file)
+            self.assertEqual(dumped['packages'], {'pa': report, 'pb': report})
+            self.assertEqual(dumped['setup'], report)
+            self.assertEqual(dumped['total']['phases'],
+                            {'repo.clone': {'calls': 3, 'seconds': 3.0}})
+            self.assertEqual(dumped['total']['counters'], {'lines.misses': 3})
+        finally:
+            shutil.rmtree(tmp_path)
+
+class TestProfilingGit(unittest.TestCase):
+    """Tests for profiling of the search of the closest commit"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_path = tempfile.mkdtemp(prefix='gitlag_')
+        cls.dir = os.path.join(cls.tmp_path, 'dirs2', '7beb12a')
+        cls.url_git = os.path.join(cls.tmp_path, 'dir2_git')
+        cls.cloned_git = os.path.join(cls.tmp_path, 'cloned_git')
+
+        subprocess.check_call(['tar', '-xzf', 'data/dirs2.tar.gz',
+                               '-C', cls.tmp_path])
+        subprocess.check_call(['tar', '-xzf', 'data/dir2_git.tar.gz',
+                               '-C', cls.tmp_path])
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_path)
+
+    def tearDown(self):
+
+        techlag.profiling.disable()
+
+    def test_closest_commit(self):
+        """Test phases and counters for Metrics.closest_commit
+
+        With a pool of workers, reports of workers are merged, so
+        counters for the search are the same (counters for caches are
+        not, since each worker has its own caches).
+
+        """
+
+        techlag.profiling.enable()
+        repo = techlag.gitlag.Repo(url=self.url_git, dir=self.cloned_git)
+        report = techlag.profiling.collect()
+        self.assertEqual(report['phases']['repo.clone']['calls'], 1)
+        self.assertEqual(report['counters']['repo.commits'], len(repo.commits))
+        reports = {}
+        for workers in [1, 2]:
+            metrics = techlag.gitlag.Metrics(repo=repo, dir=self.dir,
+                                            metrics_kinds=['same'],
+                                            mode='blobs', workers=workers)
+            result = metrics.closest_commit(closest_fn=max,
+                                            metric='common_lines',
+                                            strategy='exhaustive')
+            self.assertEqual(result['sequence'], 12)
+            reports[workers] = techlag.profiling.collect()
+            counters = reports[workers]['counters']
+            self.assertEqual(counters['search.evaluated'], len(repo.commits))
+            self.assertEqual(counters['basedir.files'], 12)
+            phases = reports[workers]['phases']
+            self.assertEqual(phases['metrics.compare']['calls'],
+                            len(repo.commits))
+            self.assertEqual(phases['metrics.search']['calls'], 1)
+        for name in ['search.evaluated', 'search.iterations']:
+            self.assertEqual(reports[1]['counters'].get(name),
+                            reports[2]['counters'].get(name))
+
+if __name__ == "__main__":
+    unittest.main()
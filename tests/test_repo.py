@@ -22,11 +22,13 @@
 #
 
 import os
+import pickle
 import shutil
 import subprocess
 import sys
 import tempfile
 import unittest
+import unittest.mock
 import filecmp
 import logging
 
@@ -68,6 +70,155 @@ class TestRepo(unittest.TestCase):
         result = os.listdir(copy)
         self.assertEqual(result, ['file_dir2.txt', 'only_1', 'dir_common'])
 
+    def test_user_repo(self):
+        """Test that a repository not cloned by Repo is not changed"""
+
+        user_git = os.path.join(self.tmp_path, 'user_git')
+        subprocess.check_call(['git', 'clone', '--quiet', self.url_git,
+                                user_git])
+        subprocess.check_call(['git', '-C', user_git, 'remote', 'remove',
+                                'origin'])
+        file = os.path.join(user_git, 'file_dir2.txt')
+        with open(file, 'a') as file_obj:
+            file_obj.write('Uncommitted line\n')
+        with open(file) as file_obj:
+            content = file_obj.read()
+        repo = techlag.gitlag.Repo(url=user_git, dir=user_git)
+        self.assertEqual(list(repo.commits), list(self.repo.commits))
+        with open(file) as file_obj:
+            self.assertEqual(file_obj.read(), content)
+
+    def test_trees_bounded(self):
+        """Test that the caches of trees in Repo are bounded"""
+
+        repo = techlag.gitlag.Repo(url=self.url_git, dir=self.cloned_git)
+        repo.trees = techlag.gitlag.LRUMemo(2)
+        repo.resolved_trees = techlag.gitlag.LRUMemo(1)
+        for commit_no in range(len(repo.commits)):
+            self.assertEqual(repo.tree(commit_no),
+                            self.repo.tree(commit_no))
+            self.assertLessEqual(len(repo.trees), 2)
+            self.assertLessEqual(len(repo.resolved_trees), 1)
+        copy = pickle.loads(pickle.dumps(repo))
+        self.assertEqual(len(copy.trees), 0)
+        self.assertEqual(copy.trees.maxsize, repo.trees_size)
+        memo = pickle.loads(pickle.dumps(repo.trees))
+        self.assertEqual((memo, memo.maxsize), (repo.trees, 2))
+
+    def test_index(self):
+        """Test the compact index of commits (Repo.index)"""
+
+        index = self.repo.index
+        self.assertEqual(len(index), len(self.repo.commits))
+        self.assertEqual(len(index.hashes), 20 * len(index))
+        self.assertEqual(index.hashes[:20].hex(),
+                        '1b3a00eb5668e602b70faa3dbc6f6eda0046e8f5')
+        self.assertEqual(index.hash(0), self.repo.commits[0][0])
+        self.assertEqual(len(index.authors), len(set(index.author_ids)))
+        result = subprocess.check_output(['git', '-C', self.cloned_git,
+                    'log', '--reverse', '--format=%H %cd', 'origin/master'],
+                    universal_newlines=True).splitlines()
+        commits = [' '.join(commit) for commit in self.repo.commits]
+        self.assertEqual(commits, result)
+        self.assertEqual(self.repo.commits[-1],
+                        self.repo.commits[self.repo.last_commit()])
+
+    def test_format_date(self):
+        """Test format_date"""
+
+        result = techlag.gitlag.format_date(1470474821, 120)
+        self.assertEqual(result, 'Sat Aug 6 11:13:41 2016 +0200')
+        result = techlag.gitlag.format_date(1470474821, -330)
+        self.assertEqual(result, 'Sat Aug 6 03:43:41 2016 -0530')
+
+class TestRepoCache(unittest.TestCase):
+    """Tests for the cache of commits of class Repo"""
+
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp(prefix='gitlag_')
+        self.url_git = os.path.join(self.tmp_path, 'dir_git')
+        self.cloned_git = os.path.join(self.tmp_path, 'cloned_git')
+        self.cache = os.path.join(self.tmp_path, 'commits.cache')
+
+        subprocess.check_call(['tar', '-xzf', 'data/dir_git.tar.gz',
+                               '-C', self.tmp_path])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def commit(self, message):
+        """Add a commit to the upstream repository"""
+
+        with open(os.path.join(self.url_git, 'new.txt'), 'a') as file:
+            file.write(message + '\n')
+        for cmd in [['add', 'new.txt'],
+                    ['-c', 'user.name=Test', '-c', 'user.email=test@example.com',
+                        'commit', '--quiet', '-m', message]]:
+            subprocess.check_call(['git', '-C', self.url_git] + cmd)
+
+    def git_log(self):
+        """Commits in the cloned repository, as [hash, date]"""
+
+        result = subprocess.check_output(['git', '-C', self.cloned_git,
+                    'log', '--reverse', '--topo-order', '--format=%H%x00%cd',
+                    'origin/master'], universal_newlines=True)
+        return [line.split('\0') for line in result.splitlines()]
+
+    def test_save_load(self):
+        """Test CommitIndex.save and CommitIndex.load"""
+
+        repo = techlag.gitlag.Repo(url=self.url_git, dir=self.cloned_git,
+                                    cache=self.cache)
+        index = techlag.gitlag.CommitIndex.load(self.cache)
+        self.assertEqual(index.heads, repo.index.heads)
+        self.assertEqual(index.authors, repo.index.authors)
+        self.assertEqual(list(techlag.gitlag.CommitList(index)),
+                        list(repo.commits))
+        self.assertEqual(list(techlag.gitlag.AuthorshipList(index)),
+                        list(repo.authorship))
+        # No temporary file is left, even if saving fails
+        files = sorted(os.listdir(self.tmp_path))
+        with unittest.mock.patch.object(index, '_columns',
+                                        side_effect=OSError('No space')):
+            with self.assertRaises(OSError):
+                index.save(self.cache)
+        self.assertEqual(sorted(os.listdir(self.tmp_path)), files)
+        self.assertIsNotNone(techlag.gitlag.CommitIndex.load(self.cache))
+        with open(self.cache, 'wb') as file:
+            file.write(b'Not an index')
+        self.assertIsNone(techlag.gitlag.CommitIndex.load(self.cache))
+
+    def test_update(self):
+        """Test that new commits are appended to the cache"""
+
+        repo = techlag.gitlag.Repo(url=self.url_git, dir=self.cloned_git,
+                                    cache=self.cache)
+        commits = list(repo.commits)
+        self.commit('First new commit.')
+        self.commit('Second new commit.')
+        repo = techlag.gitlag.Repo(url=self.url_git, dir=self.cloned_git,
+                                    cache=self.cache)
+        self.assertEqual(len(repo.commits), len(commits) + 2)
+        self.assertEqual(list(repo.commits[:len(commits)]), commits)
+        self.assertEqual(list(repo.commits), self.git_log())
+        self.assertEqual(repo.authorship[-1]['author'],
+                        'Test <test@example.com>')
+        index = techlag.gitlag.CommitIndex.load(self.cache)
+        self.assertEqual(len(index), len(commits) + 2)
+
+    def test_rewritten(self):
+        """Test that the cache is rebuilt if history is rewritten"""
+
+        self.commit('New commit.')
+        repo = techlag.gitlag.Repo(url=self.url_git, dir=self.cloned_git,
+                                    cache=self.cache)
+        subprocess.check_call(['git', '-C', self.url_git, 'reset',
+                                '--quiet', '--hard', 'HEAD~1'])
+        self.commit('Other new commit.')
+        repo = techlag.gitlag.Repo(url=self.url_git, dir=self.cloned_git,
+                                    cache=self.cache)
+        self.assertEqual(list(repo.commits), self.git_log())
+
 if __name__ == "__main__":
 #    logging.basicConfig(level=logging.DEBUG)
     unittest.main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2016 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#     Jesus M. Gonzalez-Barahona <jgb@bitergia.com>
+#
+
+import concurrent.futures
+import multiprocessing
+import os
+import shelve
+import shutil
+import sys
+import tempfile
+import unittest
+
+if not '..' in sys.path:
+    sys.path.insert(0, '..')
+
+import techlag.results
+
+
+def result(value):
+    """Result with all metrics equal to value (except hash)"""
+
+    result = {name: value for name in techlag.results.METRIC_NAMES}
+    result['closest_hash'] = 'hash' + str(value)
+    return result
+
+def put_results(path, package, count):
+    """Store results for versions of a package (run in other processes)"""
+
+    results = techlag.results.ResultsStore(path)
+    for value in range(count):
+        results.put(package, '1.' + str(value), '2016%04d' % value,
+                    result(value))
+    results.close()
+    return count
+
+
+class TestResultsStore(unittest.TestCase):
+    """Tests for the ResultsStore class"""
+
+    def setUp(self):
+
+        self.tmp_path = tempfile.mkdtemp(prefix='techlag_')
+        self.path = os.path.join(self.tmp_path, 'results.db')
+        self.results = techlag.results.ResultsStore(self.path)
+
+    def tearDown(self):
+
+        self.results.close()
+        shutil.rmtree(self.tmp_path)
+
+    def test_put_get(self):
+        """Test ResultsStore.put and ResultsStore.get"""
+
+        self.assertIsNone(self.results.get('pkg', '1.0'))
+        self.results.put('pkg', '1.0', '20160827T170032Z', result(1))
+        self.assertEqual(self.results.get('pkg', '1.0'),
+                        ('20160827T170032Z', result(1)))
+        self.results.put('pkg', '1.0', '20160827T170032Z', result(2))
+        self.assertEqual(self.results.get('pkg', '1.0'),
+                        ('20160827T170032Z', result(2)))
+        # Persistent, and typed by column
+        self.results.close()
+        results = techlag.results.ResultsStore(self.path)
+        (date, stored) = results.get('pkg', '1.0')
+        self.assertIsInstance(stored['closest_hash'], str)
+        self.assertIsInstance(stored['closest_sequence'], int)
+        results.close()
+
+    def test_results(self):
+        """Test ResultsStore.results, ordered by package and date"""
+
+        self.results.put('pkg2', '1.0', '20160101T000000Z', result(1))
+        self.results.put('pkg1', '2.0', '20160301T000000Z', result(2))
+        self.results.put('pkg1', '10.0', '20160201T000000Z', result(3))
+        self.assertEqual([item[:3] for item in self.results.results()],
+                        [('pkg1', '10.0', '20160201T000000Z'),
+                        ('pkg1', '2.0', '20160301T000000Z'),
+                        ('pkg2', '1.0', '20160101T000000Z')])
+        self.assertEqual(list(self.results.results('pkg2')),
+                        [('pkg2', '1.0', '20160101T000000Z', result(1))])
+        self.assertEqual(list(self.results.results('pkg3')), [])
+
+    def test_missing(self):
+        """Test versions stored as missing"""
+
+        self.results.put_missing('pkg', '1.0', ('No src files', '1.0'))
+        self.results.put_missing('pkg', '2.0', (ValueError('Error'),))
+        self.assertEqual(list(self.results.missing()),
+                        [('pkg', '1.0', ('No src files', '1.0')),
+                        ('pkg', '2.0', ('Error',))])
+        # Computed later: not missing any more
+        self.results.put('pkg', '1.0', '20160827T170032Z', result(1))
+        self.assertEqual([item[:2] for item in self.results.missing('pkg')],
+                        [('pkg', '2.0')])
+        self.results.clear_missing()
+        self.assertEqual(list(self.results.missing()), [])
+
+    def test_import_shelves(self):
+        """Test importing results from shelves of earlier debsnapshotlag"""
+
+        done = os.path.join(self.tmp_path, 'data-done')
+        missing = os.path.join(self.tmp_path, 'data-missing')
+        with shelve.open(done) as shelf:
+            shelf['pkg:1.0'] = {'date': '20160101T000000Z', 'result': result(1)}
+            shelf['pkg:1:2.0'] = {'date': '20160201T000000Z',
+                                'result': result(2)}
+        with shelve.open(missing) as shelf:
+            shelf['pkg:3.0'] = ('No src files', '3.0')
+        self.assertEqual(self.results.import_shelves(done, missing), (2, 1))
+        self.assertEqual(list(self.results.results('pkg')),
+                        [('pkg', '1.0', '20160101T000000Z', result(1)),
+                        ('pkg', '1:2.0', '20160201T000000Z', result(2))])
+        self.assertEqual(list(self.results.missing()),
+                        [('pkg', '3.0', ('No src files', '3.0'))])
+        # Importing again replaces, and doesn't duplicate
+        self.assertEqual(self.results.import_shelves(done), (2, 0))
+        self.assertEqual(len(list(self.results.results())), 2)
+        self.assertEqual(self.results.import_shelves(missing=missing), (0, 1))
+
+    def test_concurrent(self):
+        """Test several processes writing at the same time"""
+
+        context = multiprocessing.get_context('spawn')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=3,
+                                            mp_context=context) as executor:
+            counts = list(executor.map(put_results, [self.path] * 3,
+                                        ['pkg1', 'pkg2', 'pkg3'], [50] * 3))
+        self.assertEqual(counts, [50] * 3)
+        for package in ['pkg1', 'pkg2', 'pkg3']:
+            self.assertEqual([item[1] for item in self.results.results(package)],
+                            ['1.' + str(value) for value in range(50)])
+
+if __name__ == "__main__":
+    unittest.main()
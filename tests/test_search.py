@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2016 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#     Jesus M. Gonzalez-Barahona <jgb@bitergia.com>
+#
+
+import datetime
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+if not '..' in sys.path:
+    sys.path.insert(0, '..')
+
+import techlag.gitlag
+import techlag.search
+
+class FakeMetrics:
+    """Metrics object with metrics computed by a function
+
+    Implements the part of the interface of gitlag.Metrics used by strategies.
+
+    """
+
+    def __init__(self, values, sign=-1):
+        self.commits = list(range(len(values)))
+        self.values = values
+        self.sign = sign
+        self.metrics = {}
+        self.evaluated = 0
+
+    def screen_metrics(self, commits):
+        return {commit_no: {'same_blobs': self.sign * self.values[commit_no],
+                            'jaccard': 0}
+                for commit_no in commits}
+
+    def commits_metrics(self, commits):
+        for commit_no in commits:
+            if commit_no not in self.metrics:
+                self.evaluated += 1
+                self.metrics[commit_no] = {'value': self.values[commit_no]}
+
+    def range_metrics(self, first, last, step):
+        self.commits_metrics(list(range(first, last, step)) + [last])
+
+    def closest_range(self, length, metric, closest_fn):
+        return techlag.gitlag.Metrics.closest_range(self, length,
+                                                    metric, closest_fn)
+
+class TestStrategies(unittest.TestCase):
+    """Tests for search strategies, with synthetic metrics"""
+
+    def search(self, strategy, values, closest_fn=min):
+        metrics = FakeMetrics(values, sign=-1 if closest_fn is min else 1)
+        strategy = techlag.search.get_strategy(strategy)
+        closest = strategy.search(metrics, metric='value',
+                                    closest_fn=closest_fn)
+        return (closest, metrics.evaluated)
+
+    def test_unimodal(self):
+        """Test that all strategies find the closest commit of unimodal metrics"""
+
+        for closest in [0, 1, 217, 500, 998, 999]:
+            values = [abs(commit_no - closest) for commit_no in range(1000)]
+            for strategy in techlag.search.STRATEGIES:
+                self.assertEqual(self.search(strategy, values)[0], closest)
+            values = [-value for value in values]
+            for strategy in techlag.search.STRATEGIES:
+                self.assertEqual(self.search(strategy, values, max)[0],
+                                closest)
+
+    def test_evaluated(self):
+        """Test that unimodal strategies evaluate less commits"""
+
+        values = [abs(commit_no - 617) for commit_no in range(1000)]
+        (closest, golden) = self.search('golden', values)
+        (closest, ternary) = self.search('ternary', values)
+        (closest, screen) = self.search('screen', values)
+        (closest, ratio) = self.search('ratio', values)
+        (closest, exhaustive) = self.search('exhaustive', values)
+        self.assertEqual(exhaustive, 1000)
+        self.assertLess(golden, 25)
+        self.assertLess(golden, ternary)
+        self.assertLess(ternary, ratio)
+        self.assertLess(screen, 25)
+
+    def test_refinement(self):
+        """Test local refinement, for metrics not exactly unimodal"""
+
+        values = [abs(commit_no - 40) for commit_no in range(100)]
+        # Local minimum close to the closest commit
+        values[36] = 3
+        values[37] = 5
+        self.assertEqual(self.search('golden', values)[0], 40)
+        self.assertEqual(self.search('ternary', values)[0], 40)
+
+    def test_window(self):
+        """Test that strategies search only in the window"""
+
+        values = [abs(commit_no - 500) for commit_no in range(1000)]
+        for strategy in techlag.search.STRATEGIES:
+            metrics = FakeMetrics(values)
+            closest = techlag.search.get_strategy(strategy).search(metrics,
+                                metric='value', closest_fn=min,
+                                first=100, last=300)
+            self.assertEqual(closest, 300)
+            self.assertTrue(all(100 <= commit_no <= 300
+                                for commit_no in metrics.metrics))
+
+    def test_strategy_names(self):
+        """Test names of strategies"""
+
+        for name in techlag.search.STRATEGIES:
+            self.assertEqual(techlag.search.get_strategy(name).name, name)
+        with self.assertRaises(ValueError):
+            techlag.search.get_strategy('unknown')
+
+    def test_strategy_parameters(self):
+        """Test that screen uses top and window, not ratio and range"""
+
+        strategy = techlag.search.get_strategy('screen', ratio=5, range=5,
+                                                top=4, window=2)
+        self.assertEqual((strategy.top, strategy.window_length), (4, 2))
+        strategy = techlag.search.get_strategy('ratio', ratio=5, range=4,
+                                                top=20, window=2)
+        self.assertEqual((strategy.ratio, strategy.range), (5, 4))
+
+class TestSearchGit(unittest.TestCase):
+    """Tests for search strategies, with a small git repository"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_path = tempfile.mkdtemp(prefix='gitlag_')
+        cls.dirs = [os.path.join(cls.tmp_path, 'dirs2', dir)
+                    for dir in ['b306b9d', '7beb12a', '6d1c3c1']]
+        cls.url_git = os.path.join(cls.tmp_path, 'dir2_git')
+        cls.cloned_git = os.path.join(cls.tmp_path, 'cloned_git')
+
+        subprocess.check_call(['tar', '-xzf', 'data/dirs2.tar.gz',
+                               '-C', cls.tmp_path])
+        subprocess.check_call(['tar', '-xzf', 'data/dir2_git.tar.gz',
+                               '-C', cls.tmp_path])
+
+        cls.repo = techlag.gitlag.Repo(url=cls.url_git, dir=cls.cloned_git)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_path)
+
+    def test_closest_commit(self):
+        """Test Metrics.closest_commit with all strategies"""
+
+        for dir, sequence in zip(self.dirs, [0, 12, 27]):
+            for strategy in techlag.search.STRATEGIES:
+                metrics = techlag.gitlag.Metrics(repo=self.repo, dir=dir,
+                                                metrics_kinds=['same'],
+                                                mode='blobs')
+                result = metrics.closest_commit(closest_fn=max,
+                                                metric='common_lines',
+                                                strategy=strategy)
+                self.assertEqual(result['sequence'], sequence)
+                self.assertEqual(metrics.evaluated, len(metrics.metrics))
+                if strategy == 'exhaustive':
+                    self.assertEqual(metrics.evaluated, len(metrics.commits))
+
+    def test_screen_metrics(self):
+        """Test Metrics.screen_metrics"""
+
+        for mode in techlag.gitlag.MODES:
+            metrics = techlag.gitlag.Metrics(repo=self.repo, dir=self.dirs[1],
+                                            metrics_kinds=['same'], mode=mode)
+            screens = metrics.screen_metrics(range(len(metrics.commits)))
+            self.assertEqual(screens[12],
+                            {'same_blobs': 12, 'common_paths': 12,
+                            'jaccard': 1.0})
+            self.assertEqual(max(screens, key=lambda commit_no:
+                                screens[commit_no]['same_blobs']), 12)
+            # No commit was evaluated
+            self.assertEqual(metrics.metrics, {})
+
+    def test_date_window(self):
+        """Test Metrics.date_window, and closest_commit starting with it"""
+
+        metrics = techlag.gitlag.Metrics(repo=self.repo, dir=self.dirs[1],
+                                        metrics_kinds=['same'], mode='blobs')
+        date = datetime.datetime(2016, 8, 6, 9, 13, 41)
+        self.assertEqual(metrics.date_window(date, datetime.timedelta(0)),
+                        (12, 12))
+        (first, last) = metrics.date_window(date, datetime.timedelta(days=3))
+        self.assertTrue(first <= 12 <= last)
+        self.assertEqual(metrics.date_window(datetime.datetime(2000, 1, 1),
+                                            datetime.timedelta(days=3)),
+                        (0, 0))
+        # Same windows as checking the dates of all commits
+        dates = [techlag.gitlag.commit_date(commit[1])
+                    for commit in self.repo.commits]
+        for (commit_no, commit_date) in enumerate(dates):
+            for days in [0, 1, 10]:
+                date = commit_date.replace(tzinfo=None) \
+                    - commit_date.utcoffset() + datetime.timedelta(hours=5)
+                slack = datetime.timedelta(days=days)
+                close = [number for (number, other) in enumerate(dates)
+                            if abs(other - commit_date
+                                    - datetime.timedelta(hours=5)) <= slack]
+                if not close:
+                    close = [min(enumerate(dates), key=lambda item:
+                                abs(item[1] - commit_date
+                                    - datetime.timedelta(hours=5)))[0]]
+                self.assertEqual(metrics.date_window(date, slack),
+                                (close[0], close[-1]))
+        for strategy in techlag.search.STRATEGIES:
+            for date in [datetime.datetime(2016, 8, 6),
+                        datetime.datetime(2016, 6, 1),
+                        datetime.datetime(2016, 12, 1)]:
+                metrics = techlag.gitlag.Metrics(repo=self.repo,
+                                                dir=self.dirs[1],
+                                                metrics_kinds=['same'],
+                                                mode='blobs')
+                result = metrics.closest_commit(closest_fn=max,
+                                metric='common_lines', strategy=strategy,
+                                date=date, slack=datetime.timedelta(days=2))
+                self.assertEqual(result['sequence'], 12)
+
+    def test_seed(self):
+        """Test closest_commit starting around a seed commit"""
+
+        metrics = techlag.gitlag.Metrics(repo=self.repo, dir=self.dirs[1],
+                                        metrics_kinds=['same'], mode='blobs')
+        metrics.closest_commit(closest_fn=max, metric='common_lines')
+        evaluated = metrics.evaluated
+        for strategy in techlag.search.STRATEGIES:
+            for seed in [0, 10, 12, 27]:
+                metrics = techlag.gitlag.Metrics(repo=self.repo,
+                                                dir=self.dirs[1],
+                                                metrics_kinds=['same'],
+                                                mode='blobs')
+                result = metrics.closest_commit(closest_fn=max,
+                                metric='common_lines', strategy=strategy,
+                                seed=seed)
+                self.assertEqual(result['sequence'], 12)
+                if seed == 12:
+                    self.assertLess(metrics.evaluated, evaluated)
+
+    def test_lag_seed_hash(self):
+        """Test lag seeding the search with the hash of a commit"""
+
+        hash = self.repo.commits[12][0]
+        for seed_hash in [None, hash, '0' * 40]:
+            result = techlag.gitlag.lag(name='dir', upstream=self.repo,
+                                        dir=self.dirs[1], after=None,
+                                        store=None, mode='blobs',
+                                        seed_hash=seed_hash)
+            self.assertEqual(result['closest_sequence'], 12)
+            self.assertEqual(result['closest_hash'], hash)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2016 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#     Jesus M. Gonzalez-Barahona <jgb@bitergia.com>
+#
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+if not '..' in sys.path:
+    sys.path.insert(0, '..')
+
+import techlag.gitlag
+import techlag.sketch
+
+class TestSketch(unittest.TestCase):
+    """Tests for sketches of trees, and the index of sketches of commits"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_path = tempfile.mkdtemp(prefix='gitlag_')
+        cls.dirs = [os.path.join(cls.tmp_path, 'dirs2', dir)
+                    for dir in ['b306b9d', '7beb12a', '6d1c3c1']]
+        cls.url_git = os.path.join(cls.tmp_path, 'dir2_git')
+        cls.cloned_git = os.path.join(cls.tmp_path, 'cloned_git')
+
+        subprocess.check_call(['tar', '-xzf', 'data/dirs2.tar.gz',
+                               '-C', cls.tmp_path])
+        subprocess.check_call(['tar', '-xzf', 'data/dir2_git.tar.gz',
+                               '-C', cls.tmp_path])
+
+        cls.repo = techlag.gitlag.Repo(url=cls.url_git, dir=cls.cloned_git)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_path)
+
+    def test_tree_sketch(self):
+        """Test that sketches estimate similarity of trees"""
+
+        memo = {}
+        sketches = [techlag.sketch.tree_sketch(self.repo.tree(commit_no), memo)
+                    for commit_no in range(self.repo.last_commit() + 1)]
+        # Sketches are the same without memo
+        for commit_no, sketch in enumerate(sketches):
+            self.assertEqual(techlag.sketch.tree_sketch(
+                                self.repo.tree(commit_no)), sketch)
+        # Trees from a directory and from git have the same sketch
+        basedir = techlag.gitlag.BaseDir(self.dirs[1])
+        sketch = techlag.sketch.tree_sketch(basedir.tree)
+        self.assertEqual(techlag.sketch.similarity(sketch, sketches[12]), 1.0)
+        self.assertLess(techlag.sketch.similarity(sketch, sketches[0]), 0.5)
+        empty = techlag.sketch.tree_sketch(techlag.gitlag.Tree())
+        self.assertEqual(empty, techlag.sketch.EMPTY)
+
+    def test_index(self):
+        """Test SketchIndex"""
+
+        path = os.path.join(self.tmp_path, 'index.sketch')
+        index = techlag.sketch.SketchIndex(path)
+        self.assertEqual(index.update(self.repo), self.repo.last_commit() + 1)
+        self.assertEqual(index.update(self.repo), 0)
+        index.close()
+        # Index is persistent
+        index = techlag.sketch.SketchIndex(path)
+        self.assertEqual(index.update(self.repo), 0)
+        for dir, sequence in zip(self.dirs, [0, 12, 27]):
+            basedir = techlag.gitlag.BaseDir(dir)
+            similar = index.query(basedir.tree, k=3)
+            self.assertLessEqual(len(similar), 3)
+            self.assertEqual(similar[0],
+                            (self.repo.commits[sequence][0], 1.0))
+        index.close()
+
+    def test_bounded(self):
+        """Test that caches don't grow while updating SketchIndex"""
+
+        memo = techlag.sketch.LRUMemo(2)
+        memo['a'] = 1
+        memo['b'] = 2
+        self.assertEqual(memo['a'], 1)
+        memo['c'] = 3
+        self.assertEqual(list(memo), ['a', 'c'])
+
+        repo = techlag.gitlag.Repo(url=self.url_git, dir=self.cloned_git)
+        index = techlag.sketch.SketchIndex(':memory:')
+        index.batch = 5
+        index.memo_size = 10
+        self.assertEqual(index.update(repo), repo.last_commit() + 1)
+        self.assertEqual(repo.trees, {})
+        self.assertEqual(repo.resolved_trees, {})
+        # Sketches are the same as with an unbounded memo
+        similar = index.query(repo.tree(12), k=1)
+        self.assertEqual(similar, [(repo.commits[12][0], 1.0)])
+        index.close()
+
+    def test_candidates(self):
+        """Test Metrics.closest_commit seeded by candidates from the index"""
+
+        index = techlag.sketch.SketchIndex(':memory:')
+        index.update(self.repo)
+        metrics = techlag.gitlag.Metrics(repo=self.repo, dir=self.dirs[1],
+                                        metrics_kinds=['same'], mode='blobs')
+        candidates = [metrics.commit_number(hash) for (hash, similarity)
+                        in index.query(metrics.basedir.tree)]
+        result = metrics.closest_commit(closest_fn=max, metric='common_lines',
+                                        candidates=candidates)
+        self.assertEqual(result['sequence'], 12)
+        self.assertLess(metrics.evaluated, len(metrics.commits))
+
+if __name__ == "__main__":
+    unittest.main()